@@ -0,0 +1,104 @@
+"""Logging throughput of the clients against a local stub server.
+
+The stub accepts batches without storing them and answers after a fixed
+latency, so the numbers show the client overhead and how well it hides the
+latency of the server:
+
+    python benchmarks/stub_throughput.py --records 20000 --latency 0.005
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from aiohttp import web
+
+import logsink
+
+
+def start_stub(latency):
+    """Run the stub server in a background thread, returns its port."""
+
+    async def post_log(request):
+        await request.read()
+        await asyncio.sleep(latency)
+        return web.json_response({}, status=201)
+
+    async def post_batch(request):
+        batch = await request.json()
+        await asyncio.sleep(latency)
+        return web.json_response({'inserted': len(batch), 'errors': []}, status=201)
+
+    app = web.Application()
+    app.router.add_post('/logs', post_log)
+    app.router.add_post('/logs/batch', post_batch)
+
+    started = threading.Event()
+    port = []
+
+    def run():
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, 'localhost', 0)
+        loop.run_until_complete(site.start())
+        port.append(site._server.sockets[0].getsockname()[1])
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+
+    return port[0]
+
+
+def bench_executor(port, records, threads=10):
+    # What asyncio services do today: blocking log() calls on executor threads
+    client = logsink.Client('bench', port=port)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            await asyncio.gather(*[
+                loop.run_in_executor(executor, client.log, 'bench message %d' % i)
+                for i in range(records)
+            ])
+
+    asyncio.run(run())
+
+
+def bench_buffered(port, records):
+    with logsink.Client('bench', port=port, buffered=True) as client:
+        for i in range(records):
+            client.log('bench message %d' % i)
+
+
+def bench_async(port, records):
+    async def run():
+        async with logsink.AsyncClient('bench', port=port) as client:
+            for i in range(records):
+                await client.log('bench message %d' % i)
+
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds per request')
+    args = parser.parse_args()
+
+    port = start_stub(args.latency)
+    for name, bench in [
+            ('Client in executor', bench_executor),
+            ('Client(buffered=True)', bench_buffered),
+            ('AsyncClient', bench_async)]:
+        start = time.perf_counter()
+        bench(port, args.records)
+        elapsed = time.perf_counter() - start
+        print('%-22s %10.0f records/s' % (name, args.records/elapsed))
+
+
+if __name__ == '__main__':
+    main()
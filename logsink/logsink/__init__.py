@@ -1,4 +1,40 @@
+import datetime
+import gzip
+import json
+import logging
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .buffer import (
+    BatchBuffer,
+    BLOCK,
+    DROP_OLDEST,
+    DROP_NEWEST,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_FLUSH_INTERVAL,
+    DEFAULT_MAX_QUEUE_SIZE,
+)
+from . import lineprotocol
+from .spool import Replayer, Spool, DEFAULT_MAX_BYTES as DEFAULT_SPOOL_MAX_BYTES
+
+try:
+    from .aio import AsyncClient
+except ImportError:
+    # aiohttp is optional: pip install logsink[aio]
+    pass
+
+
+logger = logging.getLogger(__name__)
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+CSV_MIMETYPE = 'text/csv'
+EXPORT_CHUNK_SIZE = 64*1024
+
+DEFAULT_POOL_SIZE = 10  # max number of keep-alive connections
+DEFAULT_RETRIES = 3
 
 
 class Client:
@@ -8,24 +44,74 @@ class Client:
             host='localhost',
             port=6789,
             token=None,
-            protocol='http'):
+            protocol='http',
+            buffered=False,
+            batch_size=DEFAULT_BATCH_SIZE,
+            flush_interval=DEFAULT_FLUSH_INTERVAL,
+            max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+            overflow=BLOCK,
+            pool_size=DEFAULT_POOL_SIZE,
+            retries=DEFAULT_RETRIES,
+            compress_threshold=None,
+            spool=None,
+            spool_max_bytes=DEFAULT_SPOOL_MAX_BYTES,
+            line_protocol=False):
         self.client_name = client_name
         self.protocol = protocol
         self.host = host
         self.port = port
         self.token = token
 
-    @property
-    def url(self):
-        return '%s://%s:%s' % (self.protocol, self.host, self.port)
-
-    @property
-    def headers(self):
-        return {
+        self.url = '%s://%s:%s' % (protocol, host, port)
+        self.headers = {
             'Content-Type': 'application/json',
-            'X-Auth-Token': self.token,
+            'X-Auth-Token': token,
         }
 
+        # Request bodies of at least compress_threshold bytes are gzipped,
+        # None disables compression
+        self.compress_threshold = compress_threshold
+        # Batches are sent in InfluxDB line protocol instead of JSON
+        self.line_protocol = line_protocol
+
+        # Keep-alive connections are reused by all the requests
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=_retry(retries)
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Messages which can't be sent (or don't fit in the buffer) are
+        # written to the spool directory and sent again later, see spool.py
+        self.spool = None
+        self.replayer = None
+        if spool is not None:
+            self.spool = Spool(spool, max_bytes=spool_max_bytes)
+            self.replayer = Replayer(self.spool, self._post_batch)
+
+        # In buffered mode log() only queues the message, a background
+        # thread sends the queued messages in batches
+        self.buffer = None
+        if buffered:
+            self.buffer = BatchBuffer(
+                self._send_batch,
+                batch_size=batch_size,
+                flush_interval=flush_interval,
+                max_size=max_queue_size,
+                overflow=overflow,
+                spill=self._spool_record if self.spool is not None else None
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def log(self, message, **kwargs):
         data = {
             'message': message,
@@ -35,29 +121,231 @@ class Client:
         }
         data['tags'].update(kwargs)
 
-        return requests.post(
-            '%s/logs' % self.url,
-            json=data,
-            headers=self.headers
-        )
+        if self.buffer is not None:
+            # The message is sent later so stamp it with the time of the call
+            data['tags'].setdefault('time', _utcnow().isoformat())
+            return self.buffer.put(data)
+
+        if self.spool is None:
+            return self._post('/logs', data)
+
+        try:
+            r = self._post('/logs', data)
+        except requests.RequestException as e:
+            logger.debug('Spooling log record: %s', e)
+            r = None
+        if r is None or r.status_code >= 500:
+            self._spool_record(data)
+        elif len(self.spool):
+            # The server is back
+            self.replayer.wake()
+
+        return r
+
+    def flush(self, timeout=None):
+        """Send all buffered messages. No-op when not in buffered mode."""
+
+        if self.buffer is None:
+            return True
+        return self.buffer.flush(timeout=timeout)
+
+    def close(self, timeout=None):
+        """Flush buffered messages, stop the background sender and close the
+        connections."""
+
+        if self.buffer is not None and not self.buffer.closed:
+            self.buffer.close(timeout=timeout)
+        if self.replayer is not None:
+            # What's left is replayed by the next client using the spool
+            self.replayer.close(timeout=timeout)
+            self.spool.close()
+        self.session.close()
+
+    def _post(self, path, data):
+        if self.compress_threshold is None:
+            return self.session.post(self.url + path, json=data)
+
+        return self._post_body(path, json.dumps(data).encode('utf-8'))
+
+    def _post_body(self, path, body, content_type=None):
+        headers = {}
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        if self.compress_threshold is not None and len(body) >= self.compress_threshold:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        return self.session.post(self.url + path, data=body, headers=headers or None)
+
+    def _send_batch(self, records):
+        if self.spool is None:
+            return self._post_batch(records)
+
+        try:
+            self._post_batch(records)
+        except requests.RequestException as e:
+            if e.response is not None and e.response.status_code < 500:
+                raise
+            logger.warning('Spooling %d log records: %s', len(records), e)
+            self.spool.append(records)
+            return
+        if len(self.spool):
+            self.replayer.wake()
+
+    def _spool_record(self, record):
+        # Sent later, stamp it with the time it was logged
+        record['tags'].setdefault('time', _utcnow().isoformat())
+        self.spool.append([record])
+
+    def _post_batch(self, records):
+        if self.line_protocol:
+            r = self._post_body(
+                '/logs/batch',
+                lineprotocol.encode(records),
+                lineprotocol.MIMETYPE
+            )
+        else:
+            r = self._post('/logs/batch', records)
+        r.raise_for_status()
+
+        # Some records may have been rejected (207 Multi-Status)
+        for error in r.json().get('errors', []):
+            logger.error(
+                'Log record rejected: %s (%r)',
+                error['error'],
+                records[error['index']]
+            )
 
     def query(self, **params):
-        return requests.get(
+        return self.session.get(
             '%s/logs' % self.url,
-            params=params,
-            headers=self.headers
+            params=params
         ).json()
 
-    def clear(self, **params):
-        return requests.delete(
+    def query_pages(self, **params):
+        """Yield all pages of the query, each one a list of log messages.
+
+        Uses keyset pagination (cursor) so deep pages are as cheap as the
+        first one. The page parameter is ignored."""
+
+        params = dict(params, cursor=params.get('cursor', ''))
+        params.pop('page', None)
+
+        while True:
+            r = self.query(**params)
+            if r['logs']:
+                yield r['logs']
+            if r['next_cursor'] is None:
+                return
+            params['cursor'] = r['next_cursor']
+
+    def iter_query(self, **params):
+        """Yield ALL the log messages matching the query, one by one.
+
+        The server streams the results so they are read lazily, without
+        holding the whole result in memory. Pagination parameters are
+        ignored except per_page which sets how many messages the server
+        reads from its storage at a time."""
+
+        r = self.session.get(
             '%s/logs' % self.url,
             params=params,
-            headers=self.headers
+            headers={'Accept': NDJSON_MIMETYPE},
+            stream=True
+        )
+        try:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            r.close()
+
+    def export(self, path, format='ndjson', **params):
+        """Write ALL the log messages matching the query to the file path.
+
+        The file is gzip compressed NDJSON, or CSV with format='csv', as sent
+        by the server: it reads the time range in slices, concurrently, and
+        streams the messages in time order. Pagination parameters are
+        ignored. Returns the number of bytes written."""
+
+        if format not in ('ndjson', 'csv'):
+            raise ValueError('format must be ndjson or csv.')
+
+        r = self.session.get(
+            '%s/logs/export' % self.url,
+            params=params,
+            headers={'Accept': CSV_MIMETYPE if format == 'csv' else NDJSON_MIMETYPE},
+            stream=True
+        )
+        try:
+            r.raise_for_status()
+            size = 0
+            with open(path, 'wb') as f:
+                # Kept compressed
+                for chunk in r.raw.stream(EXPORT_CHUNK_SIZE, decode_content=False):
+                    f.write(chunk)
+                    size += len(chunk)
+        finally:
+            r.close()
+
+        return size
+
+    def tail(self, **params):
+        """Yield the new log messages matching the query as they are logged.
+
+        Runs until the generator is closed. It also ends when the server
+        drops the connection because the messages weren't read fast enough,
+        then some messages may be missed."""
+
+        r = self.session.get(
+            '%s/logs/tail' % self.url,
+            params=params,
+            headers={'Accept': NDJSON_MIMETYPE},
+            stream=True
+        )
+        try:
+            r.raise_for_status()
+            # Small chunks, otherwise messages wait until a chunk is full
+            for line in r.iter_lines(chunk_size=1):
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            r.close()
+
+    def clear(self, **params):
+        return self.session.delete(
+            '%s/logs' % self.url,
+            params=params
         )
 
     def agg_query(self, **params):
-        return requests.get(
+        return self.session.get(
             '%s/logs/aggregated' % self.url,
-            params=params,
-            headers=self.headers
+            params=params
         ).json()
+
+
+def _retry(retries):
+    # Connection errors and 503 (server busy, see its Retry-After header) are
+    # retried, whatever the method: the server didn't process the request.
+    # Other errors are not, a log could be stored twice.
+    kwargs = {
+        'total': retries,
+        'connect': retries,
+        'read': 0,
+        'status': retries,
+        'status_forcelist': [503],
+        'backoff_factor': 0.2,
+        # Return the last response instead of raising
+        'raise_on_status': False,
+    }
+    try:
+        return Retry(allowed_methods=None, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=None, **kwargs)
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
@@ -0,0 +1,288 @@
+import asyncio
+import collections
+import datetime
+import json
+import logging
+import time
+
+import aiohttp
+
+from .buffer import (
+    BLOCK,
+    DROP_OLDEST,
+    DROP_NEWEST,
+    OVERFLOW_POLICIES,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_FLUSH_INTERVAL,
+    DEFAULT_MAX_QUEUE_SIZE,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_CONNECTIONS = 10  # size of the keep-alive connection pool
+DEFAULT_MAX_IN_FLIGHT = 4  # max number of batches being sent at the same time
+
+
+class AsyncClient:
+    """asyncio version of logsink.Client.
+
+    log() queues the messages, they are sent in batches to /logs/batch as
+    soon as batch_size messages are queued or the oldest queued message is
+    flush_interval seconds old. Up to max_in_flight batches are sent
+    concurrently over a pool of keep-alive connections.
+
+    Must be closed (or used as an async context manager) so that the
+    queued messages are sent."""
+
+    def __init__(
+            self,
+            client_name,
+            host='localhost',
+            port=6789,
+            token=None,
+            protocol='http',
+            batch_size=DEFAULT_BATCH_SIZE,
+            flush_interval=DEFAULT_FLUSH_INTERVAL,
+            max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+            overflow=BLOCK,
+            max_connections=DEFAULT_MAX_CONNECTIONS,
+            max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                'overflow must be one of: %s' % ', '.join(OVERFLOW_POLICIES)
+            )
+        if batch_size < 1 or max_queue_size < 1 or max_in_flight < 1:
+            raise ValueError('batch_size, max_queue_size and max_in_flight must be positive.')
+
+        self.client_name = client_name
+        self.protocol = protocol
+        self.host = host
+        self.port = port
+        self.token = token
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.overflow = overflow
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+        self._session = None
+        # (enqueue monotonic time, record) pairs
+        self._queue = collections.deque()
+        self._in_flight = set()  # tasks sending a batch
+        self._room = asyncio.Condition()
+        self._timer = None
+        self._flushing = False
+        self._closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __len__(self):
+        return len(self._queue)
+
+    @property
+    def url(self):
+        return '%s://%s:%s' % (self.protocol, self.host, self.port)
+
+    @property
+    def headers(self):
+        headers = {'Content-Type': 'application/json'}
+        if self.token is not None:
+            headers['X-Auth-Token'] = self.token
+        return headers
+
+    @property
+    def session(self):
+        # Created on first use, it must be created in the running event loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                headers=self.headers
+            )
+        return self._session
+
+    async def log(self, message, **kwargs):
+        """Queue a message. Returns False if it was dropped."""
+
+        if self._closed:
+            raise RuntimeError('Client is closed.')
+
+        data = {
+            'message': message,
+            'tags': {
+                'client_name': self.client_name,
+            },
+        }
+        data['tags'].update(kwargs)
+        # The message is sent later so stamp it with the time of the call
+        data['tags'].setdefault('time', _utcnow().isoformat())
+
+        if len(self._queue) >= self.max_queue_size:
+            if self.overflow == DROP_NEWEST:
+                self.dropped += 1
+                return False
+            elif self.overflow == DROP_OLDEST:
+                self._queue.popleft()
+                self.dropped += 1
+            else:
+                async with self._room:
+                    await self._room.wait_for(
+                        lambda: self._closed or len(self._queue) < self.max_queue_size
+                    )
+                if self._closed:
+                    raise RuntimeError('Client is closed.')
+
+        self._queue.append((time.monotonic(), data))
+        self._dispatch()
+
+        return True
+
+    async def flush(self):
+        """Send all queued messages and wait until they are sent."""
+
+        self._flushing = True
+        try:
+            while self._queue or self._in_flight:
+                self._dispatch()
+                await asyncio.wait(set(self._in_flight))
+        finally:
+            self._flushing = False
+
+    async def close(self):
+        """Flush queued messages and close the connections."""
+
+        if self._closed:
+            return
+
+        await self.flush()
+        self._closed = True
+        async with self._room:
+            self._room.notify_all()
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._session is not None:
+            await self._session.close()
+
+    def _dispatch(self):
+        # Start sending the batches which are due, as far as max_in_flight
+        # allows. Called again when a batch is sent.
+        while self._queue and len(self._in_flight) < self.max_in_flight:
+            age = time.monotonic() - self._queue[0][0]
+            if not (self._flushing
+                    or len(self._queue) >= self.batch_size
+                    or age >= self.flush_interval):
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(
+                        self.flush_interval - age, self._timer_expired
+                    )
+                return
+
+            batch = [
+                self._queue.popleft()[1]
+                for _ in range(min(self.batch_size, len(self._queue)))
+            ]
+            task = asyncio.ensure_future(self._send_batch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._batch_sent)
+            if self.overflow == BLOCK:
+                # Wake up the log() calls waiting for room in the queue
+                asyncio.ensure_future(self._notify_room())
+
+    def _timer_expired(self):
+        self._timer = None
+        self._dispatch()
+
+    def _batch_sent(self, task):
+        self._in_flight.discard(task)
+        self._dispatch()
+
+    async def _notify_room(self):
+        async with self._room:
+            self._room.notify_all()
+
+    async def _send_batch(self, records):
+        try:
+            async with self.session.post(
+                    '%s/logs/batch' % self.url,
+                    data=json.dumps(records)) as r:
+                r.raise_for_status()
+                result = await r.json()
+        except Exception:
+            self.failed += len(records)
+            logger.exception('Failed to send %d log records', len(records))
+            return
+
+        self.sent += len(records)
+        # Some records may have been rejected (207 Multi-Status)
+        for error in result.get('errors', []):
+            logger.error(
+                'Log record rejected: %s (%r)',
+                error['error'],
+                records[error['index']]
+            )
+
+    async def query(self, **params):
+        async with self.session.get(
+                '%s/logs' % self.url,
+                params=_params(params)) as r:
+            return await r.json()
+
+    async def query_pages(self, **params):
+        """Async iterator over all pages of the query, see Client.query_pages.
+
+        The next page is requested while the current one is processed."""
+
+        params = dict(params, cursor=params.get('cursor', ''))
+        params.pop('page', None)
+
+        next_page = asyncio.ensure_future(self.query(**params))
+        try:
+            while next_page is not None:
+                r = await next_page
+                next_page = None
+                if r['next_cursor'] is not None:
+                    params['cursor'] = r['next_cursor']
+                    next_page = asyncio.ensure_future(self.query(**params))
+                if r['logs']:
+                    yield r['logs']
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def clear(self, **params):
+        async with self.session.delete(
+                '%s/logs' % self.url,
+                params=_params(params)) as r:
+            # Read the body so that it can still be used after the
+            # connection is released
+            await r.read()
+            return r
+
+    async def agg_query(self, **params):
+        async with self.session.get(
+                '%s/logs/aggregated' % self.url,
+                params=_params(params)) as r:
+            return await r.json()
+
+
+def _params(params):
+    # aiohttp only accepts strings and numbers as query parameters
+    return {
+        key: str(value) if isinstance(value, bool) or not isinstance(value, (str, int, float)) else value
+        for key, value in params.items()
+    }
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
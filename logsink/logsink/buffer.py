@@ -0,0 +1,185 @@
+import collections
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Policies applied by BatchBuffer.put when the queue is full
+BLOCK = 'block'  # wait until the flusher makes room
+DROP_OLDEST = 'drop_oldest'  # discard the oldest queued record
+DROP_NEWEST = 'drop_newest'  # discard the record being put
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 1.0  # seconds
+DEFAULT_MAX_QUEUE_SIZE = 10000
+
+
+class BatchBuffer:
+    """Bounded in-memory queue drained by a background flusher thread.
+
+    Records are handed to send_batch(records) in batches of at most
+    batch_size, as soon as batch_size records are queued or the oldest
+    queued record is flush_interval seconds old.
+
+    With spill set, records put when the queue is full are handed to
+    spill(record) instead of applying the overflow policy."""
+
+    def __init__(
+            self,
+            send_batch,
+            batch_size=DEFAULT_BATCH_SIZE,
+            flush_interval=DEFAULT_FLUSH_INTERVAL,
+            max_size=DEFAULT_MAX_QUEUE_SIZE,
+            overflow=BLOCK,
+            block_timeout=None,
+            spill=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                'overflow must be one of: %s' % ', '.join(OVERFLOW_POLICIES)
+            )
+        if batch_size < 1 or max_size < 1:
+            raise ValueError('batch_size and max_size must be positive.')
+
+        self.send_batch = send_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.spill = spill
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+        # (enqueue monotonic time, record) pairs
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._flush_requested = False
+        self._closed = False
+
+        self._thread = threading.Thread(
+            target=self._run,
+            name='logsink-flusher',
+            daemon=True
+        )
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._queue)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def put(self, record):
+        """Queue a record. Returns False if it was dropped."""
+
+        spill = False
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Buffer is closed.')
+
+            if len(self._queue) >= self.max_size:
+                if self.spill is not None:
+                    spill = True
+                elif self.overflow == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.overflow == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self._cond.notify_all()
+                    has_room = self._cond.wait_for(
+                        lambda: self._closed or len(self._queue) < self.max_size,
+                        timeout=self.block_timeout
+                    )
+                    if self._closed:
+                        raise RuntimeError('Buffer is closed.')
+                    if not has_room:
+                        self.dropped += 1
+                        return False
+
+            if not spill:
+                self._queue.append((time.monotonic(), record))
+                if len(self._queue) >= self.batch_size:
+                    self._cond.notify_all()
+
+        if spill:
+            # Outside of the lock, writing to disk may be slow
+            self.spill(record)
+
+        return True
+
+    def flush(self, timeout=None):
+        """Send everything queued so far and wait for it to complete.
+
+        Returns False if timeout expired before the queue was drained."""
+
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(
+                lambda: not self._queue and not self._in_flight,
+                timeout=timeout
+            )
+
+    def close(self, timeout=None):
+        """Flush the remaining records and stop the flusher thread."""
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if len(self._queue) >= self.batch_size:
+                    break
+                if not self._queue:
+                    self._flush_requested = False
+                    self._cond.notify_all()
+                    if self._closed:
+                        return None
+                    self._cond.wait()
+                    continue
+                if self._closed or self._flush_requested:
+                    break
+                age = time.monotonic() - self._queue[0][0]
+                if age >= self.flush_interval:
+                    break
+                self._cond.wait(self.flush_interval - age)
+
+            batch = [
+                self._queue.popleft()[1]
+                for _ in range(min(self.batch_size, len(self._queue)))
+            ]
+            self._in_flight += 1
+            # Wake up producers blocked on a full queue
+            self._cond.notify_all()
+
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            try:
+                self.send_batch(batch)
+                self.sent += len(batch)
+            except Exception:
+                self.failed += len(batch)
+                logger.exception('Failed to send %d log records', len(batch))
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify_all()
@@ -0,0 +1,303 @@
+# Write-ahead spool of log records on local disk.
+#
+# Records which couldn't be sent are appended to segment files, one JSON
+# object per line:
+#
+#     <path>/<sequence number>.spool
+#
+# A Replayer thread sends them again, oldest first and in large batches, once
+# the server is back. The spool holds at most max_bytes, the oldest segments
+# are dropped past that. Appends are buffered and fsynced at most every
+# fsync_interval seconds, a crash loses the records of the last interval.
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_BYTES = 100*1024*1024
+DEFAULT_SEGMENT_BYTES = 4*1024*1024  # a new segment is started past this size
+DEFAULT_FSYNC_INTERVAL = 1.0  # seconds
+DEFAULT_REPLAY_BATCH_SIZE = 1000
+DEFAULT_REPLAY_INTERVAL = 5.0  # seconds between replay attempts
+
+SEGMENT_SUFFIX = '.spool'
+POSITION_FILE = 'position'  # "<sequence number> <offset>" of the next record to replay
+
+
+class Spool:
+    """Append-only spool of log records in local segment files."""
+
+    def __init__(
+            self,
+            path,
+            max_bytes=DEFAULT_MAX_BYTES,
+            segment_bytes=DEFAULT_SEGMENT_BYTES,
+            fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        if segment_bytes > max_bytes:
+            raise ValueError('segment_bytes must not exceed max_bytes.')
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+
+        self.dropped = 0  # records evicted because the spool was full
+
+        self._lock = threading.Lock()
+        # sequence number -> [size, number of records], oldest first
+        self._segments = collections.OrderedDict()
+        self._size = 0
+        self._count = 0
+        # Replay position in the oldest segment: offset and records before it
+        self._offset = 0
+        self._replayed = 0
+        self._writer = None  # last segment, open for appending
+        self._last_sync = time.monotonic()
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def __len__(self):
+        """Number of records waiting to be replayed."""
+
+        return self._count - self._replayed
+
+    @property
+    def size(self):
+        return self._size
+
+    def _load(self):
+        seqs = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        for seq in seqs:
+            with open(self._segment_path(seq), 'rb+') as f:
+                data = f.read()
+                # Drop a partially written last record
+                size = data.rfind(b'\n') + 1
+                if size < len(data):
+                    f.truncate(size)
+            self._segments[seq] = [size, data.count(b'\n', 0, size)]
+            self._size += size
+            self._count += self._segments[seq][1]
+
+        try:
+            with open(os.path.join(self.path, POSITION_FILE)) as f:
+                seq, offset = (int(value) for value in f.read().split())
+        except (OSError, ValueError):
+            return
+        if self._segments and seq == next(iter(self._segments)):
+            with open(self._segment_path(seq), 'rb') as f:
+                self._replayed = f.read(offset).count(b'\n')
+            self._offset = offset
+
+    def _segment_path(self, seq):
+        return os.path.join(self.path, '%08d%s' % (seq, SEGMENT_SUFFIX))
+
+    def append(self, records):
+        """Append records (JSON serializable dicts) to the spool."""
+
+        lines = [json.dumps(record).encode('utf-8') + b'\n' for record in records]
+        size = sum(len(line) for line in lines)
+
+        with self._lock:
+            if self._writer is None or self._segments[self._last_seq()][0] >= self.segment_bytes:
+                self._new_segment()
+            self._writer.writelines(lines)
+            segment = self._segments[self._last_seq()]
+            segment[0] += size
+            segment[1] += len(lines)
+            self._size += size
+            self._count += len(lines)
+
+            self._evict()
+            if time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def sync(self):
+        """Write the appended records to disk."""
+
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._sync()
+                self._writer.close()
+                self._writer = None
+
+    def read(self, count):
+        """Read up to count records to replay, oldest first.
+
+        Returns (records, position), position is passed to commit once the
+        records are sent. (None, None) when there's nothing to replay."""
+
+        with self._lock:
+            self._drop_replayed()
+            if not len(self):
+                return None, None
+            seq = next(iter(self._segments))
+            start = offset = self._offset
+            end = self._segments[seq][0]
+            if self._writer is not None and seq == self._last_seq():
+                # Appended records may still be in the write buffer
+                self._writer.flush()
+
+        records = []
+        lines = 0
+        try:
+            with open(self._segment_path(seq), 'rb') as f:
+                f.seek(offset)
+                while lines < count and offset < end:
+                    line = f.readline()
+                    offset += len(line)
+                    lines += 1
+                    try:
+                        records.append(json.loads(line.decode('utf-8')))
+                    except ValueError:
+                        logger.error('Skipping corrupt spooled record: %r', line)
+        except FileNotFoundError:
+            # Evicted meanwhile
+            return [], (seq, start, offset, 0)
+
+        return records, (seq, start, offset, lines)
+
+    def commit(self, position):
+        """Mark the records returned by read as sent."""
+
+        seq, start, offset, lines = position
+        with self._lock:
+            if not self._segments or seq != next(iter(self._segments)) or start != self._offset:
+                # Evicted meanwhile
+                return
+            self._offset = offset
+            self._replayed += lines
+            self._drop_replayed()
+
+            path = os.path.join(self.path, POSITION_FILE)
+            with open(path + '.tmp', 'w') as f:
+                f.write('%d %d' % (next(iter(self._segments)), self._offset))
+            os.replace(path + '.tmp', path)
+
+    def _new_segment(self):
+        if self._writer is not None:
+            self._sync()
+            self._writer.close()
+        seq = self._last_seq() + 1 if self._segments else 0
+        self._writer = open(self._segment_path(seq), 'ab')
+        self._segments[seq] = [0, 0]
+
+    def _last_seq(self):
+        return next(reversed(self._segments))
+
+    def _sync(self):
+        if self._writer is not None:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+        self._last_sync = time.monotonic()
+
+    def _evict(self):
+        # The last segment is never evicted, segment_bytes <= max_bytes
+        while self._size > self.max_bytes and len(self._segments) > 1:
+            seq, (size, count) = self._segments.popitem(last=False)
+            os.remove(self._segment_path(seq))
+            dropped = count - self._replayed
+            self.dropped += dropped
+            self._size -= size
+            self._count -= count
+            self._offset = self._replayed = 0
+            logger.warning('Spool full, dropped %d log records', dropped)
+
+    def _drop_replayed(self):
+        # Remove the oldest segments once they're replayed, except the one
+        # being appended to
+        while len(self._segments) > 1:
+            seq, (size, count) = next(iter(self._segments.items()))
+            if self._offset < size:
+                return
+            del self._segments[seq]
+            os.remove(self._segment_path(seq))
+            self._size -= size
+            self._count -= count
+            self._offset = self._replayed = 0
+
+
+class Replayer:
+    """Sends the spooled records with send_batch(records), in a background
+    thread.
+
+    Replay is attempted every interval seconds, or sooner when woken up
+    (e.g. after a successful send), and stops at the first failed batch."""
+
+    def __init__(
+            self,
+            spool,
+            send_batch,
+            batch_size=DEFAULT_REPLAY_BATCH_SIZE,
+            interval=DEFAULT_REPLAY_INTERVAL):
+        self.spool = spool
+        self.send_batch = send_batch
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self.sent = 0
+
+        self._lock = threading.Lock()  # one replay at a time
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='logsink-replayer',
+            daemon=True
+        )
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def close(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def replay(self):
+        """Send the spooled records until none are left, returns how many
+        were sent. Exceptions of send_batch are raised."""
+
+        sent = 0
+        with self._lock:
+            while not self._stop.is_set():
+                records, position = self.spool.read(self.batch_size)
+                if position is None:
+                    break
+                if records:
+                    self.send_batch(records)
+                self.spool.commit(position)
+                sent += len(records)
+                self.sent += len(records)
+
+        return sent
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+            self.spool.sync()
+            if not len(self.spool):
+                continue
+            try:
+                sent = self.replay()
+            except Exception as e:
+                logger.warning('Replay of spooled log records failed: %s', e)
+            else:
+                if sent:
+                    logger.info('Replayed %d spooled log records', sent)
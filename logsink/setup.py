@@ -20,6 +20,9 @@ setup(
     keywords = "logsink",
     url = "http://packages.python.org/an_example_pypi_project",
     install_requires=['requests==2.12.4'],
+    extras_require={
+        'aio': ['aiohttp'],
+    },
     packages=['logsink'],
     classifiers=[
         "Development Status :: 3 - Alpha",
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import unittest
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+import logsink
+
+
+TEST_TOKEN = os.environ['TEST_TOKEN']
+
+
+class StubServer:
+    """Minimal logsink API keeping the logs in memory."""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.logs = []
+        self.batches = []
+        self.tokens = set()
+
+        self.app = web.Application()
+        self.app.router.add_post('/logs/batch', self.post_batch)
+        self.app.router.add_get('/logs', self.get_logs)
+        self.app.router.add_delete('/logs', self.delete_logs)
+        self.app.router.add_get('/logs/aggregated', self.get_aggregated)
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, 'localhost', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def post_batch(self, request):
+        self.tokens.add(request.headers.get('X-Auth-Token'))
+        batch = await request.json()
+        await asyncio.sleep(self.delay)
+        self.batches.append(batch)
+        self.logs.extend(batch)
+        return web.json_response({'inserted': len(batch), 'errors': []}, status=201)
+
+    async def get_logs(self, request):
+        per_page = int(request.query.get('per_page', 25))
+        start = int(request.query.get('cursor') or 0)
+        logs = self.logs[start:start + per_page]
+        next_cursor = start + per_page if start + per_page < len(self.logs) else None
+        return web.json_response({
+            'logs': logs,
+            'next_cursor': None if next_cursor is None else str(next_cursor),
+        })
+
+    async def delete_logs(self, request):
+        self.logs = []
+        return web.json_response(200)
+
+    async def get_aggregated(self, request):
+        return web.json_response([{'time': '2017-01-01T00:00:00Z', 'count_message': len(self.logs)}])
+
+
+@unittest.skipIf(web is None, 'aiohttp is not installed')
+class TestAsyncClient(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = StubServer()
+        await self.server.start()
+
+    async def asyncTearDown(self):
+        await self.server.stop()
+
+    def client(self, **kwargs):
+        return logsink.AsyncClient(
+            'test-client',
+            port=self.server.port,
+            token=TEST_TOKEN,
+            **kwargs
+        )
+
+    async def test_batching(self):
+        async with self.client(batch_size=10, flush_interval=60) as client:
+            for i in range(25):
+                self.assertTrue(await client.log('test message %d' % i, tag1='value1'))
+            await asyncio.sleep(0.1)
+            # Full batches are sent right away
+            self.assertEqual([len(batch) for batch in self.server.batches], [10, 10])
+
+        self.assertEqual([len(batch) for batch in self.server.batches], [10, 10, 5])
+        self.assertEqual(self.server.tokens, {TEST_TOKEN})
+        self.assertEqual(client.sent, 25)
+        # Concurrent batches may arrive in any order
+        self.assertEqual(
+            sorted(log['message'] for log in self.server.logs),
+            sorted('test message %d' % i for i in range(25))
+        )
+        log = self.server.logs[0]
+        self.assertEqual(log['tags']['client_name'], 'test-client')
+        self.assertEqual(log['tags']['tag1'], 'value1')
+        self.assertIn('time', log['tags'])
+
+    async def test_flush_interval(self):
+        async with self.client(flush_interval=0.05) as client:
+            await client.log('test message')
+            await asyncio.sleep(0.2)
+            self.assertEqual(len(self.server.logs), 1)
+
+    async def test_pipelining(self):
+        self.server.delay = 0.2
+        async with self.client(batch_size=1, max_in_flight=5) as client:
+            start = asyncio.get_running_loop().time()
+            for i in range(5):
+                await client.log('test message %d' % i)
+            await client.flush()
+            # The batches are sent concurrently
+            self.assertLess(asyncio.get_running_loop().time() - start, 0.6)
+
+    async def test_overflow(self):
+        self.server.delay = 0.1
+        async with self.client(batch_size=1, max_in_flight=1, max_queue_size=2,
+                               overflow=logsink.DROP_NEWEST) as client:
+            results = [await client.log('test message %d' % i) for i in range(5)]
+        # One batch in flight, two queued
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(client.dropped, 2)
+
+        async with self.client(batch_size=1, max_in_flight=1, max_queue_size=2) as client:
+            for i in range(5):
+                self.assertTrue(await client.log('blocking message %d' % i))
+        self.assertEqual(
+            [log['message'] for log in self.server.logs[-5:]],
+            ['blocking message %d' % i for i in range(5)]
+        )
+        self.assertEqual(client.dropped, 0)
+
+    async def test_query(self):
+        async with self.client() as client:
+            for i in range(5):
+                await client.log('test message %d' % i)
+            await client.flush()
+
+            pages = [page async for page in client.query_pages(per_page=2)]
+            self.assertEqual([len(page) for page in pages], [2, 2, 1])
+
+            result = await client.agg_query()
+            self.assertEqual(result[0]['count_message'], 5)
+
+            r = await client.clear()
+            self.assertEqual(r.status, 200)
+            self.assertEqual((await client.query())['logs'], [])
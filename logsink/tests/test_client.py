@@ -1,9 +1,16 @@
+import gzip
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import unittest.mock as mock
 
 
 import logsink
+import requests
 
 
 TEST_TOKEN = os.environ['TEST_TOKEN']
@@ -13,7 +20,7 @@ class TestClient(unittest.TestCase):
     def setUp(self):
         self.client = logsink.Client('test-client', token=TEST_TOKEN)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_log_request(self, requests_post):
         message = 'test message'
         self.client.log(
@@ -27,10 +34,9 @@ class TestClient(unittest.TestCase):
         kwargs = call[2]
         url = args[0]
         params = kwargs.get('json')
-        headers = kwargs.get('headers')
+        headers = self.client.session.headers
         self.assertTrue(url.endswith('/logs'))
         self.assertIsNotNone(params)
-        self.assertIsNotNone(headers)
         self.assertEqual(params.get('message'), message)
         self.assertEqual(
             params.get('tags'),
@@ -43,8 +49,23 @@ class TestClient(unittest.TestCase):
         self.assertEqual(headers.get('Content-Type'), 'application/json')
         self.assertEqual(headers.get('X-Auth-Token'), TEST_TOKEN)
 
-    @mock.patch('requests.get')
-    def test_log_request(self, requests_get):
+    @mock.patch('requests.Session.post')
+    def test_compression(self, requests_post):
+        client = logsink.Client('test-client', token=TEST_TOKEN, compress_threshold=100)
+
+        client.log('short')
+        kwargs = requests_post.call_args[1]
+        self.assertIsNone(kwargs['headers'])
+        self.assertEqual(json.loads(kwargs['data'].decode('utf-8'))['message'], 'short')
+
+        client.log('long' * 100)
+        kwargs = requests_post.call_args[1]
+        self.assertEqual(kwargs['headers'], {'Content-Encoding': 'gzip'})
+        data = json.loads(gzip.decompress(kwargs['data']).decode('utf-8'))
+        self.assertEqual(data['message'], 'long' * 100)
+
+    @mock.patch('requests.Session.get')
+    def test_query_request(self, requests_get):
         self.client.query(message='test message', tag1='value1')
         self.assertTrue(requests_get.called)
         call = requests_get.mock_calls[0]
@@ -55,3 +76,224 @@ class TestClient(unittest.TestCase):
         self.assertIsNotNone(params)
         self.assertEqual(params.get('message'), 'test message')
         self.assertEqual(params.get('tag1'), 'value1')
+
+    @mock.patch('requests.Session.get')
+    def test_query_pages(self, requests_get):
+        requests_get.return_value.json.side_effect = [
+            {'logs': [{'message': 'message 1'}, {'message': 'message 2'}], 'next_cursor': 'abc'},
+            {'logs': [{'message': 'message 3'}], 'next_cursor': None},
+        ]
+        pages = list(self.client.query_pages(tag1='value1', per_page=2, page=3))
+        self.assertEqual(
+            pages,
+            [
+                [{'message': 'message 1'}, {'message': 'message 2'}],
+                [{'message': 'message 3'}],
+            ]
+        )
+        self.assertEqual(requests_get.call_count, 2)
+        first_params = requests_get.mock_calls[0][2].get('params')
+        self.assertEqual(first_params.get('cursor'), '')
+        self.assertNotIn('page', first_params)
+        self.assertEqual(first_params.get('tag1'), 'value1')
+        second_params = requests_get.call_args_list[1][1].get('params')
+        self.assertEqual(second_params.get('cursor'), 'abc')
+
+    @mock.patch('requests.Session.get')
+    def test_iter_query(self, requests_get):
+        requests_get.return_value.iter_lines.return_value = iter([
+            b'{"message": "message 1"}',
+            b'',
+            b'{"message": "message 2"}',
+        ])
+        logs = self.client.iter_query(tag1='value1')
+        self.assertEqual(next(logs), {'message': 'message 1'})
+        self.assertEqual(list(logs), [{'message': 'message 2'}])
+
+        kwargs = requests_get.call_args[1]
+        self.assertTrue(kwargs.get('stream'))
+        self.assertEqual(kwargs['headers'].get('Accept'), 'application/x-ndjson')
+        self.assertEqual(kwargs['params'].get('tag1'), 'value1')
+        self.assertTrue(requests_get.return_value.close.called)
+
+    @mock.patch('requests.Session.get')
+    def test_export(self, requests_get):
+        data = gzip.compress(b'time,message\n2017-01-01T00:00:00Z,message 1\n')
+        requests_get.return_value.raw.stream.return_value = iter([data[:10], data[10:]])
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'logs.csv.gz')
+            size = self.client.export(path, format='csv', time__gte='2017-01-01')
+            self.assertEqual(size, len(data))
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual(f.readline(), 'time,message\n')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertTrue(requests_get.call_args[0][0].endswith('/logs/export'))
+        kwargs = requests_get.call_args[1]
+        self.assertEqual(kwargs['headers'].get('Accept'), 'text/csv')
+        self.assertEqual(kwargs['params'], {'time__gte': '2017-01-01'})
+        self.assertEqual(requests_get.return_value.raw.stream.call_args[1], {'decode_content': False})
+        self.assertTrue(requests_get.return_value.close.called)
+
+        with self.assertRaises(ValueError):
+            self.client.export(path, format='xml')
+
+    @mock.patch('requests.Session.get')
+    def test_tail(self, requests_get):
+        requests_get.return_value.iter_lines.return_value = iter([
+            b'',  # heartbeat
+            b'{"message": "message 1"}',
+            b'{"message": "message 2"}',
+        ])
+        logs = self.client.tail(tag1='value1')
+        self.assertEqual(next(logs), {'message': 'message 1'})
+        logs.close()
+
+        self.assertTrue(requests_get.call_args[0][0].endswith('/logs/tail'))
+        self.assertEqual(requests_get.call_args[1]['params'], {'tag1': 'value1'})
+        self.assertTrue(requests_get.return_value.close.called)
+
+
+class TestBufferedClient(unittest.TestCase):
+    def setUp(self):
+        self.client = logsink.Client(
+            'test-client',
+            token=TEST_TOKEN,
+            buffered=True,
+            batch_size=10,
+            flush_interval=60
+        )
+
+    def tearDown(self):
+        self.client.close()
+
+    @mock.patch('requests.Session.post')
+    def test_log_is_queued_until_flush(self, requests_post):
+        self.client.log('message 1', tag1='value1')
+        self.client.log('message 2')
+        self.assertFalse(requests_post.called)
+
+        self.assertTrue(self.client.flush(timeout=5))
+        # Both messages are sent in one batch request
+        self.assertEqual(requests_post.call_count, 1)
+        call = requests_post.mock_calls[0]
+        self.assertTrue(call[1][0].endswith('/logs/batch'))
+        params = call[2].get('json')
+        self.assertEqual(len(params), 2)
+        self.assertEqual(params[0].get('message'), 'message 1')
+        self.assertEqual(params[0]['tags'].get('tag1'), 'value1')
+        self.assertEqual(params[1].get('message'), 'message 2')
+        # Buffered messages are stamped when log() is called
+        self.assertIn('time', params[0]['tags'])
+
+    @mock.patch('requests.Session.post')
+    def test_line_protocol(self, requests_post):
+        client = logsink.Client('test-client', token=TEST_TOKEN, buffered=True, line_protocol=True)
+        client.log('message "1"', tag1='value 1', time='2017-01-01T01:00:00Z')
+        client.close()
+
+        kwargs = requests_post.call_args[1]
+        self.assertEqual(kwargs['headers'], {'Content-Type': 'application/x-influxdb-line-protocol'})
+        self.assertEqual(
+            kwargs['data'],
+            b'logs,client_name=test-client,tag1=value\\ 1 message="message \\"1\\"" 1483232400000000000\n'
+        )
+
+    @mock.patch('requests.Session.post')
+    def test_close_flushes(self, requests_post):
+        self.client.log('message')
+        self.client.close()
+        self.assertEqual(requests_post.call_count, 1)
+
+    def test_overflow_policies(self):
+        sent = []
+        release = threading.Event()
+
+        def send_batch(records):
+            release.wait(5)
+            sent.extend(records)
+
+        for overflow, expected in [
+                (logsink.DROP_NEWEST, [0, 1, 2]),
+                (logsink.DROP_OLDEST, [0, 3, 4])]:
+            sent.clear()
+            release.clear()
+            buffer = logsink.BatchBuffer(
+                send_batch,
+                batch_size=1,
+                max_size=2,
+                overflow=overflow
+            )
+            buffer.put(0)
+            # Wait for the flusher to pick up the first record
+            while len(buffer):
+                time.sleep(0.01)
+            for record in range(1, 5):
+                buffer.put(record)
+            self.assertEqual(buffer.dropped, 2)
+            release.set()
+            buffer.close(timeout=5)
+            self.assertEqual(sent, expected)
+
+
+class TestSpooledClient(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    @mock.patch('requests.Session.post')
+    def test_spool_and_replay(self, requests_post):
+        client = logsink.Client('test-client', token=TEST_TOKEN, spool=self.path)
+
+        requests_post.side_effect = requests.ConnectionError('server down')
+        self.assertIsNone(client.log('message 1'))
+        self.assertEqual(len(client.spool), 1)
+
+        requests_post.side_effect = None
+        requests_post.return_value.status_code = 201
+        requests_post.return_value.json.return_value = {'inserted': 1, 'errors': []}
+        client.log('message 2')
+        # Also woken up in the background by the successful send
+        client.replayer.replay()
+        self.assertEqual(client.replayer.sent, 1)
+        self.assertEqual(len(client.spool), 0)
+
+        # The spooled message is sent in a batch, stamped with its time
+        url, = requests_post.call_args[0]
+        self.assertTrue(url.endswith('/logs/batch'))
+        records = requests_post.call_args[1]['json']
+        self.assertEqual([record['message'] for record in records], ['message 1'])
+        self.assertIn('time', records[0]['tags'])
+        client.close()
+
+    @mock.patch('requests.Session.post')
+    def test_buffer_spill(self, requests_post):
+        release = threading.Event()
+        requests_post.side_effect = lambda *args, **kwargs: release.wait(5) and mock.DEFAULT
+        client = logsink.Client(
+            'test-client',
+            token=TEST_TOKEN,
+            buffered=True,
+            batch_size=1,
+            max_queue_size=1,
+            spool=self.path
+        )
+        client.log('message 1')
+        # Wait for the flusher to be stuck sending the first message
+        while len(client.buffer):
+            time.sleep(0.01)
+
+        # The buffer is full, the messages lagging behind go to the spool
+        for i in range(2, 5):
+            self.assertTrue(client.log('message %d' % i))
+        self.assertEqual(len(client.buffer), 1)
+        self.assertEqual(len(client.spool), 2)
+        self.assertEqual(client.buffer.dropped, 0)
+
+        release.set()
+        client.close()
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from logsink import spool
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def open(self, **kwargs):
+        return spool.Spool(self.path, **kwargs)
+
+    def records(self, start, stop):
+        return [{'message': 'message %d' % i, 'tags': {}} for i in range(start, stop)]
+
+    def test_append_replay(self):
+        s = self.open(segment_bytes=100)
+        s.append(self.records(0, 5))
+        s.append(self.records(5, 10))
+        self.assertEqual(len(s), 10)
+        self.assertGreater(len(os.listdir(self.path)), 1)
+
+        sent = []
+        replayer = spool.Replayer(s, sent.extend, batch_size=4, interval=60)
+        self.assertEqual(replayer.replay(), 10)
+        replayer.close()
+        self.assertEqual(sent, self.records(0, 10))
+        self.assertEqual(len(s), 0)
+        # Replayed segments are removed, except the one being appended to
+        self.assertEqual(len([name for name in os.listdir(self.path) if name.endswith('.spool')]), 1)
+
+        s.append(self.records(10, 11))
+        self.assertEqual(s.read(10)[0], self.records(10, 11))
+        s.close()
+
+    def test_failed_replay(self):
+        s = self.open()
+        s.append(self.records(0, 3))
+
+        def fail(records):
+            raise IOError('server down')
+
+        replayer = spool.Replayer(s, fail, interval=60)
+        with self.assertRaises(IOError):
+            replayer.replay()
+        replayer.close()
+        self.assertEqual(len(s), 3)
+        s.close()
+
+    def test_reopen(self):
+        s = self.open()
+        s.append(self.records(0, 5))
+        records, position = s.read(2)
+        s.commit(position)
+        s.close()
+
+        # Simulate a crash in the middle of an append
+        segment = os.path.join(self.path, '00000000.spool')
+        with open(segment, 'ab') as f:
+            f.write(b'{"message": "mess')
+
+        s = self.open()
+        self.assertEqual(len(s), 3)
+        self.assertEqual(s.read(10)[0], self.records(2, 5))
+        s.close()
+
+    def test_eviction(self):
+        s = self.open(max_bytes=200, segment_bytes=100)
+        for i in range(10):
+            s.append(self.records(i, i + 1))
+
+        self.assertLessEqual(s.size, 200 + 100)
+        self.assertGreater(s.dropped, 0)
+        self.assertEqual(len(s) + s.dropped, 10)
+        # The oldest records were dropped
+        sent = []
+        replayer = spool.Replayer(s, sent.extend, interval=60)
+        replayer.replay()
+        replayer.close()
+        self.assertEqual(sent, self.records(s.dropped, 10))
+        s.close()
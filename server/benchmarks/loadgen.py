@@ -0,0 +1,135 @@
+"""Load generator for a running logsink server.
+
+Each worker thread sends requests in a loop over its own keep-alive
+connection: log batches (POST /logs, or POST /logs/batch when --batch-size is
+above 1) and, with --read-ratio, queries (GET /logs):
+
+    python benchmarks/loadgen.py --concurrency 50 --duration 30 \\
+        --batch-size 100 --tag-cardinality 10000 --output load.json
+"""
+import argparse
+import collections
+import itertools
+import os
+import random
+import threading
+import time
+
+import requests
+
+import results
+
+
+class Worker(threading.Thread):
+    def __init__(self, args, deadline, counter):
+        super().__init__(daemon=True)
+        self.args = args
+        self.deadline = deadline
+        self.counter = counter
+        self.random = random.Random()
+
+        self.session = requests.Session()
+        self.session.headers['X-Auth-Token'] = args.token
+
+        self.latencies = collections.defaultdict(list)
+        self.statuses = collections.Counter()
+        self.records = 0
+        self.errors = 0
+
+    def run(self):
+        while time.monotonic() < self.deadline:
+            if self.args.requests and next(self.counter) >= self.args.requests:
+                return
+            if self.random.random() < self.args.read_ratio:
+                self.request('query', self.query)
+            else:
+                self.request('ingest', self.ingest)
+
+    def request(self, name, method):
+        start = time.perf_counter()
+        try:
+            r = method()
+        except requests.RequestException:
+            self.errors += 1
+            return
+        self.latencies[name].append(time.perf_counter() - start)
+        self.statuses[r.status_code] += 1
+
+    def log(self):
+        tags = {'client_name': 'loadgen'}
+        for i in range(self.args.tags):
+            tags['tag%d' % i] = 'value%d' % self.random.randrange(self.args.tag_cardinality)
+        return {'message': 'loadgen message %d' % self.random.getrandbits(32), 'tags': tags}
+
+    def ingest(self):
+        if self.args.batch_size == 1:
+            r = self.session.post(self.args.url + '/logs', json=self.log())
+        else:
+            r = self.session.post(
+                self.args.url + '/logs/batch',
+                json=[self.log() for _ in range(self.args.batch_size)]
+            )
+        if r.status_code < 300:
+            self.records += self.args.batch_size
+        return r
+
+    def query(self):
+        params = {'per_page': self.args.per_page}
+        if self.args.tags:
+            params['tag0'] = 'value%d' % self.random.randrange(self.args.tag_cardinality)
+        return self.session.get(self.args.url + '/logs', params=params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:6789')
+    parser.add_argument('--token', default=os.environ.get('TEST_TOKEN', 'test-token'))
+    parser.add_argument('--concurrency', type=int, default=10, help='worker threads')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many requests (0: no limit)')
+    parser.add_argument('--batch-size', type=int, default=1, help='log messages per ingest request')
+    parser.add_argument('--tags', type=int, default=1, help='tags per log message, besides client_name')
+    parser.add_argument('--tag-cardinality', type=int, default=100, help='distinct values of each tag')
+    parser.add_argument('--read-ratio', type=float, default=0, help='fraction of requests which are queries')
+    parser.add_argument('--per-page', type=int, default=25, help='page size of the queries')
+    parser.add_argument('--output', default='-', help='result file, - for stdout')
+    args = parser.parse_args()
+
+    counter = itertools.count()
+    start = time.perf_counter()
+    workers = [
+        Worker(args, time.monotonic() + args.duration, counter)
+        for _ in range(args.concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    result = {}
+    for name in ['ingest', 'query']:
+        latencies = list(itertools.chain.from_iterable(w.latencies[name] for w in workers))
+        if latencies:
+            result[name] = dict(
+                results.summarize(latencies),
+                requests_per_s=round(len(latencies)/elapsed, 1)
+            )
+    statuses = sum((w.statuses for w in workers), collections.Counter())
+    records = sum(w.records for w in workers)
+    result['total'] = {
+        'elapsed_s': round(elapsed, 3),
+        'records': records,
+        'records_per_s': round(records/elapsed, 1),
+        'connection_errors': sum(w.errors for w in workers),
+        'error_responses': sum(count for status, count in statuses.items() if status >= 400),
+    }
+    result['status_codes'] = {str(status): count for status, count in statuses.items()}
+
+    params = vars(args)
+    del params['token']
+    results.write(args.output, 'loadgen', params, result)
+
+
+if __name__ == '__main__':
+    main()
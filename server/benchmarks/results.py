@@ -0,0 +1,99 @@
+"""Machine-readable benchmark results, shared by suite.py and loadgen.py.
+
+A result file is a JSON object:
+
+    {
+        "benchmark": "suite",
+        "version": "<git describe>",
+        "timestamp": "...", "python": "...", "platform": "...",
+        "params": {...},
+        "results": {"<name>": {"<metric>": <number>, ...}, ...}
+    }
+
+Two files of the same benchmark can be compared with
+
+    python benchmarks/results.py old.json new.json
+"""
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+
+def summarize(latencies):
+    """Latency statistics, in milliseconds, of a list of durations in seconds."""
+
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'count': 0}
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies)*p))]*1000, 3)
+
+    return {
+        'count': len(latencies),
+        'mean_ms': round(sum(latencies)/len(latencies)*1000, 3),
+        'p50_ms': percentile(0.5),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': round(latencies[-1]*1000, 3),
+    }
+
+
+def version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def write(path, benchmark, params, results):
+    data = {
+        'benchmark': benchmark,
+        'version': version(),
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'results': results,
+    }
+
+    if path == '-':
+        json.dump(data, sys.stdout, indent=2)
+        print()
+        return
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+
+
+def compare(old, new):
+    """Print the relative change of each metric between two result files."""
+
+    for name, metrics in sorted(new['results'].items()):
+        old_metrics = old['results'].get(name, {})
+        for metric, value in sorted(metrics.items()):
+            old_value = old_metrics.get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old_value, (int, float)):
+                continue
+            change = (value - old_value)/old_value*100 if old_value else 0
+            print('%-40s %-14s %12.3f -> %12.3f  %+7.1f%%' % (
+                name, metric, old_value, value, change
+            ))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: %s OLD.json NEW.json' % sys.argv[0])
+    with open(sys.argv[1]) as f:
+        old = json.load(f)
+    with open(sys.argv[2]) as f:
+        new = json.load(f)
+    print('%s (%s) -> %s (%s)' % (sys.argv[1], old['version'], sys.argv[2], new['version']))
+    compare(old, new)
@@ -0,0 +1,213 @@
+"""Offline benchmark suite of the ingest and query hot paths.
+
+The API server runs in this process on the embedded storage backend, in a
+temporary directory, so no InfluxDB (or network) is needed:
+
+    python benchmarks/suite.py --output results.json
+    python benchmarks/results.py old.json results.json
+
+Benchmarks:
+
+    * ingest: records/s through logsink.Client.log, one request per log vs.
+      buffered batches
+    * query_page: GET /logs latency by page depth
+    * aggregated: storage aggregated() latency by window size
+    * memory: peak Python memory allocated while handling one request
+"""
+import argparse
+import datetime
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import requests
+
+import results
+
+
+os.environ.setdefault('ROOT_TOKEN', 'logsink-token')
+os.environ.setdefault('TEST_TOKEN', 'test-token')
+
+
+def start_server(app):
+    """Serve app in a background thread, returns the port."""
+
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('localhost', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server.server_port
+
+
+def populate(db, records, days, tag_cardinality):
+    """Insert records spread evenly over the last days, returns the time range."""
+
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    start = now - datetime.timedelta(days=days)
+    step = (now - start)/records
+    batch = []
+    for i in range(records):
+        batch.append(('bench message %d' % i, {
+            'client_name': 'bench',
+            'host': 'host-%d' % (i % tag_cardinality),
+            'time': (start + step*i).isoformat() + 'Z',
+        }))
+        if len(batch) == 5000:
+            db.insert_many(batch)
+            batch = []
+    if batch:
+        db.insert_many(batch)
+
+    return start, now
+
+
+def bench_ingest(port, token, records):
+    import logsink
+
+    result = {}
+
+    single = max(1, records//10)
+    with logsink.Client('bench', port=port, token=token) as client:
+        start = time.perf_counter()
+        for i in range(single):
+            client.log('ingest message %d' % i, host='host-%d' % (i % 10))
+        result['ingest_single'] = {
+            'records': single,
+            'records_per_s': round(single/(time.perf_counter() - start), 1),
+        }
+
+    with logsink.Client('bench', port=port, token=token, buffered=True) as client:
+        start = time.perf_counter()
+        for i in range(records):
+            client.log('ingest message %d' % i, host='host-%d' % (i % 10))
+        client.flush()
+        result['ingest_batched'] = {
+            'records': records,
+            'records_per_s': round(records/(time.perf_counter() - start), 1),
+        }
+
+    return result
+
+
+def bench_query_pages(port, token, gte, lte, depths, repeat):
+    session = requests.Session()
+    session.headers['X-Auth-Token'] = token
+
+    result = {}
+    for page in depths:
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            r = session.get('http://localhost:%d/logs' % port, params={
+                'page': page,
+                'per_page': 25,
+                'time__gte': gte.isoformat(),
+                'time__lte': lte.isoformat(),
+            })
+            r.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        result['query_page_%d' % page] = results.summarize(latencies)
+
+    return result
+
+
+def bench_aggregated(db, lte, windows, repeat):
+    result = {}
+    for hours in windows:
+        gte = lte - datetime.timedelta(hours=hours)
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(db.aggregated(time__gte=gte.isoformat(), time__lte=lte.isoformat()))
+            latencies.append(time.perf_counter() - start)
+        result['aggregated_%dh' % hours] = results.summarize(latencies)
+
+    return result
+
+
+def bench_memory(app, token, gte, lte):
+    client = app.test_client()
+    headers = {'X-Auth-Token': token}
+    window = {'time__gte': gte.isoformat(), 'time__lte': lte.isoformat()}
+    batch = [
+        {'message': 'memory message %d' % i, 'tags': {'host': 'host-%d' % (i % 10)}}
+        for i in range(1000)
+    ]
+
+    requests_ = {
+        'memory_post_batch_1000': lambda: client.post('/logs/batch', json=batch, headers=headers),
+        'memory_get_logs_1000': lambda: client.get(
+            '/logs', query_string=dict(window, per_page=1000), headers=headers
+        ),
+        'memory_get_logs_ndjson': lambda: client.get(
+            '/logs', query_string=window,
+            headers=dict(headers, Accept='application/x-ndjson')
+        ),
+        'memory_aggregated': lambda: client.get('/logs/aggregated', query_string=window, headers=headers),
+    }
+
+    result = {}
+    for name, request in requests_.items():
+        request()  # warm up
+        tracemalloc.start()
+        r = request()
+        r.get_data()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result[name] = {
+            'peak_kib': round(peak/1024, 1),
+            'response_kib': round(len(r.get_data())/1024, 1),
+        }
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=100000, help='records stored before the query benchmarks')
+    parser.add_argument('--days', type=int, default=30, help='time span of the stored records')
+    parser.add_argument('--tag-cardinality', type=int, default=100, help='distinct values of the host tag')
+    parser.add_argument('--ingest-records', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=20, help='requests per latency measurement')
+    parser.add_argument('--output', default='-', help='result file, - for stdout')
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='logsink-bench-')
+    os.environ['LOGSINK_STORAGE'] = 'embedded'
+    os.environ['LOGSINK_DATA_DIR'] = data_dir
+    try:
+        from logsink_server import api
+        from logsink_server import auth
+        from logsink_server import storage
+
+        token = auth.TEST_TOKEN
+        db = storage.get_storage(auth.TOKEN_DBS[token])
+        port = start_server(api.app)
+
+        print('Storing %d records...' % args.records, file=sys.stderr)
+        gte, lte = populate(db, args.records, args.days, args.tag_cardinality)
+
+        result = {}
+        print('Query pages...', file=sys.stderr)
+        result.update(bench_query_pages(port, token, gte, lte, [1, 10, 100, 1000], args.repeat))
+        print('Aggregated...', file=sys.stderr)
+        result.update(bench_aggregated(db, lte, [1, 24, 24*7, 24*args.days], args.repeat))
+        print('Memory...', file=sys.stderr)
+        result.update(bench_memory(api.app, token, gte, lte))
+        print('Ingest...', file=sys.stderr)
+        result.update(bench_ingest(port, token, args.ingest_records))
+    finally:
+        shutil.rmtree(data_dir)
+
+    results.write(args.output, 'suite', vars(args), result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+# Non-blocking storage interface, used by the ASGI server (see asgi.py).
+#
+# AsyncInfluxDBStorage talks to InfluxDB over aiohttp for inserts and
+# queries, the hot paths. Everything else, and other backends, run the
+# blocking storage (see storage.get_storage) in a thread pool so that the
+# caches, rollups and listeners keep working the same way.
+import abc
+import asyncio
+import concurrent.futures
+import functools
+import os
+
+import aiohttp
+import influxdb
+from influxdb.line_protocol import make_lines
+from influxdb.resultset import ResultSet
+
+from logsink_server import lineprotocol
+from logsink_server import metrics
+from logsink_server import query
+from logsink_server import storage
+
+
+# Threads running the blocking storage calls
+EXECUTOR_THREADS = int(os.environ.get('LOGSINK_STORAGE_THREADS', 32))
+
+
+class AsyncABCStorage(metaclass=abc.ABCMeta):
+    """Async version of storage.ABCStorage.
+
+    Same methods and arguments, query returns a list of rows."""
+
+    @abc.abstractmethod
+    async def insert(self, message, **kwargs):
+        raise NotImplemented()
+
+    @abc.abstractmethod
+    async def insert_many(self, records):
+        raise NotImplemented()
+
+    @abc.abstractmethod
+    async def insert_lines(self, data):
+        raise NotImplemented()
+
+    @abc.abstractmethod
+    async def query(self, **kwargs):
+        raise NotImplemented()
+
+    @abc.abstractmethod
+    async def aggregated(self, **kwargs):
+        raise NotImplemented()
+
+    @abc.abstractmethod
+    async def clear(self, **kwargs):
+        raise NotImplemented()
+
+    async def close(self):
+        pass
+
+
+class ExecutorStorage(AsyncABCStorage):
+    """Runs the methods of a blocking storage in a thread pool."""
+
+    def __init__(self, db, executor=None):
+        self.db = db
+        self.dbname = db.dbname
+        self.executor = executor or _executor
+
+    async def _run(self, method, *args, **kwargs):
+        # The rows are read in the thread too, some storages return generators
+        def call():
+            return list(method(*args, **kwargs))
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def insert(self, message, **kwargs):
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            functools.partial(self.db.insert, message, **kwargs)
+        )
+
+    async def insert_many(self, records):
+        return await self._run(self.db.insert_many, list(records))
+
+    async def insert_lines(self, data):
+        return await self._run(self.db.insert_lines, data)
+
+    async def query(self, **kwargs):
+        # The query cache is used as in the WSGI server
+        from logsink_server import cache
+
+        if cache.queries is None:
+            return await self._read_query(**kwargs)
+
+        rows, entry = cache.queries.lookup(self.dbname, **kwargs)
+        if rows is not None:
+            return rows
+        try:
+            rows = await self._read_query(**kwargs)
+        except BaseException:
+            cache.queries.cancel(entry)
+            raise
+        cache.queries.store(entry, rows)
+
+        return rows
+
+    async def _read_query(self, **kwargs):
+        return await self._run(self.db.query, **kwargs)
+
+    async def aggregated(self, **kwargs):
+        # The aggregation cache is used as in the WSGI server
+        from logsink_server import cache
+
+        if cache.aggregations is not None:
+            return await self._run(cache.aggregations.aggregated, self.db, **kwargs)
+        return await self._run(self.db.aggregated, **kwargs)
+
+    async def clear(self, **kwargs):
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            functools.partial(self.db.clear, **kwargs)
+        )
+
+
+class AsyncInfluxDBStorage(ExecutorStorage):
+    """Inserts and queries over non-blocking HTTP requests to InfluxDB.
+
+    Connects to the InfluxDB of db, the blocking storage (see its settings)."""
+
+    def __init__(self, db, executor=None):
+        super().__init__(db, executor=executor)
+        self.url = 'http://%s:%s' % (db.settings['host'], db.settings['port'])
+        self.auth = aiohttp.BasicAuth(db.settings['user'], db.settings['password'])
+        self.pool_size = db.settings['pool_size']
+        self._session = None
+
+    @property
+    def session(self):
+        # Created on first use, it must be created in the running event loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                auth=self.auth
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def write_points(self, points):
+        if storage.write_behind is not None:
+            storage.write_behind.put(self.dbname, points)
+        else:
+            await self._write(points)
+
+    async def _write(self, points):
+        with metrics.stage('influxdb_write'):
+            async with self.session.post(
+                    '%s/write' % self.url,
+                    params={'db': self.dbname},
+                    data=make_lines({'points': points}).encode('utf-8')) as r:
+                if r.status != 204:
+                    raise influxdb.exceptions.InfluxDBClientError(await r.text(), r.status)
+
+        if storage._insert_listeners:
+            storage._notify_insert(
+                self.dbname,
+                [storage._point_record(point) for point in points]
+            )
+
+    async def insert(self, message, **kwargs):
+        await self.write_points([storage._point(message, kwargs)])
+
+    async def insert_many(self, records):
+        # Same as InfluxDBStorage.insert_many
+        errors = []
+        points = []
+        indices = []
+        for index, (message, tags) in enumerate(records):
+            try:
+                points.append(storage._point(message, tags))
+            except ValueError as e:
+                errors.append((index, str(e)))
+                continue
+            indices.append(index)
+
+        if storage.write_behind is not None:
+            if points:
+                storage.write_behind.put(self.dbname, points)
+            return errors
+
+        for start in range(0, len(points), storage.INSERT_CHUNK_SIZE):
+            chunk = points[start:start + storage.INSERT_CHUNK_SIZE]
+            try:
+                await self._write(chunk)
+            except influxdb.exceptions.InfluxDBClientError:
+                # Find out which points were rejected
+                for index, point in zip(indices[start:], chunk):
+                    try:
+                        await self._write([point])
+                    except influxdb.exceptions.InfluxDBClientError as e:
+                        errors.append((index, str(e)))
+
+        return sorted(errors)
+
+    async def insert_lines(self, data):
+        # Same as InfluxDBStorage.insert_lines
+        with metrics.stage('influxdb_write'):
+            async with self.session.post(
+                    '%s/write' % self.url,
+                    params={'db': self.dbname},
+                    data=data) as r:
+                failed = r.status != 204
+        if failed:
+            return await self.insert_many(lineprotocol.decode_lines(data))
+
+        if storage._insert_listeners:
+            storage._notify_insert(self.dbname, storage._line_records(data))
+
+        return []
+
+    async def _read_query(self, **kwargs):
+        with metrics.stage('query_build'):
+            statement = query.select_logs(query.compile(**kwargs))
+
+        return await self._query(statement)
+
+    async def _query(self, query):
+        with metrics.timed_query('influxdb_query', query):
+            async with self.session.get(
+                    '%s/query' % self.url,
+                    params={'db': self.dbname, 'q': query}) as r:
+                result = await r.json(content_type=None)
+                if r.status >= 400:
+                    raise influxdb.exceptions.InfluxDBClientError(
+                        result.get('error', r.reason), r.status
+                    )
+
+        return list(ResultSet(result['results'][0]).get_points())
+
+
+_executor = concurrent.futures.ThreadPoolExecutor(
+    EXECUTOR_THREADS,
+    thread_name_prefix='logsink-storage'
+)
+
+_storages = {}
+
+
+async def get_storage(dbname):
+    """Return the shared async storage for database dbname."""
+
+    db = _storages.get(dbname)
+    if db is None:
+        # Creating the blocking storage may create the database
+        sync_db = await asyncio.get_running_loop().run_in_executor(
+            _executor, storage.get_storage, dbname
+        )
+        db = _storages.get(dbname)
+        if db is None:
+            if isinstance(sync_db, storage.InfluxDBStorage):
+                db = AsyncInfluxDBStorage(sync_db)
+            else:
+                db = ExecutorStorage(sync_db)
+            _storages[dbname] = db
+
+    return db
+
+
+async def close_storages():
+    for db in list(_storages.values()):
+        await db.close()
+    _storages.clear()
+
+
+async def iter_query(db, **kwargs):
+    """Async version of storage.iter_query."""
+
+    kwargs = dict(kwargs)
+    kwargs.pop('page', None)
+    kwargs.setdefault('per_page', storage.STREAM_PAGE_SIZE)
+    kwargs.setdefault('cursor', '')
+
+    # Don't let the default time range move while reading the pages
+    compiled = query.compile(**kwargs)
+    kwargs.setdefault('time__gte', compiled.time__gte.isoformat())
+    kwargs.setdefault('time__lte', compiled.time__lte.isoformat())
+
+    while True:
+        rows = await db.query(**kwargs)
+        for row in rows:
+            yield row
+
+        cursor = storage.next_cursor(rows, **kwargs)
+        if cursor is None:
+            return
+        kwargs['cursor'] = cursor
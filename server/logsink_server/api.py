@@ -1,18 +1,30 @@
 import flask
 from flask_cors import CORS  # This is to allow swagger-ui access
-from flask_restful import Resource, reqparse  # Api is from swagger
+from flask_restful import Resource  # Api is from swagger
 from flask_restful_swagger_2 import Api, swagger, Schema
 from functools import wraps
+import itertools
+import json
 import os
 
 from logsink_server import auth
+from logsink_server import cache
+from logsink_server import export
+from logsink_server import limits
+from logsink_server import lineprotocol
+from logsink_server import metrics
+from logsink_server import middleware
+from logsink_server import retention
 from logsink_server import storage
+from logsink_server import tail
 
 
 def token_required(method):
     @wraps(method)
     def wrapper(*args, **kwargs):
-        if not auth.is_authenticated(flask.request):
+        with metrics.stage('auth'):
+            authenticated = auth.is_authenticated(flask.request)
+        if not authenticated:
             return {'error': 'Token incorrect'}, 403
 
         return method(*args, **kwargs)
@@ -20,6 +32,7 @@ def token_required(method):
 
 
 app = flask.Flask(__name__)
+app.wsgi_app = middleware.GzipRequestMiddleware(app.wsgi_app)
 CORS(app)
 api = Api(
     app,
@@ -35,9 +48,9 @@ api = Api(
 )
 
 
-log_parser = reqparse.RequestParser()
-log_parser.add_argument('message', required=True)
-log_parser.add_argument('tags', type=dict, required=True)
+MAX_BATCH_SIZE = 10000  # max number of records accepted by one batch request
+NDJSON_MIMETYPE = 'application/x-ndjson'
+SSE_MIMETYPE = 'text/event-stream'
 
 
 class LogMessageModel(Schema):
@@ -55,6 +68,216 @@ class LogMessageModel(Schema):
     required = ['message', 'tags']
 
 
+class LogMessageBatchModel(Schema):
+    type = 'array'
+    items = LogMessageModel
+
+
+class LogBatchResultModel(Schema):
+    type = 'object'
+    properties = {
+        'inserted': {
+            'type': 'integer',
+            'description': 'Number of stored log messages.',
+        },
+        'errors': {
+            'type': 'array',
+            'description': 'Log messages which were not stored.',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'index': {
+                        'type': 'integer',
+                        'description': 'Position of the log message in the batch.',
+                    },
+                    'error': {
+                        'type': 'string',
+                    },
+                },
+            },
+        },
+    }
+
+
+# The request parsing, validation and error responses below are shared with
+# the ASGI server (asgi.py), its requests have the same args, mimetype and
+# accept_mimetypes attributes.
+
+def wants_ndjson(request):
+    return request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE]
+    ) == NDJSON_MIMETYPE
+
+
+def _ndjson_response(rows):
+    """Stream rows as they are read from the storage, one JSON per line.
+
+    The first row is read right away so that invalid queries raise here
+    and not in the middle of the response."""
+
+    rows = iter(rows)
+    first = list(itertools.islice(rows, 1))
+
+    def generate():
+        for row in itertools.chain(first, rows):
+            yield json.dumps(row) + '\n'
+
+    return flask.Response(generate(), mimetype=NDJSON_MIMETYPE)
+
+
+def buffer_full_response(error, records=1):
+    # The write-behind buffer is full, the client should retry shortly
+    metrics.records_dropped.inc(records, reason='buffer_full')
+    retry_after = max(1, int(storage.WRITE_BEHIND_FLUSH_INTERVAL + 0.5))
+    return {'error': str(error)}, 503, {'Retry-After': str(retry_after)}
+
+
+def rate_limited_response(error, records=0):
+    # Over a limit of the token, see limits.py
+    if records:
+        metrics.records_dropped.inc(records, reason='rate_limited')
+    return {'error': str(error)}, 429, {'Retry-After': error.retry_after_header()}
+
+
+# Errors of query parameters and query limits
+QUERY_ERRORS = (ValueError, limits.RateLimited)
+
+
+def query_error_response(error):
+    """Response to one of QUERY_ERRORS."""
+
+    if isinstance(error, limits.RateLimited):
+        return rate_limited_response(error)
+    return {'error': str(error)}, 400
+
+
+def logs_result(rows, args):
+    """Body of GET /logs: the rows, with the next cursor with keyset pagination."""
+
+    if 'cursor' not in args:
+        return rows
+
+    return {
+        'logs': rows,
+        'next_cursor': storage.next_cursor(rows, **args),
+    }
+
+
+def decode_log(data, values):
+    """Decode the body of POST /logs, a JSON log message.
+
+    The message may be passed in values (the query string) instead. Returns
+    the log and a dict of errors per parameter, empty when it's valid."""
+
+    try:
+        log = json.loads(data.decode('utf-8'))
+    except ValueError:
+        log = None
+    if not isinstance(log, dict):
+        log = {}
+    message = log.get('message', values.get('message'))
+    tags = log.get('tags')
+
+    errors = {}
+    missing = 'Missing required parameter in the JSON body or the post body or the query string'
+    if message is None:
+        errors['message'] = missing
+    elif not isinstance(tags, dict):
+        errors['tags'] = missing
+    if errors:
+        metrics.records_rejected.inc()
+        return None, errors
+
+    return {'message': str(message), 'tags': tags}, errors
+
+
+def _limited_rows(dbname, rows):
+    # Streamed rows are read while the response is sent, holding a query slot
+    with limits.query_slot(dbname):
+        yield from rows
+
+
+def _batch_records(request):
+    return decode_batch(request.mimetype, request.get_data())
+
+
+def decode_batch(mimetype, data):
+    """Decode the body of a batch request.
+
+    Returns a list of (message, tags) pairs and a list of (index, error)
+    pairs for records which couldn't be decoded. Invalid records are kept in
+    the first list as None so that indices match the request body.
+
+    With line protocol the records are the lines, see lineprotocol.py."""
+
+    if mimetype == lineprotocol.MIMETYPE:
+        records, errors = lineprotocol.split_lines(data)
+        if len(records) > MAX_BATCH_SIZE:
+            raise ValueError('At most %d log messages are allowed in one batch.' % MAX_BATCH_SIZE)
+        return records, errors
+
+    if mimetype == NDJSON_MIMETYPE:
+        items = []
+        lines = data.decode('utf-8', 'replace').splitlines()
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(e)
+    else:
+        try:
+            items = json.loads(data.decode('utf-8'))
+        except ValueError:
+            items = None
+        if not isinstance(items, list):
+            raise ValueError('Expected a JSON array of log messages.')
+
+    if len(items) > MAX_BATCH_SIZE:
+        raise ValueError('At most %d log messages are allowed in one batch.' % MAX_BATCH_SIZE)
+
+    records = []
+    errors = []
+    for index, item in enumerate(items):
+        if isinstance(item, Exception):
+            error = 'Invalid JSON: %s' % item
+        elif not isinstance(item, dict) or item.get('message') is None:
+            error = 'Missing required parameter: message'
+        elif not isinstance(item.get('tags'), dict):
+            error = 'Missing required parameter: tags'
+        else:
+            records.append((str(item['message']), item['tags']))
+            continue
+
+        records.append(None)
+        errors.append((index, error))
+
+    return records, errors
+
+
+def batch_result(records, errors, storage_errors):
+    """Response of a batch request, as (body, status).
+
+    records and errors are returned by decode_batch, storage_errors by
+    insert_many of the records which were decoded."""
+
+    # insert_many reports positions among the decoded records only
+    valid = [index for index, record in enumerate(records) if record is not None]
+    errors = sorted(errors + [(valid[i], error) for i, error in storage_errors])
+
+    result = {
+        'inserted': len(valid) - len(storage_errors),
+        'errors': [
+            {'index': index, 'error': error} for index, error in errors
+        ],
+    }
+    metrics.records_ingested.inc(result['inserted'])
+    metrics.records_rejected.inc(len(errors))
+
+    return result, 207 if errors else 201
+
+
 class Logs(Resource):
     @swagger.doc({
         'tags': ['logs'],
@@ -90,13 +313,25 @@ class Logs(Resource):
                 'in': 'path',
                 'type': 'integer',
             },
+            {
+                'name': 'cursor',
+                'description': 'Keyset pagination, used instead of page when present. '
+                               'Pass an empty value for the first page, then the next_cursor '
+                               'of the previous page. The response is then an object with the '
+                               'logs and the next_cursor (null on the last page).',
+                'in': 'path',
+                'type': 'string',
+            },
         ],
+        'produces': ['application/json', NDJSON_MIMETYPE],
         'security': {
             'auth-token': [],
         },
         'responses': {
             '200': {
-                'description': 'Query',
+                'description': 'Query. With the %s Accept header, ALL the logs matching '
+                               'the query are streamed, one JSON per line, and the '
+                               'pagination parameters are ignored.' % NDJSON_MIMETYPE,
             },
         },
     })
@@ -105,11 +340,24 @@ class Logs(Resource):
         # Force convert to dict
         args = {arg: value for arg, value in flask.request.args.items()}
 
-        db = storage.InfluxDBStorage(dbname=auth.token_dbname(flask.request))
+        dbname = auth.token_dbname(flask.request)
+        db = storage.get_storage(dbname)
+
+        try:
+            if wants_ndjson(flask.request):
+                return _ndjson_response(_limited_rows(dbname, storage.iter_query(db, **args)))
+
+            with limits.query_slot(dbname), metrics.stage('storage'):
+                if cache.queries is not None:
+                    rows = cache.queries.query(db, **args)
+                else:
+                    rows = [
+                        row for row in db.query(**args)
+                    ]
+        except QUERY_ERRORS as e:
+            return query_error_response(e)
 
-        return [
-            row for row in db.query(**args)
-        ]
+        return logs_result(rows, args)
 
     @swagger.doc({
         'tags': ['logs'],
@@ -144,12 +392,26 @@ class Logs(Resource):
     })
     @token_required
     def post(self):
-        log = log_parser.parse_args()
+        with metrics.stage('parse'):
+            log, errors = decode_log(flask.request.get_data(), flask.request.values)
+        if errors:
+            return {'message': errors}, 400
         app.logger.debug('Log: %r', log)
 
-        db = storage.InfluxDBStorage(dbname=auth.token_dbname(flask.request))
+        dbname = auth.token_dbname(flask.request)
+        try:
+            limits.admit(dbname, 1, len(flask.request.get_data()))
+        except limits.RateLimited as e:
+            return rate_limited_response(e, 1)
 
-        db.insert(log['message'], **log['tags'])
+        db = storage.get_storage(dbname)
+
+        try:
+            with metrics.stage('storage'):
+                db.insert(log['message'], **log['tags'])
+        except storage.BufferFull as e:
+            return buffer_full_response(e)
+        metrics.records_ingested.inc()
 
         return log, 201
 
@@ -171,13 +433,88 @@ class Logs(Resource):
         # Force convert to dict
         args = {arg: value for arg, value in flask.request.args.items()}
 
-        db = storage.InfluxDBStorage(dbname=auth.token_dbname(flask.request))
+        db = storage.get_storage(auth.token_dbname(flask.request))
 
-        db.clear(**args)
+        try:
+            db.clear(**args)
+        except ValueError as e:
+            return {'error': str(e)}, 400
 
         return 200
 
 
+class LogsBatch(Resource):
+    @swagger.doc({
+        'tags': ['logs'],
+        'description': 'Store many log messages at once. The body is either a JSON array '
+                       'of log messages or, with the %s content type, one JSON log message '
+                       'per line, or, with the %s content type, one InfluxDB line protocol '
+                       'point of the logs measurement per line. Invalid messages are '
+                       'reported and the rest is stored.' % (NDJSON_MIMETYPE, lineprotocol.MIMETYPE),
+        'parameters': [
+            {
+                'name': 'body',
+                'description': 'The log messages you want to store',
+                'in': 'body',
+                'schema': LogMessageBatchModel,
+                'required': True,
+            },
+        ],
+        'security': {
+            'auth-token': [],
+        },
+        'responses': {
+            '201': {
+                'description': 'All log messages were stored',
+                'schema': LogBatchResultModel,
+            },
+            '207': {
+                'description': 'Some log messages were not stored',
+                'schema': LogBatchResultModel,
+            },
+            '400': {
+                'description': 'Malformed request body',
+            },
+            '429': {
+                'description': 'Over the ingest limits of the token, retry after the '
+                               'Retry-After header seconds',
+            },
+        },
+    })
+    @token_required
+    def post(self):
+        try:
+            with metrics.stage('parse'):
+                records, errors = _batch_records(flask.request)
+        except ValueError as e:
+            return {'error': str(e)}, 400
+
+        dbname = auth.token_dbname(flask.request)
+        valid = [record for record in records if record is not None]
+        try:
+            limits.admit(dbname, len(valid), len(flask.request.get_data()))
+        except limits.RateLimited as e:
+            return rate_limited_response(e, len(valid))
+
+        db = storage.get_storage(dbname)
+
+        try:
+            with metrics.stage('storage'):
+                if flask.request.mimetype == lineprotocol.MIMETYPE:
+                    storage_errors = db.insert_lines(
+                        lineprotocol.join(records, flask.request.get_data())
+                    )
+                else:
+                    storage_errors = db.insert_many(valid)
+        except storage.BufferFull as e:
+            return buffer_full_response(e, len(valid))
+
+        result, status = batch_result(records, errors, storage_errors)
+        app.logger.debug('Batch: %d inserted, %d errors', result['inserted'], len(result['errors']))
+
+        return result, status
+
+
 class AggregatedLogs(Resource):
     @swagger.doc({
         'tags': ['logs'],
@@ -204,6 +541,7 @@ class AggregatedLogs(Resource):
                 'format': 'date-time',
             },
         ],
+        'produces': ['application/json', NDJSON_MIMETYPE],
         'security': {
             'auth-token': [],
         },
@@ -215,18 +553,280 @@ class AggregatedLogs(Resource):
     })
     @token_required
     def get(self):
-        db = storage.InfluxDBStorage(dbname=auth.token_dbname(flask.request))
+        dbname = auth.token_dbname(flask.request)
+        db = storage.get_storage(dbname)
 
-        return [
-            row for row in db.aggregated(
-                # Force convert to dict
-                **{arg: value for arg, value in flask.request.args.items()}
-            )
-        ]
+        # Force convert to dict
+        args = {arg: value for arg, value in flask.request.args.items()}
+        try:
+            with limits.query_slot(dbname), metrics.stage('storage'):
+                if cache.aggregations is not None:
+                    rows = cache.aggregations.aggregated(db, **args)
+                else:
+                    rows = db.aggregated(**args)
+                rows = [
+                    row for row in rows
+                ]
+        except QUERY_ERRORS as e:
+            return query_error_response(e)
+        if wants_ndjson(flask.request):
+            return _ndjson_response(rows)
+
+        return rows
+
+
+class LogsTail(Resource):
+    @swagger.doc({
+        'tags': ['logs'],
+        'description': 'Streams the new logs as they are inserted. Takes the same filters '
+                       'as GET /logs, the time range and pagination are ignored. Logs '
+                       'inserted through other server processes are not seen.',
+        'parameters': [
+            {
+                'name': 'message',
+                'description': 'Query part of the message. Will to a regex search.',
+                'in': 'path',
+                'type': 'string',
+            },
+        ],
+        'produces': [NDJSON_MIMETYPE, SSE_MIMETYPE],
+        'security': {
+            'auth-token': [],
+        },
+        'responses': {
+            '200': {
+                'description': 'Endless stream of logs, one JSON per line (or one server-sent '
+                               'event per log with the %s Accept header). Empty lines (or '
+                               'comments) are sent as heartbeats. The stream ends when the '
+                               'client reads too slowly.' % SSE_MIMETYPE,
+            },
+        },
+    })
+    @token_required
+    def get(self):
+        # Force convert to dict
+        args = {arg: value for arg, value in flask.request.args.items()}
+
+        try:
+            subscriber = tail.hub.subscribe(auth.token_dbname(flask.request), **args)
+        except ValueError as e:
+            return {'error': str(e)}, 400
+
+        sse = flask.request.accept_mimetypes.best_match(
+            [NDJSON_MIMETYPE, SSE_MIMETYPE]
+        ) == SSE_MIMETYPE
+        if sse:
+            mimetype, line, heartbeat = SSE_MIMETYPE, 'data: %s\n\n', ': heartbeat\n\n'
+        else:
+            mimetype, line, heartbeat = NDJSON_MIMETYPE, '%s\n', '\n'
+
+        def generate():
+            # Send the headers right away
+            yield heartbeat
+            while True:
+                try:
+                    row = subscriber.get(timeout=tail.HEARTBEAT_INTERVAL)
+                except tail.Dropped:
+                    if sse:
+                        yield 'event: dropped\ndata: {}\n\n'
+                    return
+                if row is None:
+                    yield heartbeat
+                else:
+                    yield line % json.dumps(row)
+
+        response = flask.Response(
+            generate(),
+            mimetype=mimetype,
+            headers={'Cache-Control': 'no-cache'}
+        )
+        response.call_on_close(lambda: tail.hub.unsubscribe(subscriber))
+
+        return response
+
+
+class LogsExport(Resource):
+    @swagger.doc({
+        'tags': ['logs'],
+        'description': 'Exports ALL the logs matching the query, in time order, for offline '
+                       'analysis. The time range is read in slices, concurrently. Takes the '
+                       'same filters as GET /logs, pagination is ignored. The response is '
+                       'gzip compressed (Content-Encoding).',
+        'parameters': [
+            {
+                'name': 'message',
+                'description': 'Query part of the message. Will to a regex search.',
+                'in': 'path',
+                'type': 'string',
+            },
+            {
+                'name': 'time__gte',
+                'description': 'Timestamp must be greater than this value. By default this is now() - 10 days. String isoformat representation of datetime.',
+                'in': 'path',
+                'type': 'string',
+            },
+            {
+                'name': 'time__lte',
+                'description': 'Timestamp must be less than this value. By default this is now(). String isoformat representation of datetime.',
+                'in': 'path',
+                'type': 'string',
+            },
+        ],
+        'produces': [NDJSON_MIMETYPE, export.CSV_MIMETYPE],
+        'security': {
+            'auth-token': [],
+        },
+        'responses': {
+            '200': {
+                'description': 'The logs, one JSON per line, or CSV with the %s Accept header: '
+                               'a header line then time, message and the tags of the database '
+                               'as columns.' % export.CSV_MIMETYPE,
+            },
+        },
+    })
+    @token_required
+    def get(self):
+        # Force convert to dict
+        args = {arg: value for arg, value in flask.request.args.items()}
+
+        dbname = auth.token_dbname(flask.request)
+        db = storage.get_storage(dbname)
+        is_csv = flask.request.accept_mimetypes.best_match(
+            [NDJSON_MIMETYPE, export.CSV_MIMETYPE]
+        ) == export.CSV_MIMETYPE
+
+        try:
+            rows = _limited_rows(dbname, export.iter_rows(db, **args))
+            # Invalid queries and limits raise here, not in the middle of
+            # the response
+            first = list(itertools.islice(rows, 1))
+            rows = itertools.chain(first, rows)
+            if is_csv:
+                mimetype, lines = export.CSV_MIMETYPE, export.csv_lines(rows, db.tag_keys(**args))
+            else:
+                mimetype, lines = NDJSON_MIMETYPE, export.ndjson_lines(rows)
+        except QUERY_ERRORS as e:
+            return query_error_response(e)
+
+        return flask.Response(
+            export.gzip_chunks(lines),
+            mimetype=mimetype,
+            headers={
+                'Content-Encoding': 'gzip',
+                'Content-Disposition': 'attachment; filename="logs.%s"' % ('csv' if is_csv else 'ndjson'),
+            }
+        )
+
+
+class Stats(Resource):
+    @swagger.doc({
+        'tags': ['stats'],
+        'description': 'Returns server statistics. write_behind is null when inserts are not buffered, aggregation_cache when aggregations are not cached, query_cache when query results are not cached, rollups (the rollup watermarks of the database of the token) when rollups are disabled and limits (the limits and usage of the database of the token) when no limits are set.',
+        'parameters': [],
+        'security': {
+            'auth-token': [],
+        },
+        'responses': {
+            '200': {
+                'description': 'Statistics',
+            },
+        },
+    })
+    @token_required
+    def get(self):
+        # Server wide counters, and what is per database for the database
+        # of the token only
+        dbname = auth.token_dbname(flask.request)
+
+        write_behind = None
+        if storage.write_behind is not None:
+            write_behind = storage.write_behind.stats.as_dict()
+            write_behind['pending_points'] = len(storage.write_behind)
+
+        aggregation_cache = None
+        if cache.aggregations is not None:
+            aggregation_cache = cache.aggregations.as_dict()
+
+        query_cache = None
+        if cache.queries is not None:
+            query_cache = cache.queries.as_dict()
+
+        rollups = None
+        if storage.downsampler is not None:
+            rollups = storage.downsampler.as_dict(dbname)
+
+        return {
+            'write_behind': write_behind,
+            'aggregation_cache': aggregation_cache,
+            'query_cache': query_cache,
+            'rollups': rollups,
+            'limits': limits.usage(dbname),
+            'tail': {
+                'subscribers': len(tail.hub),
+                'dropped': tail.hub.dropped,
+            },
+        }
+
+
+class Metrics(Resource):
+    @swagger.doc({
+        'tags': ['stats'],
+        'description': 'Server metrics in the Prometheus text format: request and stage '
+                       'latency histograms, ingested, rejected and dropped records, bytes '
+                       'received and sent and storage connection pool usage.',
+        'parameters': [],
+        'security': {
+            'auth-token': [],
+        },
+        'responses': {
+            '200': {
+                'description': 'Metrics',
+            },
+        },
+    })
+    @token_required
+    def get(self):
+        return flask.Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+class StorageAdmin(Resource):
+    @swagger.doc({
+        'tags': ['admin'],
+        'description': 'Returns the retention settings of the database, its disk usage '
+                       'per shard (InfluxDB) or partition (embedded storage) and the '
+                       'pending expirations, soonest first. Times are RFC3339, expires '
+                       'is null for data kept for ever.',
+        'parameters': [],
+        'security': {
+            'auth-token': [],
+        },
+        'responses': {
+            '200': {
+                'description': 'Storage usage',
+            },
+        },
+    })
+    @token_required
+    def get(self):
+        db = storage.get_storage(auth.token_dbname(flask.request))
+
+        return retention.status(db)
 
 
 api.add_resource(Logs, '/logs')
+api.add_resource(LogsBatch, '/logs/batch')
 api.add_resource(AggregatedLogs, '/logs/aggregated')
+api.add_resource(LogsTail, '/logs/tail')
+api.add_resource(LogsExport, '/logs/export')
+api.add_resource(Stats, '/stats')
+api.add_resource(Metrics, '/metrics')
+api.add_resource(StorageAdmin, '/admin/storage')
+
+if metrics.ENABLED:
+    app.wsgi_app = middleware.MetricsMiddleware(
+        app.wsgi_app,
+        [rule.rule for rule in app.url_map.iter_rules()]
+    )
 
 
 if __name__ == '__main__':
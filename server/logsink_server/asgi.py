@@ -0,0 +1,443 @@
+# ASGI entry point of the API server:
+#
+#     uvicorn logsink_server.asgi:app --port 6789
+#
+# The ingest and query endpoints (/logs, /logs/batch, /logs/aggregated) are
+# served here with the async storages of aiostorage.py, so that waiting on
+# the storage doesn't hold a thread. The other endpoints (swagger spec, tail,
+# stats) are served by the Flask app (api.py) in a thread pool.
+import asyncio
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import sys
+import time
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from logsink_server import aiostorage
+from logsink_server import api
+from logsink_server import auth
+from logsink_server import limits
+from logsink_server import lineprotocol
+from logsink_server import metrics
+from logsink_server import middleware
+from logsink_server import storage
+
+
+# Threads serving the requests passed to the Flask app. Each tailing client
+# holds one.
+WSGI_THREADS = int(os.environ.get('LOGSINK_WSGI_THREADS', 64))
+STREAM_CHUNK_SIZE = 64*1024  # bytes of NDJSON sent at a time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Headers(dict):
+    """Request headers, looked up case-insensitively as in Flask."""
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+
+class Request:
+    """The parts of flask.request used by the endpoints and auth module."""
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.body = body
+
+        # Header names are lowercase in ASGI
+        self.headers = Headers()
+        for name, value in scope['headers']:
+            self.headers.setdefault(name.decode('latin-1'), value.decode('latin-1'))
+
+        # First value of each parameter, as flask.request.args.items()
+        self.args = {}
+        for name, value in parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True):
+            self.args.setdefault(name, value)
+
+    @property
+    def mimetype(self):
+        return self.headers.get('content-type', '').split(';')[0].strip().lower()
+
+    @property
+    def accept_mimetypes(self):
+        return parse_accept_header(self.headers.get('accept'), MIMEAccept)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    body = await _read_body(receive)
+
+    path = scope['path'].rstrip('/')
+    handler = ROUTES.get((scope['method'], path))
+    if handler is None:
+        # The Flask app records its own metrics
+        await _wsgi(scope, body, receive, send)
+        return
+    if not metrics.ENABLED:
+        await _handle(handler, scope, body, send)
+        return
+
+    start = time.perf_counter()
+    response = {'status': '', 'size': 0}
+    metrics.bytes_received.inc(len(body), handler=path)
+
+    async def metrics_send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = str(message['status'])
+        else:
+            response['size'] += len(message.get('body', b''))
+        await send(message)
+
+    try:
+        await _handle(handler, scope, body, metrics_send)
+    finally:
+        metrics.bytes_sent.inc(response['size'], handler=path)
+        metrics.request_latency.observe(
+            time.perf_counter() - start,
+            handler=path,
+            method=scope['method'],
+            status=response['status']
+        )
+
+
+async def _handle(handler, scope, body, send):
+    request = Request(scope, body)
+    if request.headers.get('content-encoding', '').strip().lower() == 'gzip':
+        try:
+            request.body = middleware.gunzip(body)
+        except ValueError as e:
+            await _json(send, {'error': str(e)}, 400)
+            return
+        except OverflowError:
+            await _json(send, {
+                'error': 'Decompressed body larger than %d bytes.' % middleware.MAX_DECOMPRESSED_SIZE
+            }, 413)
+            return
+
+    with metrics.stage('auth'):
+        authenticated = auth.is_authenticated(request)
+    if not authenticated:
+        await _json(send, {'error': 'Token incorrect'}, 403)
+        return
+
+    # What was sent of the response, an error can't start another one
+    response = {'started': False, 'done': False}
+
+    async def tracked_send(message):
+        if message['type'] == 'http.response.start':
+            response['started'] = True
+        elif not message.get('more_body'):
+            response['done'] = True
+        await send(message)
+
+    try:
+        await handler(request, tracked_send)
+    except Exception:
+        logger.exception('%s %s failed', scope['method'], scope['path'])
+        if not response['started']:
+            await _json(send, {'message': 'Internal Server Error'}, 500)
+        elif not response['done']:
+            # The streamed response is cut short
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def get_logs(request, send):
+    dbname = auth.token_dbname(request)
+    db = await aiostorage.get_storage(dbname)
+    args = request.args
+
+    try:
+        with limits.query_slot(dbname):
+            if api.wants_ndjson(request):
+                await _ndjson(send, aiostorage.iter_query(db, **args))
+                return
+
+            with metrics.stage('storage'):
+                rows = await db.query(**args)
+    except api.QUERY_ERRORS as e:
+        await _json(send, *api.query_error_response(e))
+        return
+
+    await _json(send, api.logs_result(rows, args))
+
+
+async def post_log(request, send):
+    with metrics.stage('parse'):
+        log, errors = api.decode_log(request.body, request.args)
+    if errors:
+        await _json(send, {'message': errors}, 400)
+        return
+
+    dbname = auth.token_dbname(request)
+    try:
+        limits.admit(dbname, 1, len(request.body))
+    except limits.RateLimited as e:
+        await _json(send, *api.rate_limited_response(e, 1))
+        return
+
+    db = await aiostorage.get_storage(dbname)
+    try:
+        with metrics.stage('storage'):
+            await db.insert(log['message'], **log['tags'])
+    except storage.BufferFull as e:
+        await _json(send, *api.buffer_full_response(e))
+        return
+    metrics.records_ingested.inc()
+
+    await _json(send, log, 201)
+
+
+async def delete_logs(request, send):
+    db = await aiostorage.get_storage(auth.token_dbname(request))
+    try:
+        await db.clear(**request.args)
+    except ValueError as e:
+        await _json(send, {'error': str(e)}, 400)
+        return
+
+    await _json(send, 200)
+
+
+async def post_batch(request, send):
+    try:
+        with metrics.stage('parse'):
+            records, errors = api.decode_batch(request.mimetype, request.body)
+    except ValueError as e:
+        await _json(send, {'error': str(e)}, 400)
+        return
+
+    dbname = auth.token_dbname(request)
+    valid = [record for record in records if record is not None]
+    try:
+        limits.admit(dbname, len(valid), len(request.body))
+    except limits.RateLimited as e:
+        await _json(send, *api.rate_limited_response(e, len(valid)))
+        return
+
+    db = await aiostorage.get_storage(dbname)
+    try:
+        with metrics.stage('storage'):
+            if request.mimetype == lineprotocol.MIMETYPE:
+                storage_errors = await db.insert_lines(lineprotocol.join(records, request.body))
+            else:
+                storage_errors = await db.insert_many(valid)
+    except storage.BufferFull as e:
+        await _json(send, *api.buffer_full_response(e, len(valid)))
+        return
+
+    await _json(send, *api.batch_result(records, errors, storage_errors))
+
+
+async def get_aggregated(request, send):
+    dbname = auth.token_dbname(request)
+    db = await aiostorage.get_storage(dbname)
+    try:
+        with limits.query_slot(dbname), metrics.stage('storage'):
+            rows = await db.aggregated(**request.args)
+    except api.QUERY_ERRORS as e:
+        await _json(send, *api.query_error_response(e))
+        return
+
+    if api.wants_ndjson(request):
+        await _ndjson(send, _aiter(rows))
+        return
+
+    await _json(send, rows)
+
+
+ROUTES = {
+    ('GET', '/logs'): get_logs,
+    ('POST', '/logs'): post_log,
+    ('DELETE', '/logs'): delete_logs,
+    ('POST', '/logs/batch'): post_batch,
+    ('GET', '/logs/aggregated'): get_aggregated,
+}
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+
+    return b''.join(chunks)
+
+
+def _headers(content_type, headers=()):
+    # flask_cors allows all origins in the Flask app
+    result = [
+        (b'content-type', content_type.encode('latin-1')),
+        (b'access-control-allow-origin', b'*'),
+    ]
+    result.extend(
+        (name.lower().encode('latin-1'), str(value).encode('latin-1'))
+        for name, value in dict(headers).items()
+    )
+    return result
+
+
+async def _json(send, data, status=200, headers=()):
+    body = (json.dumps(data) + '\n').encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': _headers('application/json', headers) + [
+            (b'content-length', str(len(body)).encode('latin-1')),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _ndjson(send, rows):
+    """Stream rows, one JSON per line.
+
+    The first row is read before the response starts so that invalid
+    queries raise here, as in api._ndjson_response."""
+
+    rows = rows.__aiter__()
+    try:
+        first = [await rows.__anext__()]
+    except StopAsyncIteration:
+        first = []
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': _headers(api.NDJSON_MIMETYPE),
+    })
+
+    chunk = []
+    size = 0
+    for row in first:
+        chunk.append(json.dumps(row) + '\n')
+    async for row in rows:
+        line = json.dumps(row) + '\n'
+        chunk.append(line)
+        size += len(line)
+        if size >= STREAM_CHUNK_SIZE:
+            await send({
+                'type': 'http.response.body',
+                'body': ''.join(chunk).encode('utf-8'),
+                'more_body': True,
+            })
+            chunk = []
+            size = 0
+
+    await send({'type': 'http.response.body', 'body': ''.join(chunk).encode('utf-8')})
+
+
+async def _aiter(rows):
+    for row in rows:
+        yield row
+
+
+_wsgi_executor = concurrent.futures.ThreadPoolExecutor(
+    WSGI_THREADS,
+    thread_name_prefix='logsink-wsgi'
+)
+
+
+async def _wsgi(scope, body, receive, send):
+    # Serve the request with the Flask app in a thread, streaming its response
+    loop = asyncio.get_running_loop()
+    environ = _environ(scope, body)
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    result = await loop.run_in_executor(_wsgi_executor, api.app, environ, start_response)
+    chunks = iter(result)
+
+    # Stop reading an endless response (tail) once the client is gone
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        # start_response may be called when the first chunk is produced
+        chunk = await loop.run_in_executor(_wsgi_executor, next, chunks, None)
+        await send({
+            'type': 'http.response.start',
+            'status': started['status'],
+            'headers': [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in started['headers']
+            ],
+        })
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if disconnected.done():
+                break
+            chunk = await loop.run_in_executor(_wsgi_executor, next, chunks, None)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(_wsgi_executor, result.close)
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        if name in environ:
+            value = '%s,%s' % (environ[name], value)
+        environ[name] = value
+
+    return environ
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await aiostorage.close_storages()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
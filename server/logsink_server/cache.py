@@ -0,0 +1,449 @@
+# Result caches of the storage queries
+import collections
+import datetime
+import math
+import os
+import pytz
+import threading
+import time
+
+from logsink_server import query
+from logsink_server import storage
+
+
+# Max memory used by the aggregation cache, in bytes. 0 disables the cache.
+AGGREGATION_CACHE_SIZE = int(os.environ.get('LOGSINK_AGGREGATION_CACHE_SIZE', 0))
+# Seconds the counts of an interval are served from the cache, writes of
+# other processes are seen after that
+AGGREGATION_CACHE_TTL = float(os.environ.get('LOGSINK_AGGREGATION_CACHE_TTL', 3600))
+# Max memory used by the query result cache, in bytes. 0 disables the cache.
+RESULT_CACHE_SIZE = int(os.environ.get('LOGSINK_RESULT_CACHE_SIZE', 0))
+# Seconds query results are served from the cache, longer for time windows
+# ended SEAL_DELAY ago
+RESULT_CACHE_TTL = float(os.environ.get('LOGSINK_RESULT_CACHE_TTL', 5))
+RESULT_CACHE_PAST_TTL = float(os.environ.get('LOGSINK_RESULT_CACHE_PAST_TTL', 3600))
+# Intervals are only cached this many seconds after their end, when late
+# writes have settled
+SEAL_DELAY = 60
+
+# Rough memory usage of cache entries, for the memory budget
+ENTRY_BYTES = 500
+BUCKET_BYTES = 100
+ROW_BYTES = 200  # plus the length of the message
+
+
+class AggregationEntry:
+    def __init__(self, filters, interval):
+        self.filters = filters
+        self.interval = interval
+        # interval start (seconds since epoch) -> (count, expiry time)
+        self.counts = {}
+
+    @property
+    def size(self):
+        return ENTRY_BYTES + BUCKET_BYTES*len(self.counts)
+
+
+class AggregationCache:
+    """Cache of aggregated (histogram) query results.
+
+    Histograms are aligned to multiples of their interval since epoch so
+    successive queries of a polling dashboard share their intervals. The
+    counts of the past ("sealed") intervals are cached per (dbname, filters,
+    interval length), only the intervals missing from the cache (typically
+    the current one) are read from the storage.
+
+    The cache listens to the storage writes: inserts of records in sealed
+    intervals and clears invalidate the affected intervals. Only the writes
+    made by this process are seen, counts are read again ttl seconds after
+    they were cached for the others."""
+
+    def __init__(self, max_size=AGGREGATION_CACHE_SIZE, seal_delay=SEAL_DELAY, ttl=AGGREGATION_CACHE_TTL):
+        self.max_size = max_size
+        self.seal_delay = seal_delay
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # LRU
+        self._size = 0
+        # Bumped on writes in sealed intervals so that results read
+        # concurrently with them are not cached
+        self._generations = collections.Counter()
+
+        storage.add_insert_listener(self._inserted)
+        storage.add_clear_listener(self._cleared)
+
+    def close(self):
+        storage.remove_listener(self._inserted)
+        storage.remove_listener(self._cleared)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def aggregated(self, db, **kwargs):
+        """Same as db.aggregated(**kwargs), served from the cache if possible."""
+
+        interval = storage.histogram_interval(**kwargs)
+        compiled = query.compile(**kwargs)
+        gte = compiled.time__gte.timestamp()
+        lte = compiled.time__lte.timestamp()
+
+        filters = storage.Filters(**kwargs)
+        key = (db.dbname, interval, filters.key())
+
+        first = int(gte // interval * interval)
+        starts = range(first, math.floor(lte) + 1, interval)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                now = time.monotonic()
+                cached = {
+                    start: count for start, (count, expires) in entry.counts.items()
+                    if expires > now
+                }
+            else:
+                cached = {}
+            generation = self._generations[db.dbname]
+
+        # Partial intervals at the edges of the window are never cached
+        def whole(start):
+            return start >= gte and start + interval <= lte
+
+        counts = {}
+        missing = []
+        for start in starts:
+            if start in cached and whole(start):
+                counts[start] = cached[start]
+            else:
+                missing.append(start)
+
+        with self._lock:
+            self.hits += len(starts) - len(missing)
+            self.misses += len(missing)
+
+        for run in _runs(missing, interval):
+            # The interval following the run is read too, it's ignored
+            rows = db.histogram(
+                interval,
+                time__gte=_isoformat(max(gte, run[0])),
+                time__lte=_isoformat(min(lte, run[-1] + interval)),
+                **filters.kwargs()
+            )
+            run = set(run)
+            for row in rows:
+                start = storage.to_micros(row['time']) // 1000000
+                if start in run:
+                    counts[start] = row['count_message'] or 0
+
+        sealed_before = time.time() - self.seal_delay
+        sealed = {
+            start: counts.get(start, 0) for start in missing
+            if whole(start) and start + interval <= sealed_before
+        }
+        if sealed:
+            self._store(key, filters, interval, sealed, generation)
+
+        return [
+            {
+                'time': storage.format_micros(start*1000000),
+                'count_message': counts.get(start, 0),
+            }
+            for start in starts
+        ]
+
+    def _store(self, key, filters, interval, counts, generation):
+        with self._lock:
+            if self._generations[key[0]] != generation:
+                # Written to in the meantime, the counts may be stale
+                return
+
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = AggregationEntry(filters, interval)
+            else:
+                self._entries.move_to_end(key)
+                self._size -= entry.size
+
+            expires = time.monotonic() + self.ttl
+            entry.counts.update((start, (count, expires)) for start, count in counts.items())
+            self._size += entry.size
+
+            while self._size > self.max_size and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+
+    def _inserted(self, dbname, records):
+        sealed_before = time.time() - self.seal_delay
+        records = [
+            record for record in records
+            if record.time.timestamp() < sealed_before
+        ]
+        if not records:
+            # Recent records only change intervals which are not cached
+            return
+
+        with self._lock:
+            self._generations[dbname] += 1
+            for key, entry in self._entries.items():
+                if key[0] != dbname:
+                    continue
+                for record in records:
+                    if entry.filters.matches(record):
+                        timestamp = record.time.timestamp()
+                        start = int(timestamp // entry.interval * entry.interval)
+                        if entry.counts.pop(start, None) is not None:
+                            self._size -= BUCKET_BYTES
+
+    def _cleared(self, dbname, kwargs):
+        if 'time__lte' not in kwargs and 'time__gte' not in kwargs:
+            gte, lte = float('-inf'), float('inf')
+        else:
+            compiled = query.compile(**kwargs)
+            gte, lte = compiled.time__gte.timestamp(), compiled.time__lte.timestamp()
+
+        with self._lock:
+            self._generations[dbname] += 1
+            for key, entry in self._entries.items():
+                if key[0] != dbname:
+                    continue
+                for start in list(entry.counts):
+                    if start <= lte and start + entry.interval > gte:
+                        del entry.counts[start]
+                        self._size -= BUCKET_BYTES
+
+
+class QueryEntry:
+    """Rows of a query, or a query being read when rows is None."""
+
+    def __init__(self, key, filters, gte, lte):
+        self.key = key
+        self.filters = filters
+        # Time window in microseconds, for the invalidation
+        self.gte = gte
+        self.lte = lte
+        self.rows = None
+        self.size = 0
+        self.expires = None  # time.monotonic()
+        self.stale = False  # written to while being read
+
+    def overlaps(self, gte, lte):
+        return self.gte <= lte and gte <= self.lte
+
+
+class QueryCache:
+    """Cache of query (GET /logs) results, for the dashboards polling the
+    same queries.
+
+    Results are cached per database and compiled query parameters: the time
+    window, filters and page. Queries without time__lte end now, they're
+    cached by their parameters only and their results served for ttl
+    seconds. Windows which ended seal_delay ago are kept past_ttl seconds.
+    Least recently used results are evicted past max_size bytes.
+
+    The cache listens to the storage writes: inserts of matching records
+    in the window of a result and overlapping clears drop it. Only the
+    writes made by this process are seen, the ttl bounds how stale results
+    of the others get."""
+
+    def __init__(self, max_size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL,
+                 past_ttl=RESULT_CACHE_PAST_TTL, seal_delay=SEAL_DELAY):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.past_ttl = past_ttl
+        self.seal_delay = seal_delay
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> QueryEntry, LRU
+        self._reading = set()  # QueryEntry of the queries being read
+        self._size = 0
+
+        storage.add_insert_listener(self._inserted)
+        storage.add_clear_listener(self._cleared)
+
+    def close(self):
+        storage.remove_listener(self._inserted)
+        storage.remove_listener(self._cleared)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
+
+    def query(self, db, **kwargs):
+        """Same as list(db.query(**kwargs)), served from the cache if possible."""
+
+        rows, entry = self.lookup(db.dbname, **kwargs)
+        if rows is not None:
+            return rows
+
+        try:
+            rows = list(db.query(**kwargs))
+        except BaseException:
+            self.cancel(entry)
+            raise
+        self.store(entry, rows)
+
+        return rows
+
+    def lookup(self, dbname, **kwargs):
+        """Returns (rows, None) for a cached query, (None, entry) otherwise.
+
+        The rows read for a missed query are then passed to store(entry,
+        rows), or cancel(entry) is called if they couldn't be read."""
+
+        compiled = query.compile(**kwargs)
+        if 'time__lte' in kwargs:
+            key = (dbname, compiled)
+            lte = storage.to_micros(compiled.time__lte)
+        else:
+            # Ends now: it's the same query at any time
+            key = (dbname, compiled._replace(
+                time__lte=None,
+                time__gte=compiled.time__gte if 'time__gte' in kwargs else None
+            ))
+            lte = float('inf')
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return list(entry.rows), None
+                self._remove(entry)
+            self.misses += 1
+
+            entry = QueryEntry(
+                key,
+                storage.Filters(**kwargs),
+                storage.to_micros(compiled.start),
+                lte
+            )
+            self._reading.add(entry)
+
+        return None, entry
+
+    def store(self, entry, rows):
+        with self._lock:
+            self._reading.discard(entry)
+            if entry.stale:
+                # Written to in the meantime, the rows may be stale
+                return
+
+            sealed_before = (time.time() - self.seal_delay)*1000000
+            entry.rows = list(rows)
+            entry.size = ENTRY_BYTES + sum(
+                ROW_BYTES + len(row.get('message') or '') for row in entry.rows
+            )
+            entry.expires = time.monotonic() + (
+                self.past_ttl if entry.lte < sealed_before else self.ttl
+            )
+
+            old = self._entries.get(entry.key)
+            if old is not None:
+                self._remove(old)
+            self._entries[entry.key] = entry
+            self._size += entry.size
+
+            while self._size > self.max_size and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+
+    def cancel(self, entry):
+        with self._lock:
+            self._reading.discard(entry)
+
+    def _remove(self, entry):
+        del self._entries[entry.key]
+        self._size -= entry.size
+
+    def _invalidate(self, dbname, affected):
+        # Drops the results, and marks the queries being read, for which
+        # affected(entry) is true
+        with self._lock:
+            for entry in list(self._entries.values()) + list(self._reading):
+                if entry.key[0] != dbname or entry.stale or not affected(entry):
+                    continue
+                entry.stale = True
+                if entry.rows is not None:
+                    self._remove(entry)
+                    self.invalidations += 1
+
+    def _inserted(self, dbname, records):
+        if not records:
+            return
+
+        records = [(storage.to_micros(record.time), record) for record in records]
+        first = min(micros for micros, _ in records)
+        last = max(micros for micros, _ in records)
+
+        def affected(entry):
+            return entry.overlaps(first, last) and any(
+                entry.gte <= micros <= entry.lte and entry.filters.matches(record)
+                for micros, record in records
+            )
+
+        self._invalidate(dbname, affected)
+
+    def _cleared(self, dbname, kwargs):
+        if 'time__lte' not in kwargs and 'time__gte' not in kwargs:
+            gte, lte = float('-inf'), float('inf')
+        else:
+            compiled = query.compile(**kwargs)
+            gte, lte = storage.to_micros(compiled.time__gte), storage.to_micros(compiled.time__lte)
+        tags = storage.filter_tags(kwargs)
+
+        def affected(entry):
+            # Unless their tag filters exclude each other
+            return entry.overlaps(gte, lte) and all(
+                str(entry.filters.tags.get(tag, value)) == str(value)
+                for tag, value in tags.items()
+            )
+
+        self._invalidate(dbname, affected)
+
+
+def _runs(starts, interval):
+    # Split the sorted interval starts into runs of consecutive intervals
+    run = []
+    for start in starts:
+        if run and start != run[-1] + interval:
+            yield run
+            run = []
+        run.append(start)
+    if run:
+        yield run
+
+
+def _isoformat(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, pytz.utc).isoformat()
+
+
+aggregations = AggregationCache() if AGGREGATION_CACHE_SIZE else None
+queries = QueryCache() if RESULT_CACHE_SIZE else None
@@ -0,0 +1,173 @@
+# Bulk export of the logs of a time range, see GET /logs/export.
+#
+# The range is cut into slices of LOGSINK_EXPORT_SLICE_SECONDS which are
+# read from the storage by LOGSINK_EXPORT_CONCURRENCY threads, each one a
+# keyset-paginated scan (storage.iter_query). The slices are written out in
+# time order: the ones ahead of the slice being sent are read meanwhile, up
+# to SLICE_QUEUE_SIZE rows each, so memory use doesn't depend on the size of
+# the range.
+#
+# Rows are written as NDJSON or CSV, gzip compressed. The CSV columns are
+# time, message and the tags of the database, sorted (see tag_keys of the
+# storages), the same for all the rows.
+import collections
+import csv
+import io
+import json
+import os
+import queue
+import threading
+import zlib
+
+from logsink_server import query
+from logsink_server import storage
+
+
+SLICE_SECONDS = int(os.environ.get('LOGSINK_EXPORT_SLICE_SECONDS', 3600))
+CONCURRENCY = int(os.environ.get('LOGSINK_EXPORT_CONCURRENCY', 4))
+SLICE_QUEUE_SIZE = 1000  # rows read ahead per slice
+CHUNK_SIZE = 64*1024  # bytes compressed at a time
+
+CSV_MIMETYPE = 'text/csv'
+
+_DONE = object()
+
+
+def time_slices(gte, lte, seconds):
+    """Cut [gte, lte] (microseconds) into (gte, lte) RFC3339 slices."""
+
+    step = seconds*1000000
+    start = gte
+    while start <= lte:
+        end = min(start + step - 1, lte)
+        yield storage.format_micros(start), storage.format_micros(end)
+        start = end + 1
+
+
+class _SliceReader:
+    """Reads the rows of a time slice in a thread, SLICE_QUEUE_SIZE ahead."""
+
+    def __init__(self, db, kwargs):
+        self.db = db
+        self.kwargs = kwargs
+        self._rows = queue.Queue(SLICE_QUEUE_SIZE)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='logsink-export', daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        while True:
+            row = self._rows.get()
+            if row is _DONE:
+                return
+            if isinstance(row, Exception):
+                raise row
+            yield row
+
+    def close(self):
+        self._stop.set()
+
+    def _run(self):
+        try:
+            for row in storage.iter_query(self.db, **self.kwargs):
+                if not self._put(row):
+                    return
+        except Exception as e:
+            self._put(e)
+        else:
+            self._put(_DONE)
+
+    def _put(self, item):
+        # Gives up once the export is closed, e.g. the client went away
+        while not self._stop.is_set():
+            try:
+                self._rows.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+def iter_rows(db, slice_seconds=SLICE_SECONDS, concurrency=CONCURRENCY, **kwargs):
+    """Yield the rows of db matching the query kwargs, in time order.
+
+    Pagination parameters are ignored. Raises ValueError for invalid query
+    parameters before reading anything."""
+
+    compiled = query.compile(**kwargs)
+    filters = {
+        key: value for key, value in kwargs.items()
+        if key not in storage.QUERY_KEYWORDS
+    }
+    slices = time_slices(
+        storage.to_micros(compiled.time__gte),
+        storage.to_micros(compiled.time__lte),
+        slice_seconds
+    )
+
+    return _read_slices(db, filters, slices, concurrency)
+
+
+def _read_slices(db, filters, slices, concurrency):
+    readers = collections.deque()
+
+    def start_next():
+        next_slice = next(slices, None)
+        if next_slice is not None:
+            readers.append(_SliceReader(db, dict(
+                filters,
+                time__gte=next_slice[0],
+                time__lte=next_slice[1]
+            )))
+
+    try:
+        for _ in range(max(1, concurrency)):
+            start_next()
+        while readers:
+            reader = readers[0]
+            yield from reader
+            readers.popleft()
+            start_next()
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def csv_lines(rows, tags):
+    """CSV lines of rows: time, message and the tags columns."""
+
+    columns = ['time', 'message'] + [tag for tag in tags if tag not in ('time', 'message')]
+    out = io.StringIO()
+    writer = csv.writer(out)
+
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(['' if row.get(column) is None else row[column] for column in columns])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue()
+
+
+def gzip_chunks(lines):
+    """Gzip compress the text lines, CHUNK_SIZE bytes of text at a time."""
+
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            data = compressor.compress(''.join(chunk).encode('utf-8'))
+            if data:
+                yield data
+            chunk = []
+            size = 0
+
+    yield compressor.compress(''.join(chunk).encode('utf-8')) + compressor.flush()
@@ -0,0 +1,220 @@
+# Secondary indexes of the embedded storage (segments.SegmentStorage).
+#
+# Indexes are kept per partition (time bucket). Records of a partition are
+# numbered in insertion order and indexes map keys to posting lists of
+# these numbers.
+from array import array
+
+
+class PostingList:
+    """Increasing record numbers, delta and varint encoded."""
+
+    __slots__ = ('_data', '_last', '_len')
+
+    def __init__(self):
+        self._data = bytearray()
+        self._last = -1
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def append(self, number):
+        if number <= self._last:
+            raise ValueError('Record numbers must be increasing.')
+
+        delta = number - self._last
+        encoded = bytearray()
+        while delta > 0x7f:
+            encoded.append(delta & 0x7f | 0x80)
+            delta >>= 7
+        encoded.append(delta)
+
+        self._data += encoded
+        self._last = number
+        self._len += 1
+
+    def __iter__(self):
+        number = -1
+        delta = 0
+        shift = 0
+        for byte in bytes(self._data):
+            delta |= (byte & 0x7f) << shift
+            if byte & 0x80:
+                shift += 7
+                continue
+            number += delta
+            yield number
+            delta = 0
+            shift = 0
+
+
+def intersect(posting_lists):
+    """Sorted list of the record numbers present in all posting_lists."""
+
+    if not posting_lists:
+        return []
+
+    # Start from the shortest list, the result can't be longer
+    posting_lists = sorted(posting_lists, key=len)
+    result = list(posting_lists[0])
+    for posting_list in posting_lists[1:]:
+        if not result:
+            break
+        members = set(result)
+        result = [number for number in posting_list if number in members]
+
+    return result
+
+
+def trigrams(text):
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def required_literals(pattern):
+    """Strings which every match of the regex pattern contains.
+
+    This is conservative: an empty list means that nothing is known."""
+
+    if '|' in pattern or '(?' in pattern:
+        # Alternatives, flags or lookarounds
+        return []
+
+    literals = []
+    current = []
+
+    def end_literal():
+        if current:
+            literals.append(''.join(current))
+            current.clear()
+
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            escaped = pattern[i + 1:i + 2]
+            i += 2
+            if escaped and not escaped.isalnum():
+                current.append(escaped)
+            else:
+                # Character class (\d, \w, ...) or an anchor
+                end_literal()
+        elif c in '*?{':
+            # The previous character is optional
+            if current:
+                current.pop()
+            end_literal()
+            i = pattern.find('}', i) + 1 if c == '{' else i + 1
+            if i == 0:
+                return []
+        elif c in '[(':
+            # Skip the whole class or group, whatever is in it may be
+            # optional
+            end_literal()
+            i = _skip_group(pattern, i)
+            if i is None:
+                return []
+        elif c in '+.^$)':
+            end_literal()
+            i += 1
+        else:
+            current.append(c)
+            i += 1
+    end_literal()
+
+    return literals
+
+
+def _skip_group(pattern, start):
+    # Index right after the class or group starting at start
+    closing = ']' if pattern[start] == '[' else ')'
+    depth = 0
+    i = start
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 2
+            continue
+        if closing == ']':
+            # ']' right after '[' or '[^' is a literal
+            if c == ']' and i > start + 1 and pattern[start + 1:i] != '^':
+                return i + 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if not depth:
+                return i + 1
+        i += 1
+
+    return None
+
+
+class PartitionIndex:
+    """Indexes of the records of one partition."""
+
+    def __init__(self, messages=False, tags=False):
+        # Record number -> location in the partition's segments
+        self.segments = array('L')
+        self.offsets = array('Q')
+
+        self.messages = {} if messages else None  # trigram -> PostingList
+        self.tags = {} if tags else None  # (tag, value as str) -> PostingList
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add(self, record, seq, offset):
+        number = len(self.offsets)
+        self.segments.append(seq)
+        self.offsets.append(offset)
+
+        if self.messages is not None:
+            for trigram in trigrams(record['m']):
+                posting_list = self.messages.get(trigram)
+                if posting_list is None:
+                    posting_list = self.messages[trigram] = PostingList()
+                posting_list.append(number)
+
+        if self.tags is not None:
+            for tag, value in record['g'].items():
+                item = (str(tag), str(value))
+                posting_list = self.tags.get(item)
+                if posting_list is None:
+                    posting_list = self.tags[item] = PostingList()
+                posting_list.append(number)
+
+    def location(self, number):
+        return self.segments[number], self.offsets[number]
+
+    def candidates(self, tags, message=None):
+        """Numbers of the records which may match the query.
+
+        tags are the exact tag values to match, compared as strings, and
+        message the message regex. Returns None when the index can't tell,
+        all the records must then be checked."""
+
+        posting_lists = []
+        if self.tags is not None:
+            for tag, value in tags.items():
+                posting_list = self.tags.get((str(tag), str(value)))
+                if posting_list is None:
+                    return []
+                posting_lists.append(posting_list)
+
+        if self.messages is not None and message is not None:
+            keys = set()
+            for literal in required_literals(message):
+                keys.update(trigrams(literal))
+            for key in keys:
+                posting_list = self.messages.get(key)
+                if posting_list is None:
+                    return []
+                posting_lists.append(posting_list)
+
+        if not posting_lists:
+            return None
+
+        # intersect() starts from the most selective posting list
+        return intersect(posting_lists)
@@ -0,0 +1,235 @@
+# Admission control per token (i.e. per database, see auth.TOKEN_DBS).
+#
+# LOGSINK_LIMITS is a JSON object mapping database names ("*" for all the
+# others) to their limits:
+#
+#     {"*": {"records_per_second": 5000, "bytes_per_second": 5000000, "max_queries": 4}}
+#
+# Ingest is limited by two token buckets, of log records and of request body
+# bytes per second. They hold up to burst seconds of their rate (1 by
+# default), so that short peaks get through. max_queries is the number of
+# queries (GET /logs, GET /logs/aggregated) of the database running at the
+# same time, so that heavy histograms can't take all the storage threads.
+# Missing limits, or null ones, don't apply.
+#
+# Requests over a limit are refused right away with a 429 status and a
+# Retry-After header, see RateLimited.
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+from logsink_server import metrics
+
+
+LIMITS = os.environ.get('LOGSINK_LIMITS', '')
+DEFAULT_BURST = 1.0  # seconds of rate a token bucket holds
+QUERY_RETRY_AFTER = 1  # seconds, when all the query slots are taken
+
+
+class RateLimited(Exception):
+    """A request went over a limit of its database."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def retry_after_header(self):
+        """Retry-After value: whole seconds, at least 1."""
+
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second, up to capacity.
+
+    Not thread-safe, Limiter holds a lock around it."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated)*self.rate)
+        self._updated = now
+
+    def wait(self, amount):
+        """Seconds before amount tokens can be taken, 0 if they can now.
+
+        More than capacity tokens can be taken once the bucket is full,
+        leaving it in debt."""
+
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens)/self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class Limiter:
+    """The limits of one database, thread-safe."""
+
+    def __init__(self, dbname, records_per_second=None, bytes_per_second=None,
+                 max_queries=None, burst=DEFAULT_BURST):
+        self.dbname = dbname
+        self.max_queries = max_queries
+        self.buckets = {}  # limit name -> TokenBucket
+        if records_per_second is not None:
+            self.buckets['records'] = TokenBucket(records_per_second, records_per_second*burst)
+        if bytes_per_second is not None:
+            self.buckets['bytes'] = TokenBucket(bytes_per_second, bytes_per_second*burst)
+
+        self.queries = 0  # running
+        self.admitted = {'records': 0, 'bytes': 0, 'queries': 0}
+        self.limited = {'records': 0, 'bytes': 0, 'queries': 0}  # refused requests
+        self._lock = threading.Lock()
+
+    def admit(self, records, size):
+        """Take records and size bytes from the buckets or raise RateLimited."""
+
+        amounts = {'records': records, 'bytes': size}
+        with self._lock:
+            now = time.monotonic()
+            for name, bucket in self.buckets.items():
+                bucket.refill(now)
+                wait = bucket.wait(amounts[name])
+                if wait:
+                    self.limited[name] += 1
+                    metrics.requests_limited.inc(database=self.dbname, limit=name)
+                    raise RateLimited(
+                        'Too many %s per second for this token.' % ('log records' if name == 'records' else 'bytes'),
+                        wait
+                    )
+            for name, bucket in self.buckets.items():
+                bucket.take(amounts[name])
+            self.admitted['records'] += records
+            self.admitted['bytes'] += size
+
+    def acquire_query(self):
+        with self._lock:
+            if self.max_queries is not None and self.queries >= self.max_queries:
+                self.limited['queries'] += 1
+                metrics.requests_limited.inc(database=self.dbname, limit='queries')
+                raise RateLimited('Too many queries running for this token.', QUERY_RETRY_AFTER)
+            self.queries += 1
+            self.admitted['queries'] += 1
+
+    def release_query(self):
+        with self._lock:
+            self.queries -= 1
+
+    def as_dict(self):
+        with self._lock:
+            now = time.monotonic()
+            for bucket in self.buckets.values():
+                bucket.refill(now)
+            return {
+                'records_per_second': _rate(self.buckets.get('records')),
+                'bytes_per_second': _rate(self.buckets.get('bytes')),
+                'max_queries': self.max_queries,
+                'available': {name: int(bucket.tokens) for name, bucket in self.buckets.items()},
+                'running_queries': self.queries,
+                'admitted': dict(self.admitted),
+                'limited': dict(self.limited),
+            }
+
+
+def _rate(bucket):
+    return bucket.rate if bucket is not None else None
+
+
+def parse_limits(text):
+    """Limiter settings per database name from the LOGSINK_LIMITS JSON."""
+
+    if not text.strip():
+        return {}
+
+    config = json.loads(text)
+    if not isinstance(config, dict):
+        raise ValueError('LOGSINK_LIMITS must be a JSON object.')
+
+    settings = {}
+    for dbname, values in config.items():
+        unknown = set(values) - {'records_per_second', 'bytes_per_second', 'max_queries', 'burst'}
+        if unknown:
+            raise ValueError('Unknown limits for %s: %s' % (dbname, ', '.join(sorted(unknown))))
+        settings[dbname] = {key: value for key, value in values.items() if value is not None}
+
+    return settings
+
+
+settings = parse_limits(LIMITS)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(dbname):
+    """The shared Limiter of the database, None when it has no limits."""
+
+    limiter = _limiters.get(dbname)
+    if limiter is None:
+        config = settings.get(dbname, settings.get('*'))
+        if config is None:
+            return None
+        with _limiters_lock:
+            limiter = _limiters.get(dbname)
+            if limiter is None:
+                limiter = _limiters[dbname] = Limiter(dbname, **config)
+
+    return limiter
+
+
+def admit(dbname, records, size):
+    """Admit an ingest request of records log records and size bytes.
+
+    Raises RateLimited when the database is over its limits."""
+
+    limiter = get_limiter(dbname)
+    if limiter is not None:
+        limiter.admit(records, size)
+
+
+@contextlib.contextmanager
+def query_slot(dbname):
+    """Context manager holding one of the query slots of the database.
+
+    Raises RateLimited when they're all taken."""
+
+    limiter = get_limiter(dbname)
+    if limiter is None:
+        yield
+        return
+
+    limiter.acquire_query()
+    try:
+        yield
+    finally:
+        limiter.release_query()
+
+
+def usage(dbname=None):
+    """Limits and usage per database, None when no limits are set.
+
+    Only the ones of dbname when given."""
+
+    if not settings:
+        return None
+
+    return {
+        name: limiter.as_dict() for name, limiter in list(_limiters.items())
+        if dbname in (None, name)
+    }
+
+
+def reset():
+    """Forget the limiters, e.g. after the settings changed."""
+
+    with _limiters_lock:
+        _limiters.clear()
@@ -0,0 +1,139 @@
+# InfluxDB line protocol ingest: POST /logs/batch with the
+# application/x-influxdb-line-protocol content type.
+#
+# One log message per line:
+#
+#     logs,client_name=my-client,tag1=value1 message="some message" 1483232400000000000
+#
+# Commas, equal signs and spaces in tag keys and values are escaped with a
+# backslash. Double quotes and backslashes in the message are escaped too,
+# other backslashes are kept as they are. Newlines in the message are written
+# as they are, inside its quotes: InfluxDB only unescapes \" and \\ so \n
+# would be stored as a backslash and an n. The timestamp is in nanoseconds
+# since epoch, the server time when it's omitted.
+#
+# Lines are validated by regexes run over the request body in place, without
+# decoding it. InfluxDB gets the valid lines as they are: the request body
+# itself when all the lines are valid and have a timestamp. Lines without one
+# are stamped with the time they were received, so that writing them again
+# after a partial write doesn't store them twice. Other storages, and the
+# insert listeners, get them decoded.
+import re
+import time
+
+from logsink_server import storage
+
+
+MIMETYPE = 'application/x-influxdb-line-protocol'
+
+_TAG = rb'(?:[^,= \\\n]|\\.)+'
+_LINE_RE = re.compile(
+    rb'logs((?:,%s=%s)*) message="((?:[^"\\]|\\[\s\S])*)"(?: (-?\d{1,19}))?\r?' % (_TAG, _TAG)
+)
+# A line, up to the first newline outside of double quotes
+_LINE_SPAN_RE = re.compile(rb'(?:[^"\n\\]|\\.|"(?:[^"\\]|\\[\s\S])*")*')
+_TAG_RE = re.compile(rb',(%s)=(%s)' % (_TAG, _TAG))
+# Tags which can't be set: the query keywords, time is the timestamp and
+# message the field
+RESERVED_TAGS = storage.QUERY_KEYWORDS + ['message', 'time']
+_RESERVED_RE = re.compile(
+    rb'(?<!\\),(?:%s)=' % b'|'.join(re.escape(tag.encode('ascii')) for tag in RESERVED_TAGS)
+)
+_ESCAPE_RE = re.compile(rb'\\(.)')
+_MESSAGE_ESCAPES = {b'"': b'"', b'\\': b'\\'}
+
+
+def split_lines(body):
+    """Validate the lines of a request body.
+
+    Returns (lines, errors) as api.decode_batch does: lines are memoryviews
+    over body, None for the invalid ones and bytes for the ones stamped with
+    the current time."""
+
+    view = memoryview(body)
+    lines = []
+    errors = []
+    stamp = None
+    for start, end in _line_spans(body):
+        # Blank lines are skipped
+        if end > start and not (end - start == 1 and body[start] == 13):
+            match = _LINE_RE.fullmatch(body, start, end)
+            if match is None:
+                error = 'Invalid line, expected: logs,<tags> message="<message>" [<timestamp>]'
+            elif _RESERVED_RE.search(body, match.start(1), match.end(1)):
+                error = '%s are reserved, you cannot use them as tags.' % ', '.join(RESERVED_TAGS)
+            else:
+                error = None
+            if error is None and match.group(3) is None:
+                if stamp is None:
+                    stamp = b' %d' % time.time_ns()
+                # Without the \r, if any
+                lines.append(body[start:match.end(2) + 1] + stamp)
+            elif error is None:
+                lines.append(view[start:end])
+            else:
+                errors.append((len(lines), error))
+                lines.append(None)
+
+    return lines, errors
+
+
+def _line_spans(body):
+    # (start, end) of the lines of body, newlines in messages included
+    start = 0
+    size = len(body)
+    while start < size:
+        # An unterminated message ends at the next newline
+        end = body.find(b'\n', _LINE_SPAN_RE.match(body, start).end())
+        if end == -1:
+            end = size
+        yield start, end
+        start = end + 1
+
+
+def join(lines, body):
+    """The valid lines, newline separated: body if none was rejected or
+    stamped."""
+
+    if all(isinstance(line, memoryview) for line in lines):
+        return body
+
+    return b'\n'.join(line for line in lines if line is not None)
+
+
+def decode_lines(data):
+    """(message, tags) of the lines of data, which are valid."""
+
+    return [
+        decode(line) for line in iter_lines(data)
+        if line.strip()
+    ]
+
+
+def iter_lines(data):
+    """The lines of data, split on the newlines outside of the messages."""
+
+    for start, end in _line_spans(data):
+        yield data[start:end]
+
+
+def decode(line):
+    """(message, tags) of a valid line, time is an RFC3339 tag."""
+
+    match = _LINE_RE.fullmatch(line)
+    tags = {
+        _unescape_tag(key): _unescape_tag(value)
+        for key, value in _TAG_RE.findall(match.group(1))
+    }
+    if match.group(3) is not None:
+        tags['time'] = storage.format_micros(int(match.group(3))//1000)
+    message = _ESCAPE_RE.sub(
+        lambda m: _MESSAGE_ESCAPES.get(m.group(1), m.group(0)),
+        match.group(2)
+    )
+
+    return message.decode('utf-8', 'replace'), tags
+
+
+def _unescape_tag(value):
+    return _ESCAPE_RE.sub(rb'\1', value).decode('utf-8', 'replace')
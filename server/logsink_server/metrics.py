@@ -0,0 +1,243 @@
+# Prometheus-style metrics, exposed by GET /metrics in the text exposition
+# format. Counters and histograms are plain in-process structures so that
+# updating them costs a few microseconds and they can stay on in production.
+import bisect
+import contextlib
+import logging
+import os
+import threading
+import time
+
+
+# Timing of the request stages (see stage), LOGSINK_METRICS=0 turns it off
+ENABLED = os.environ.get('LOGSINK_METRICS', '1') not in ('', '0')
+# Storage queries slower than this are logged with their InfluxQL
+SLOW_QUERY_SECONDS = float(os.environ.get('LOGSINK_SLOW_QUERY_SECONDS', 1.0))
+
+# Histogram buckets in seconds, from 100 microseconds to 10 seconds
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+logger = logging.getLogger(__name__)
+
+_metrics = []
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _key(self.labels, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_key(self.labels, labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, self.labels, key, value
+
+    def type(self):
+        return 'counter'
+
+
+class Gauge:
+    """Gauge read when the metrics are rendered.
+
+    callback returns a dict of label values tuple -> value."""
+
+    def __init__(self, name, help, labels=(), callback=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.callback = callback
+        _metrics.append(self)
+
+    def samples(self):
+        try:
+            values = self.callback()
+        except Exception:
+            logger.exception('Reading gauge %s failed', self.name)
+            return
+        for key, value in values.items():
+            yield self.name, self.labels, key, value
+
+    def type(self):
+        return 'gauge'
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        self._observe(_key(self.labels, labels), value)
+
+    def _observe(self, key, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0]*(len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """Context manager observing the time spent in its block."""
+
+        return _Timer(self, _key(self.labels, labels))
+
+    def count(self, **labels):
+        counts = self._values.get(_key(self.labels, labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+
+        labels = self.labels + ('le',)
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield self.name + '_bucket', labels, key + (_format(bound),), total
+            yield self.name + '_count', self.labels, key, total
+            yield self.name + '_sum', self.labels, key, counts[-1]
+
+    def type(self):
+        return 'histogram'
+
+
+class _Timer:
+    __slots__ = ('histogram', 'key', 'start')
+
+    def __init__(self, histogram, key):
+        self.histogram = histogram
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram._observe(self.key, time.perf_counter() - self.start)
+
+
+request_latency = Histogram(
+    'logsink_request_duration_seconds',
+    'Duration of the HTTP requests, until the response is sent.',
+    ['handler', 'method', 'status']
+)
+stage_latency = Histogram(
+    'logsink_stage_duration_seconds',
+    'Duration of the stages of request handling.',
+    ['stage']
+)
+bytes_received = Counter(
+    'logsink_received_bytes_total',
+    'Request body bytes received, as sent on the wire.',
+    ['handler']
+)
+bytes_sent = Counter(
+    'logsink_sent_bytes_total',
+    'Response body bytes sent.',
+    ['handler']
+)
+records_ingested = Counter(
+    'logsink_records_ingested_total',
+    'Log records accepted by the API.'
+)
+records_rejected = Counter(
+    'logsink_records_rejected_total',
+    'Log records refused because they were invalid.'
+)
+records_dropped = Counter(
+    'logsink_records_dropped_total',
+    'Valid log records which were not stored.',
+    ['reason']
+)
+requests_limited = Counter(
+    'logsink_requests_limited_total',
+    'Requests refused with a 429 status, per database and limit (records, bytes or queries).',
+    ['database', 'limit']
+)
+
+
+_disabled = contextlib.nullcontext()
+
+
+def stage(name):
+    """Context manager timing a stage of the request handling."""
+
+    if not ENABLED:
+        return _disabled
+    return stage_latency.time(stage=name)
+
+
+@contextlib.contextmanager
+def timed_query(stage_name, query):
+    """Time a storage query, logging it when it's slow."""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if ENABLED:
+            stage_latency.observe(elapsed, stage=stage_name)
+        if elapsed >= SLOW_QUERY_SECONDS:
+            logger.warning('Slow query (%.3fs): %s', elapsed, query)
+
+
+def render():
+    """All the metrics in the Prometheus text format."""
+
+    lines = []
+    for metric in _metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type()))
+        for name, labels, values, value in metric.samples():
+            if labels:
+                lines.append('%s{%s} %s' % (
+                    name,
+                    ','.join('%s="%s"' % (label, _escape(value)) for label, value in zip(labels, values)),
+                    _format(value)
+                ))
+            else:
+                lines.append('%s %s' % (name, _format(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _key(names, labels):
+    return tuple(str(labels.get(name, '')) for name in names)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,145 @@
+# WSGI middlewares of the API server
+import io
+import json
+import os
+import time
+import zlib
+
+from logsink_server import metrics
+
+
+# Max size of a decompressed request body, protects from gzip bombs
+MAX_DECOMPRESSED_SIZE = int(os.environ.get('LOGSINK_MAX_DECOMPRESSED_SIZE', 64*1024*1024))
+
+
+class GzipRequestMiddleware:
+    """Decompresses request bodies sent with Content-Encoding: gzip.
+
+    The application sees the plain body, as if it was sent uncompressed."""
+
+    def __init__(self, app, max_size=MAX_DECOMPRESSED_SIZE):
+        self.app = app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding != 'gzip':
+            return self.app(environ, start_response)
+
+        try:
+            body = gunzip(_read_body(environ), self.max_size)
+        except ValueError as e:
+            return _error(start_response, '400 Bad Request', str(e))
+        except OverflowError:
+            return _error(
+                start_response,
+                '413 Request Entity Too Large',
+                'Decompressed body larger than %d bytes.' % self.max_size
+            )
+
+        environ = dict(environ)
+        del environ['HTTP_CONTENT_ENCODING']
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+
+        return self.app(environ, start_response)
+
+
+class MetricsMiddleware:
+    """Records the duration and body sizes of the requests (see metrics).
+
+    Requests are labelled with their path when it's one of paths, other
+    paths are counted together so that the number of series is bounded."""
+
+    def __init__(self, app, paths):
+        self.app = app
+        self.paths = set(paths)
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        handler = environ.get('PATH_INFO', '').rstrip('/') or '/'
+        if handler not in self.paths:
+            handler = 'other'
+        status = []
+
+        def metrics_start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line.split(' ', 1)[0]]
+            return start_response(status_line, headers, exc_info)
+
+        length = environ.get('CONTENT_LENGTH')
+        if length and length.isdigit():
+            metrics.bytes_received.inc(int(length), handler=handler)
+
+        result = self.app(environ, metrics_start_response)
+
+        # The response may be streamed, it's done once it's closed
+        def finish():
+            metrics.request_latency.observe(
+                time.perf_counter() - start,
+                handler=handler,
+                method=environ.get('REQUEST_METHOD', ''),
+                status=status[0] if status else ''
+            )
+
+        return _CountingIterable(result, handler, finish)
+
+
+class _CountingIterable:
+    def __init__(self, result, handler, finish):
+        self.result = result
+        self.handler = handler
+        self.finish = finish
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.result:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            metrics.bytes_sent.inc(self.size, handler=self.handler)
+            self.finish()
+
+
+def gunzip(data, max_size=MAX_DECOMPRESSED_SIZE):
+    """Decompress a gzip request body.
+
+    Raises ValueError for invalid data and OverflowError when the body is
+    larger than max_size once decompressed."""
+
+    # 16 + MAX_WBITS: gzip header and trailer
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        body = decompressor.decompress(data, max_size + 1)
+    except zlib.error:
+        raise ValueError('Invalid gzip body.')
+    if len(body) > max_size:
+        raise OverflowError()
+    if not decompressor.eof:
+        raise ValueError('Truncated gzip body.')
+
+    return body
+
+
+def _read_body(environ):
+    stream = environ['wsgi.input']
+    length = environ.get('CONTENT_LENGTH')
+    if length:
+        return stream.read(int(length))
+    if environ.get('wsgi.input_terminated'):
+        # Chunked request, the server marks the end of the body
+        return stream.read()
+    return b''
+
+
+def _error(start_response, status, message):
+    body = json.dumps({'error': message}).encode('utf-8')
+    start_response(status, [
+        ('Content-Type', 'application/json'),
+        ('Content-Length', str(len(body))),
+    ])
+    return [body]
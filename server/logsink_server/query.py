@@ -0,0 +1,250 @@
+# Query compiler: turns the query parameters of a request (see
+# storage.ABCStorage.query) into a Query, parsed and validated once, and
+# Query into InfluxQL.
+#
+# compile() memoizes the queries ending at a given time__lte, so the storage
+# methods, the caches and the rollups handling one request share the same
+# Query instead of parsing the time range again. InfluxQL statements are built
+# from templates cached per query shape (which tags are filtered, message,
+# ...), only the escaped values are filled in per query.
+import collections
+import datetime
+import functools
+import os
+import re
+import threading
+
+from dateutil import parser
+import pytz
+
+from logsink_server import storage
+
+
+# Number of compiled queries and InfluxQL templates kept
+COMPILE_CACHE_SIZE = int(os.environ.get('LOGSINK_QUERY_CACHE_SIZE', 1024))
+
+
+class Query(collections.namedtuple('Query', [
+        'time__gte',      # datetime, UTC if the parameter has no timezone
+        'time__lte',      # datetime
+        'time_given',     # True if time__gte or time__lte was given
+        'message',        # message regex or None
+        'tags',           # sorted tuple of (tag, value)
+        'cursor',         # None, or (time, skip) with time None for an empty cursor
+        'page',
+        'per_page',
+        'num_intervals'])):
+    """Normalized query parameters, hashable."""
+
+    __slots__ = ()
+
+    @property
+    def offset(self):
+        # Rows to skip: with a cursor only rows at the cursor time which were
+        # already returned
+        if self.cursor is not None:
+            return self.cursor[1]
+        return (self.page - 1)*self.per_page
+
+    @property
+    def start(self):
+        """Start of the queried rows: time__gte or the cursor time."""
+
+        if self.cursor is not None and self.cursor[0] is not None:
+            return parse_time(self.cursor[0])
+        return self.time__gte
+
+
+def compile(**kwargs):
+    """Compile query parameters, raises ValueError for invalid ones."""
+
+    if 'time__lte' not in kwargs:
+        # The time range ends now, nothing to parse or to reuse
+        return _compile(kwargs)
+
+    try:
+        key = tuple(sorted(kwargs.items()))
+        hash(key)
+    except TypeError:
+        return _compile(kwargs)
+
+    with _lock:
+        query = _compiled.get(key)
+        if query is not None:
+            _compiled.move_to_end(key)
+            return query
+
+    query = _compile(kwargs)
+    with _lock:
+        _compiled[key] = query
+        while len(_compiled) > COMPILE_CACHE_SIZE:
+            _compiled.popitem(last=False)
+
+    return query
+
+
+def _compile(kwargs):
+    if 'time__lte' in kwargs:
+        time__lte = parse_time(kwargs['time__lte'])
+    else:
+        # By default, show last 10 days of data
+        time__lte = storage._utcnow()
+    if 'time__gte' in kwargs:
+        time__gte = parse_time(kwargs['time__gte'])
+    else:
+        time__gte = time__lte - datetime.timedelta(days=storage.DEFAULT_QUERY_DAY_SPAN)
+    if time__lte < time__gte:
+        raise ValueError('Invalid time range.')
+
+    cursor = None
+    if 'cursor' in kwargs:
+        cursor = storage.decode_cursor(kwargs['cursor']) or (None, 0)
+
+    message = kwargs.get('message')
+
+    return Query(
+        time__gte=time__gte,
+        time__lte=time__lte,
+        time_given='time__gte' in kwargs or 'time__lte' in kwargs,
+        message=None if message is None else str(message),
+        tags=tuple(sorted(
+            (tag, str(value)) for tag, value in kwargs.items()
+            if tag not in storage.QUERY_KEYWORDS and tag != 'message'
+        )),
+        cursor=cursor,
+        page=int(kwargs.get('page', 1)),
+        per_page=int(kwargs.get('per_page', storage.DEFAULT_PER_PAGE)),
+        num_intervals=int(kwargs.get('num_intervals', storage.DEFAULT_NUM_INTERVALS)),
+    )
+
+
+_compiled = collections.OrderedDict()  # sorted kwargs items -> Query
+_lock = threading.Lock()
+
+
+def parse_time(value):
+    """Parse a timestamp, ISO-8601 ones without dateutil.
+
+    Timestamps without a timezone are taken as UTC."""
+
+    if isinstance(value, datetime.datetime):
+        result = value
+    else:
+        text = str(value).strip()
+        if text.endswith('Z'):
+            # Not understood by fromisoformat before Python 3.11
+            text = text[:-1] + '+00:00'
+        try:
+            result = datetime.datetime.fromisoformat(text)
+        except ValueError:
+            # Other formats, and more than 6 fractional digits before 3.11
+            result = parser.parse(value)
+
+    if result.tzinfo is None:
+        result = result.replace(tzinfo=pytz.utc)
+
+    return result
+
+
+# InfluxQL
+def quote_identifier(name):
+    return '"%s"' % str(name).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def quote_string(value):
+    return "'%s'" % str(value).replace('\\', '\\\\').replace("'", "\\'")
+
+
+def quote_regex(value):
+    # Only the delimiter needs escaping, the rest is the regex syntax. A
+    # trailing lone backslash would escape the closing delimiter, it's
+    # doubled (a literal backslash).
+    return '/%s/' % _REGEX_DELIMITER_RE.sub(
+        lambda m: m.group(1) or ('\\/' if m.group(0) == '/' else '\\\\'),
+        str(value)
+    )
+
+
+# An escaped character, an unescaped / or a trailing backslash
+_REGEX_DELIMITER_RE = re.compile(r'(\\.)|/|\\\Z', re.DOTALL)
+
+
+def select_logs(query):
+    """SELECT of a page of rows."""
+
+    message = query.message is not None
+    template = _statement_template('select', _tag_names(query), message, True)
+    return template % (_where_params(query, True, message) + (query.per_page, query.offset))
+
+
+def count_logs(query, interval):
+    """COUNT of rows per interval seconds."""
+
+    message = query.message is not None
+    template = _statement_template('count', _tag_names(query), message, True)
+    return template % (_where_params(query, True, message) + (interval,))
+
+
+def delete_logs(query):
+    """DELETE of the matching rows, of all times unless a time bound was given.
+
+    Without time bounds only the tags are filtered."""
+
+    message = query.message is not None and query.time_given
+    template = _statement_template('delete', _tag_names(query), message, query.time_given)
+    return template % _where_params(query, query.time_given, message)
+
+
+def tag_filter(query):
+    """Condition of the tag filters only, '' when there are none."""
+
+    return _where_template(_tag_names(query), False, False) % _where_params(query, False, False)
+
+
+@functools.lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _statement_template(kind, tags, message, with_time):
+    where = _where_template(tags, message, with_time)
+    if kind == 'select':
+        return 'SELECT * FROM logs WHERE %s LIMIT %%d OFFSET %%d;' % where
+    if kind == 'count':
+        return 'SELECT COUNT(*) FROM logs WHERE %s GROUP BY time(%%ds);' % where
+    if kind == 'delete':
+        return 'DELETE FROM logs%s;' % (' WHERE %s' % where if where else '')
+
+    raise ValueError('Unknown statement: %s' % kind)
+
+
+@functools.lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _where_template(tags, message, with_time):
+    # %s placeholders for the values, in the order of _where_params
+    clauses = []
+    if with_time:
+        clauses.append('time >= %s AND time <= %s')
+    if message:
+        clauses.append('"message" =~ %s')
+    for tag in tags:
+        clauses.append('%s = %%s' % quote_identifier(tag).replace('%', '%%'))
+
+    return ' AND '.join(clauses)
+
+
+def _tag_names(query):
+    return tuple(tag for tag, _ in query.tags)
+
+
+def _where_params(query, with_time, message):
+    params = []
+    if with_time:
+        if query.cursor is not None and query.cursor[0] is not None:
+            # Continue from the last row of the previous page
+            params.append(quote_string(query.cursor[0]))
+        else:
+            params.append(quote_string(query.time__gte.isoformat()))
+        # Microseconds are kept: bounds of adjacent windows (e.g. the export
+        # slices) mustn't leave a fraction of a second out
+        params.append(quote_string(query.time__lte.isoformat()))
+    if message:
+        params.append(quote_regex(query.message))
+    params.extend(quote_string(value) for _, value in query.tags)
+
+    return tuple(params)
@@ -0,0 +1,365 @@
+# Retention of the logs, per database.
+#
+# LOGSINK_RETENTION is a JSON object mapping database names ("*" for all the
+# others) to their retention settings:
+#
+#     {"logsink": {"ttl": "7d", "rollups": {"logs_rollup_1m": "30d", "logs_rollup_1h": "730d"}}}
+#
+# ttl is how long the raw logs are kept (the hot tier). rollups is how long
+# the rollup measurements are kept (the cold tiers, see rollup.py), past the
+# ttl histograms are still counted from them. Durations are seconds or a
+# number followed by s, m, h, d or w, null keeps the data forever.
+#
+# InfluxDB expires the data itself: the ttl is set on the default retention
+# policy of the database and each rollup measurement listed gets a retention
+# policy of its own, of the same name. The embedded storage drops its expired
+# partitions from a background thread, see Expirer.
+#
+# Whole time windows are removed by dropping the InfluxDB shards (embedded
+# partitions) which are entirely inside them, instead of deleting their
+# points one by one. See InfluxDBStorage.clear and SegmentStorage.clear. On
+# InfluxDB this requires the rollups to be in retention policies of their
+# own, the points are deleted otherwise.
+import collections
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from logsink_server import query
+from logsink_server import storage
+
+
+RETENTION = os.environ.get('LOGSINK_RETENTION', '')
+# How often the embedded storage looks for expired partitions, in seconds
+EXPIRE_INTERVAL = float(os.environ.get('LOGSINK_EXPIRE_INTERVAL', 60))
+
+HOUR = 3600
+DAY = 24*HOUR
+
+Policy = collections.namedtuple('Policy', [
+    'ttl',      # seconds the raw logs are kept, None for ever
+    'rollups',  # rollup measurement -> seconds it's kept, None for ever
+])
+
+# A time window of stored logs: an InfluxDB shard or an embedded partition.
+# Times are microseconds since epoch, end is excluded and expires is None
+# when the data doesn't expire.
+Shard = collections.namedtuple('Shard', ['id', 'retention_policy', 'start', 'end', 'expires'])
+
+
+logger = logging.getLogger(__name__)
+
+_DURATION_RE = re.compile(r'^(\d+)([smhdw]?)$')
+_UNITS = {'': 1, 's': 1, 'm': 60, 'h': HOUR, 'd': DAY, 'w': 7*DAY}
+# Durations as returned by InfluxDB, e.g. 168h0m0s
+_INFLUXDB_DURATION_RE = re.compile(r'(\d+)([hms])')
+
+
+def parse_duration(value):
+    """Seconds of a duration setting, None for no limit."""
+
+    if value is None:
+        return None
+
+    match = _DURATION_RE.match(str(value).strip())
+    if match is None:
+        raise ValueError('Invalid duration: %r' % value)
+    seconds = int(match.group(1))*_UNITS[match.group(2)]
+    if not seconds:
+        raise ValueError('Invalid duration: %r' % value)
+
+    return seconds
+
+
+def parse_policies(text):
+    """Policy per database name from the LOGSINK_RETENTION JSON."""
+
+    if not text.strip():
+        return {}
+
+    config = json.loads(text)
+    if not isinstance(config, dict):
+        raise ValueError('LOGSINK_RETENTION must be a JSON object.')
+
+    return {
+        dbname: Policy(
+            ttl=parse_duration(settings.get('ttl')),
+            rollups={
+                measurement: parse_duration(ttl)
+                for measurement, ttl in settings.get('rollups', {}).items()
+            }
+        )
+        for dbname, settings in config.items()
+    }
+
+
+policies = parse_policies(RETENTION)
+
+
+def get_policy(dbname):
+    """Policy of the database, None when its data is kept for ever."""
+
+    return policies.get(dbname, policies.get('*'))
+
+
+def as_dict(policy):
+    if policy is None:
+        return None
+
+    return {'ttl': policy.ttl, 'rollups': dict(policy.rollups)}
+
+
+def measurement(dbname, name):
+    """InfluxQL name of a measurement of the database.
+
+    Rollups with a retention setting live in their own retention policy."""
+
+    policy = get_policy(dbname)
+    if policy is not None and name in policy.rollups:
+        return '%s.%s' % (query.quote_identifier(name), query.quote_identifier(name))
+
+    return query.quote_identifier(name)
+
+
+# InfluxDB
+def shard_duration(ttl):
+    """Shard group duration for a retention policy, the InfluxDB defaults.
+
+    Short retentions get small shards so that data is dropped soon after
+    it expires."""
+
+    if ttl is None or ttl > 180*DAY:
+        return 7*DAY
+    if ttl > 2*DAY:
+        return DAY
+    return HOUR
+
+
+def apply_policy(client, dbname, policy):
+    """Create or alter the retention policies of an InfluxDB database."""
+
+    existing = {rp['name']: rp for rp in client.get_list_retention_policies(dbname)}
+
+    for rp in existing.values():
+        if rp['default']:
+            _set_duration(client, dbname, rp, policy.ttl)
+
+    for name, ttl in policy.rollups.items():
+        if name in existing:
+            _set_duration(client, dbname, existing[name], ttl)
+            continue
+        logger.info('Creating retention policy %s on %s', name, dbname)
+        client.query('CREATE RETENTION POLICY %s ON %s DURATION %s REPLICATION 1 SHARD DURATION %ds;' % (
+            query.quote_identifier(name),
+            query.quote_identifier(dbname),
+            _influxdb_duration(ttl),
+            shard_duration(ttl)
+        ))
+
+
+def _set_duration(client, dbname, rp, ttl):
+    if parse_influxdb_duration(rp['duration']) == ttl:
+        return
+
+    logger.info('Setting the duration of retention policy %s on %s to %s', rp['name'], dbname, ttl)
+    client.query('ALTER RETENTION POLICY %s ON %s DURATION %s SHARD DURATION %ds;' % (
+        query.quote_identifier(rp['name']),
+        query.quote_identifier(dbname),
+        _influxdb_duration(ttl),
+        shard_duration(ttl)
+    ))
+
+
+def _influxdb_duration(ttl):
+    return 'INF' if ttl is None else '%ds' % ttl
+
+
+def parse_influxdb_duration(text):
+    """Seconds of a retention policy duration, None for INF (0s)."""
+
+    seconds = sum(
+        int(value)*_UNITS[unit] for value, unit in _INFLUXDB_DURATION_RE.findall(text)
+    )
+
+    return seconds or None
+
+
+def default_policy(client, dbname):
+    """Name of the retention policy the logs are written to."""
+
+    for rp in client.get_list_retention_policies(dbname):
+        if rp['default']:
+            return rp['name']
+
+
+def influxdb_shards(client, dbname):
+    """Shards of the database, ordered by start time."""
+
+    durations = {
+        rp['name']: parse_influxdb_duration(rp['duration'])
+        for rp in client.get_list_retention_policies(dbname)
+    }
+
+    shards = []
+    for row in client.query('SHOW SHARDS;').get_points(measurement=dbname):
+        shards.append(Shard(
+            id=row['id'],
+            retention_policy=row['retention_policy'],
+            start=storage.to_micros(row['start_time']),
+            end=storage.to_micros(row['end_time']),
+            expires=(
+                storage.to_micros(row['expiry_time'])
+                if durations.get(row['retention_policy']) else None
+            )
+        ))
+
+    return sorted(shards, key=lambda shard: shard.start)
+
+
+def influxdb_disk_usage(client, dbname):
+    """Bytes on disk per shard id, from the InfluxDB runtime statistics."""
+
+    usage = {}
+    for (name, tags), rows in client.query('SHOW STATS;').items():
+        if name != 'shard' or not tags or tags.get('database') != dbname:
+            continue
+        for row in rows:
+            usage[int(tags['id'])] = row.get('diskBytes') or 0
+
+    return usage
+
+
+def covered(shards, gte, lte):
+    """Split the shards overlapping [gte, lte] by whether they're inside it.
+
+    Returns (inside, partial): the shards holding only times of the window
+    and the ones also holding times out of it."""
+
+    inside = []
+    partial = []
+    for shard in shards:
+        if shard.end <= gte or shard.start > lte:
+            continue
+        if gte <= shard.start and shard.end - 1 <= lte:
+            inside.append(shard)
+        else:
+            partial.append(shard)
+
+    return inside, partial
+
+
+def drop_window(client, dbname, gte, lte, measurements=()):
+    """Drop the shards of the logs entirely inside [gte, lte].
+
+    measurements are the other measurements of the database, the rollups.
+    The shards are only dropped when they all live in retention policies of
+    their own, the shards of the logs would hold them too.
+
+    Returns False when points of the window are left in other shards, they
+    must be deleted."""
+
+    policy = get_policy(dbname)
+    if any(policy is None or name not in policy.rollups for name in measurements):
+        return False
+
+    rp = default_policy(client, dbname)
+    inside, partial = covered(
+        [shard for shard in influxdb_shards(client, dbname) if shard.retention_policy == rp],
+        gte,
+        lte
+    )
+    for shard in inside:
+        logger.info('Dropping shard %s of %s', shard.id, dbname)
+        client.query('DROP SHARD %d;' % shard.id)
+
+    return not partial
+
+
+# Embedded storage
+class Expirer:
+    """Drops the expired partitions of the embedded storages in use."""
+
+    def __init__(self, interval=EXPIRE_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run,
+            name='logsink-expirer',
+            daemon=True
+        )
+        self._thread.start()
+
+    def close(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def expire(self, db, now=None):
+        policy = get_policy(db.dbname)
+        if policy is None or policy.ttl is None:
+            return
+
+        now = time.time() if now is None else now
+        db.expire(int((now - policy.ttl)*1000000))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for dbname, db in list(storage._storages.items()):
+                if not hasattr(db, 'expire'):
+                    continue
+                try:
+                    self.expire(db)
+                except Exception:
+                    logger.exception('Expiry of %s failed', dbname)
+
+
+expirer = None
+
+
+def enable_expiry(**kwargs):
+    """Drop expired data of the embedded storages in the background.
+
+    kwargs are passed to Expirer."""
+
+    global expirer
+
+    if expirer is None:
+        expirer = Expirer(**kwargs)
+        expirer.start()
+
+    return expirer
+
+
+def status(db):
+    """Disk usage and pending expirations of a storage, see GET /admin/storage."""
+
+    usage = db.usage()  # [(Shard, disk bytes)]
+    pending = sorted(
+        (item for item in usage if item[0].expires is not None),
+        key=lambda item: item[0].expires
+    )
+
+    return {
+        'database': db.dbname,
+        'retention': as_dict(get_policy(db.dbname)),
+        'disk_bytes': sum(disk_bytes for _, disk_bytes in usage),
+        'shards': [_shard_dict(shard, disk_bytes) for shard, disk_bytes in usage],
+        'pending_expirations': [_shard_dict(shard, disk_bytes) for shard, disk_bytes in pending],
+    }
+
+
+def _shard_dict(shard, disk_bytes):
+    return {
+        'id': shard.id,
+        'retention_policy': shard.retention_policy,
+        'start': storage.format_micros(shard.start),
+        'end': storage.format_micros(shard.end),
+        'expires': storage.format_micros(shard.expires) if shard.expires is not None else None,
+        'disk_bytes': disk_bytes,
+    }
@@ -0,0 +1,376 @@
+# Pre-aggregated counts of the logs of InfluxDB databases.
+#
+# Rollup measurements hold the number of logs per period (a minute, an hour)
+# and per value of the ROLLUP_TAGS. A background Downsampler fills them with
+# SELECT ... INTO queries once the periods are over. Long-range histograms
+# then sum a few rollup points per interval instead of counting all the raw
+# points, only the ragged edges of the window are counted from the raw points.
+#
+# Only the InfluxDB storages of storage.get_storage are rolled up: sharded
+# storages (see sharding.py) and the embedded storage always count the raw
+# points.
+#
+# What is rolled up is kept in memory by the process (see RollupState), only
+# one server process may roll up a database: the late writes and clears of
+# the others would not be rolled up again.
+import collections
+import logging
+import math
+import os
+import threading
+import time
+
+from logsink_server import query
+from logsink_server import retention
+from logsink_server import storage
+
+
+# Tags the rollups are split by. Histograms filtered by other tags (or by
+# message) are counted from the raw points.
+ROLLUP_TAGS = [
+    tag.strip() for tag in os.environ.get('LOGSINK_ROLLUP_TAGS', 'client_name').split(',')
+    if tag.strip()
+]
+DOWNSAMPLE_INTERVAL = float(os.environ.get('LOGSINK_ROLLUP_INTERVAL', 30))  # seconds
+# Periods are rolled up this many seconds after their end, when late writes
+# have settled. Later writes are handled too but cost a re-rollup.
+SEAL_DELAY = 60
+MAX_PERIODS_PER_QUERY = 1440  # max number of periods rolled up by one query
+# Histogram intervals at least this many periods long are rounded to a
+# multiple of the period so that the rollup can be used
+ALIGN_MIN_PERIODS = 10
+
+Rollup = collections.namedtuple('Rollup', ['measurement', 'period'])
+
+# From the finest to the coarsest, each one is computed from the previous one
+ROLLUPS = [
+    Rollup('logs_rollup_1m', 60),
+    Rollup('logs_rollup_1h', 3600),
+]
+
+
+logger = logging.getLogger(__name__)
+
+
+class RollupState:
+    """What is rolled up in one rollup measurement of one database.
+
+    Kept in memory only, it's found again from the rollup at startup. All
+    the periods before watermark are rolled up, except for the dirty
+    ranges (written to or cleared after they were rolled up). The periods
+    before horizon are being rolled up or are rolled up already."""
+
+    def __init__(self, watermark):
+        self.watermark = watermark
+        self.horizon = watermark
+        self.dirty = []  # sorted, disjoint (start, end) ranges
+        self.rolling = []  # dirty ranges being rolled up again
+        self.reset = False  # everything must be rolled up again
+
+    def covers(self, start, end):
+        if self.reset or end > self.watermark:
+            return False
+        return not any(
+            range_start < end and start < range_end
+            for range_start, range_end in self.dirty + self.rolling
+        )
+
+    def invalidate(self, start, end):
+        end = min(end, self.horizon)
+        if start < end:
+            _add_range(self.dirty, start, end)
+
+
+class Downsampler:
+    """Keeps the rollup measurements of the InfluxDB storages up to date.
+
+    The storages in use (see storage.get_storage) are rolled up every
+    interval seconds by a background thread. Late writes and clears made by
+    this process are rolled up again."""
+
+    def __init__(
+            self,
+            rollups=ROLLUPS,
+            tags=ROLLUP_TAGS,
+            interval=DOWNSAMPLE_INTERVAL,
+            seal_delay=SEAL_DELAY):
+        self.rollups = rollups
+        self.tags = tags
+        self.interval = interval
+        self.seal_delay = seal_delay
+
+        self._lock = threading.Lock()
+        self._states = {}  # dbname -> {measurement: RollupState}
+        self._stop = threading.Event()
+        self._thread = None
+
+        storage.add_insert_listener(self._inserted)
+        storage.add_clear_listener(self._cleared)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run,
+            name='logsink-downsampler',
+            daemon=True
+        )
+        self._thread.start()
+
+    def close(self, timeout=None):
+        storage.remove_listener(self._inserted)
+        storage.remove_listener(self._cleared)
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def as_dict(self, dbname=None):
+        # Watermarks per database, only the ones of dbname when given
+        with self._lock:
+            return {
+                name: {
+                    measurement: _format(state.watermark)
+                    for measurement, state in states.items()
+                }
+                for name, states in self._states.items()
+                if dbname in (None, name)
+            }
+
+    def align_interval(self, interval):
+        """Histogram interval rounded so that a rollup can be used."""
+
+        for rollup in reversed(self.rollups):
+            if interval >= rollup.period*ALIGN_MIN_PERIODS:
+                return interval - interval % rollup.period
+
+        return interval
+
+    def plan(self, dbname, interval, gte, lte, **kwargs):
+        """How to count a histogram: (rollup, start, end) or None.
+
+        gte and lte are seconds since epoch, with a fraction. The counts in
+        [start, end) are read from the rollup, the ones in [gte, start) and
+        [end, lte] from the raw points. None means that all counts must be
+        read from the raw points."""
+
+        if 'message' in kwargs:
+            return None
+        tags = set(kwargs) - set(storage.QUERY_KEYWORDS)
+        if not tags.issubset(self.tags):
+            return None
+
+        with self._lock:
+            states = self._states.get(dbname, {})
+            # The coarsest rollup means the fewest points to read
+            for rollup in reversed(self.rollups):
+                state = states.get(rollup.measurement)
+                if state is None or interval % rollup.period:
+                    continue
+
+                start = math.ceil(gte/rollup.period)*rollup.period
+                end = min(
+                    math.floor(lte/rollup.period)*rollup.period,
+                    state.watermark
+                )
+                if start < end and state.covers(start, end):
+                    return rollup, start, end
+
+        return None
+
+    def histogram(self, db, interval, **kwargs):
+        """Same as db.histogram(interval, **kwargs) using the rollups.
+
+        Returns None when the rollups can't be used."""
+
+        compiled = query.compile(**kwargs)
+        # The bounds of query.count_logs, to the microsecond
+        gte = storage.to_micros(compiled.time__gte)
+        lte = storage.to_micros(compiled.time__lte)
+
+        plan = self.plan(db.dbname, interval, gte/1000000, lte/1000000, **kwargs)
+        if plan is None:
+            return None
+        rollup, start, end = plan
+
+        tag_filter = query.tag_filter(compiled)
+        counts = collections.Counter()
+
+        def count(select, measurement, where):
+            if tag_filter:
+                where = '%s AND %s' % (where, tag_filter)
+            rows = db._query(
+                'SELECT %s AS "count" FROM %s WHERE %s GROUP BY time(%ss);'
+                % (select, retention.measurement(db.dbname, measurement), where, interval)
+            ).get_points()
+            for row in rows:
+                counts[storage.to_micros(row['time'])] += row['count'] or 0
+
+        if gte < start*1000000:
+            count(
+                'COUNT(message)', 'logs',
+                "time >= '%s' AND time < '%s'" % (storage.format_micros(gte), _format(start))
+            )
+        count('SUM("count")', rollup.measurement, _time_where(start, end))
+        if end*1000000 <= lte:
+            count(
+                'COUNT(message)', 'logs',
+                "time >= '%s' AND time <= '%s'" % (_format(end), storage.format_micros(lte))
+            )
+
+        step = interval*1000000
+        return [
+            {
+                'time': storage.format_micros(micros),
+                'count_message': counts[micros],
+            }
+            for micros in range(gte//step*step, lte + 1, step)
+        ]
+
+    def downsample(self, db):
+        """Roll up what is due in the rollups of the storage."""
+
+        now = time.time()
+        source = None
+        for rollup in self.rollups:
+            with self._lock:
+                state = self._states.get(db.dbname, {}).get(rollup.measurement)
+
+            if state is None or state.reset:
+                if state is not None:
+                    # DELETE applies to all the retention policies
+                    db._query('DELETE FROM "%s";' % rollup.measurement)
+                state = RollupState(self._first_period(db, rollup))
+                with self._lock:
+                    self._states.setdefault(db.dbname, {})[rollup.measurement] = state
+
+            # Late writes and clears
+            with self._lock:
+                state.rolling, state.dirty = state.dirty, []
+            for start, end in state.rolling:
+                db._query(
+                    'DELETE FROM "%s" WHERE %s;'
+                    % (rollup.measurement, _time_where(start, end))
+                )
+                self._roll_up(db, rollup, source, start, end)
+            with self._lock:
+                state.rolling = []
+
+            # New periods, only once they are rolled up in the source
+            sealed = math.floor((now - self.seal_delay)/rollup.period)*rollup.period
+            if source is not None:
+                source_state = self._states[db.dbname][source.measurement]
+                sealed = min(
+                    sealed,
+                    source_state.watermark//rollup.period*rollup.period
+                )
+            while state.watermark < sealed:
+                end = min(sealed, state.watermark + rollup.period*MAX_PERIODS_PER_QUERY)
+                with self._lock:
+                    state.horizon = end
+                self._roll_up(db, rollup, source, state.watermark, end)
+                with self._lock:
+                    state.watermark = end
+
+            source = rollup
+
+    def _roll_up(self, db, rollup, source, start, end):
+        if source is None:
+            select = 'COUNT(message)'
+            group_by = ', '.join('"%s"' % tag for tag in self.tags)
+            measurement = 'logs'
+        else:
+            select = 'SUM("count")'
+            group_by = '*'
+            measurement = source.measurement
+        if group_by:
+            group_by = ', ' + group_by
+
+        db._query(
+            'SELECT %s AS "count" INTO %s FROM %s WHERE %s '
+            'GROUP BY time(%ss)%s fill(none);'
+            % (select, retention.measurement(db.dbname, rollup.measurement),
+               retention.measurement(db.dbname, measurement), _time_where(start, end),
+               rollup.period, group_by)
+        )
+
+    def _first_period(self, db, rollup):
+        # Start of the first period which may not be rolled up
+        last = list(db._query(
+            'SELECT LAST("count") FROM %s;' % retention.measurement(db.dbname, rollup.measurement)
+        ).get_points())
+        if last:
+            return storage.to_micros(last[0]['time'])//1000000 + rollup.period
+
+        first = list(db._query('SELECT FIRST(message) FROM logs;').get_points())
+        if first:
+            timestamp = storage.to_micros(first[0]['time'])//1000000
+        else:
+            timestamp = int(time.time())
+
+        return timestamp//rollup.period*rollup.period
+
+    def _inserted(self, dbname, records):
+        with self._lock:
+            for measurement, state in self._states.get(dbname, {}).items():
+                period = _period(self.rollups, measurement)
+                for record in records:
+                    timestamp = record.time.timestamp()
+                    if timestamp < state.horizon:
+                        start = math.floor(timestamp/period)*period
+                        state.invalidate(start, start + period)
+
+    def _cleared(self, dbname, kwargs):
+        if 'time__lte' not in kwargs and 'time__gte' not in kwargs:
+            with self._lock:
+                for state in self._states.get(dbname, {}).values():
+                    state.reset = True
+            return
+
+        compiled = query.compile(**kwargs)
+        time__gte, time__lte = compiled.time__gte, compiled.time__lte
+        with self._lock:
+            for measurement, state in self._states.get(dbname, {}).items():
+                period = _period(self.rollups, measurement)
+                state.invalidate(
+                    math.floor(time__gte.timestamp()/period)*period,
+                    (math.floor(time__lte.timestamp()/period) + 1)*period
+                )
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for dbname, db in list(storage._storages.items()):
+                # Not the shards of sharded storages: they have the same
+                # database name and their writes aren't told apart
+                if not isinstance(db, storage.InfluxDBStorage):
+                    continue
+                try:
+                    self.downsample(db)
+                except Exception:
+                    logger.exception('Downsampling of %s failed', dbname)
+
+
+def _period(rollups, measurement):
+    for rollup in rollups:
+        if rollup.measurement == measurement:
+            return rollup.period
+
+
+def _format(timestamp):
+    return storage.format_micros(timestamp*1000000)
+
+
+def _time_where(start, end):
+    # start and end are seconds since epoch, end is excluded
+    return "time >= '%s' AND time < '%s'" % (_format(start), _format(end))
+
+
+def _add_range(ranges, start, end):
+    # Add [start, end) to the sorted disjoint ranges, merging as needed
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end < start or end < range_start:
+            merged.append((range_start, range_end))
+        else:
+            start = min(start, range_start)
+            end = max(end, range_end)
+    merged.append((start, end))
+    ranges[:] = sorted(merged)
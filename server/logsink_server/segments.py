@@ -0,0 +1,613 @@
+# Embedded on-disk storage, for nodes without InfluxDB.
+#
+# Log records are appended to segment files, one JSON object per line.
+# Segments are grouped in partitions, each one holding the records of
+# partition_seconds of time:
+#
+#     <data_dir>/<dbname>/<partition start, epoch seconds>/<sequence number>.seg
+#
+# The min/max time of every segment is kept in memory so that queries only
+# read the segments overlapping the requested time range. Segments are read
+# through mmap.
+#
+# Optionally, indexes are kept per partition (see index.py): a trigram
+# index of the messages, so that message searches only run the regex on the
+# records which may match, and posting lists of the records with each tag
+# value.
+import collections
+import datetime
+import itertools
+import json
+import mmap
+import os
+import shutil
+import threading
+
+from logsink_server import index
+from logsink_server import lineprotocol
+from logsink_server import query
+from logsink_server import retention
+from logsink_server import storage
+
+
+PARTITION_SECONDS = 3600
+SEGMENT_MAX_BYTES = 64*1024*1024  # a new segment is started past this size
+MAX_OPEN_SEGMENTS = 16  # max number of segment files kept open for appending
+SEGMENT_SUFFIX = '.seg'
+MESSAGE_INDEX = os.environ.get('LOGSINK_MESSAGE_INDEX', '') not in ('', '0')
+TAG_INDEX = os.environ.get('LOGSINK_TAG_INDEX', '') not in ('', '0')
+
+
+class Segment:
+    def __init__(self, path, seq):
+        self.path = path
+        self.seq = seq
+        self.size = 0
+        self.count = 0
+        self.min_time = None
+        self.max_time = None
+        self._view = None
+
+    @classmethod
+    def load(cls, path, seq, add=None):
+        """Load the segment from path.
+
+        add(record, seq, offset) is called for each record of the segment."""
+
+        segment = cls(path, seq)
+
+        size = os.path.getsize(path)
+        if size:
+            with open(path, 'rb') as f:
+                view = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            # Drop a partially written last record
+            end = view.rfind(b'\n') + 1
+            if end < size:
+                del view
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+                size = end
+
+        segment.size = size
+        for offset, record in segment.records(size):
+            segment.add(record['t'], 0)
+            if add is not None:
+                add(record, seq, offset)
+
+        return segment
+
+    def add(self, time, size):
+        self.size += size
+        self.count += 1
+        if self.min_time is None or time < self.min_time:
+            self.min_time = time
+        if self.max_time is None or time > self.max_time:
+            self.max_time = time
+
+    def overlaps(self, gte, lte):
+        return self.count and self.min_time <= lte and self.max_time >= gte
+
+    def view(self, size):
+        """Read-only mmap of (at least) the first size bytes."""
+
+        view = self._view
+        if view is None or len(view) < size:
+            with open(self.path, 'rb') as f:
+                view = self._view = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+        return view
+
+    def detach(self):
+        """Map the whole segment before its file is replaced or removed.
+
+        Readers holding the segment keep reading the old file, they don't
+        open its path again."""
+
+        if self.size:
+            self.view(self.size)
+
+    def lines(self, size):
+        """Yield (offset, raw line) of the records in the first size bytes."""
+
+        if not size:
+            return
+
+        view = self.view(size)
+        offset = 0
+        while offset < size:
+            end = view.find(b'\n', offset, size)
+            yield offset, view[offset:end + 1]
+            offset = end + 1
+
+    def records(self, size):
+        """Yield (offset, record) of the records in the first size bytes."""
+
+        for offset, line in self.lines(size):
+            yield offset, json.loads(line.decode('utf-8'))
+
+    def record(self, offset, size):
+        view = self.view(size)
+        end = view.find(b'\n', offset, size)
+
+        return json.loads(view[offset:end].decode('utf-8'))
+
+
+class Partition:
+    def __init__(self, path, start, new_index=None):
+        self.path = path
+        self.start = start  # seconds since epoch
+        self.segments = []  # ordered by sequence number
+        self.new_index = new_index
+        self.index = new_index() if new_index is not None else None
+
+    def reindex(self):
+        if self.index is None:
+            return
+
+        self.index = self.new_index()
+        for segment in self.segments:
+            for offset, record in segment.records(segment.size):
+                self.index.add(record, segment.seq, offset)
+
+    def new_segment(self):
+        seq = self.segments[-1].seq + 1 if self.segments else 0
+        segment = Segment(
+            os.path.join(self.path, '%08d%s' % (seq, SEGMENT_SUFFIX)),
+            seq
+        )
+        self.segments.append(segment)
+
+        return segment
+
+
+class SegmentStorage:
+    """Append-only storage in local segment files, time partitioned."""
+
+    def __init__(
+            self,
+            dbname,
+            data_dir=None,
+            partition_seconds=PARTITION_SECONDS,
+            segment_max_bytes=SEGMENT_MAX_BYTES,
+            message_index=MESSAGE_INDEX,
+            tag_index=TAG_INDEX):
+        self.dbname = dbname
+        self.path = os.path.join(data_dir or storage.DATA_DIR, dbname)
+        self.partition_seconds = partition_seconds
+        self.segment_max_bytes = segment_max_bytes
+        self.message_index = message_index
+        self.tag_index = tag_index
+
+        self._lock = threading.RLock()
+        self._partitions = {}  # start -> Partition
+        self._writers = collections.OrderedDict()  # segment path -> file, LRU
+
+        os.makedirs(self.path, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        for name in os.listdir(self.path):
+            if not name.isdigit():
+                continue
+
+            partition = Partition(
+                os.path.join(self.path, name),
+                int(name),
+                self._index_factory()
+            )
+            add = partition.index.add if partition.index is not None else None
+            for segment_name in sorted(os.listdir(partition.path)):
+                segment_path = os.path.join(partition.path, segment_name)
+                if not segment_name.endswith(SEGMENT_SUFFIX):
+                    # Leftover of an interrupted rewrite
+                    os.remove(segment_path)
+                    continue
+                seq = int(segment_name[:-len(SEGMENT_SUFFIX)])
+                partition.segments.append(Segment.load(segment_path, seq, add))
+
+            self._partitions[partition.start] = partition
+
+    def _index_factory(self):
+        if not self.message_index and not self.tag_index:
+            return None
+
+        return lambda: index.PartitionIndex(
+            messages=self.message_index,
+            tags=self.tag_index
+        )
+
+    def close(self):
+        with self._lock:
+            for f in self._writers.values():
+                f.close()
+            self._writers.clear()
+
+    def insert(self, message, **kwargs):
+        errors = self.insert_many([(message, kwargs)])
+        if errors:
+            raise ValueError(errors[0][1])
+
+    def insert_many(self, records):
+        errors = []
+        lines = []
+        for i, (message, tags) in enumerate(records):
+            try:
+                lines.append(_record(message, tags))
+            except ValueError as e:
+                errors.append((i, str(e)))
+
+        with self._lock:
+            written = set()
+            for record, line in lines:
+                partition, segment = self._active_segment(record['t'])
+                f = self._writer(segment)
+                if partition.index is not None:
+                    partition.index.add(record, segment.seq, segment.size)
+                f.write(line)
+                segment.add(record['t'], len(line))
+                written.add(f)
+
+            # Readers only see the records once they are flushed, segment
+            # sizes are read under the lock too
+            for f in written:
+                # Writers evicted from the LRU were flushed when closed
+                if not f.closed:
+                    f.flush()
+
+        if storage._insert_listeners and lines:
+            storage._notify_insert(
+                self.dbname,
+                [
+                    storage.Record(
+                        storage.EPOCH + datetime.timedelta(microseconds=record['t']),
+                        record['m'],
+                        record['g']
+                    )
+                    for record, _ in lines
+                ]
+            )
+
+        return errors
+
+    def insert_lines(self, data):
+        return self.insert_many(lineprotocol.decode_lines(data))
+
+    def query(self, **kwargs):
+        gte, lte = self._time_range(**kwargs)
+        matches = Filter(**kwargs)
+
+        per_page = int(kwargs.get('per_page', storage.DEFAULT_PER_PAGE))
+        if 'cursor' in kwargs:
+            cursor = storage.decode_cursor(kwargs['cursor'])
+            offset = cursor[1] if cursor is not None else 0
+        else:
+            offset = (int(kwargs.get('page', 1)) - 1)*per_page
+
+        records = itertools.islice(
+            self._scan(gte, lte, matches, ordered=True),
+            offset,
+            offset + per_page
+        )
+
+        return (_row(record) for record in records)
+
+    def aggregated(self, **kwargs):
+        interval = storage.histogram_interval(**kwargs)
+        kwargs.pop('num_intervals', None)
+
+        return self.histogram(interval, **kwargs)
+
+    def histogram(self, interval, **kwargs):
+        gte, lte = self._time_range(**kwargs)
+        matches = Filter(**kwargs)
+
+        # Buckets are aligned to epoch, like InfluxDB's GROUP BY time(). Only
+        # the non-empty ones are counted, there may be many more intervals
+        # than records.
+        step = interval*1000000
+        counts = collections.Counter(
+            record['t'] // step for record in self._scan(gte, lte, matches)
+        )
+
+        return (
+            {
+                'time': storage.format_micros(bucket*step),
+                'count_message': counts[bucket],
+            }
+            for bucket in range(gte // step, lte // step + 1)
+        )
+
+    def tag_keys(self, **kwargs):
+        gte, lte = self._time_range(**kwargs)
+        matches = Filter(**kwargs)
+
+        keys = set()
+        for segments, partition_index, count in self._snapshot(gte, lte):
+            if partition_index is not None and partition_index.tags is not None:
+                # The tags of the whole partition are indexed
+                with self._lock:
+                    keys.update(tag for tag, _ in partition_index.tags)
+                continue
+            for _, _, record in self._records(segments, partition_index, count, matches):
+                if gte <= record['t'] <= lte and matches(record):
+                    keys.update(record['g'])
+
+        return sorted(keys)
+
+    def clear(self, **kwargs):
+        if 'time__lte' not in kwargs and 'time__gte' not in kwargs:
+            # Clear all time intervals (don't apply the DEFAULT_QUERY_DAY_SPAN)
+            gte, lte = float('-inf'), float('inf')
+        else:
+            gte, lte = self._time_range(**kwargs)
+        matches = Filter(**kwargs)
+        whole = not matches.tags and matches.message is None
+
+        with self._lock:
+            for partition in self._overlapping_partitions(gte, lte):
+                if whole and gte <= partition.start*1000000 and self._partition_end(partition) - 1 <= lte:
+                    # All the records of the partition are removed
+                    self._drop_partition(partition)
+                    continue
+
+                # Only the segments holding candidates need to be rewritten
+                numbers = matches.candidates(partition.index)
+                if numbers is not None:
+                    seqs = {partition.index.location(number)[0] for number in numbers}
+
+                for segment in list(partition.segments):
+                    if numbers is not None and segment.seq not in seqs:
+                        continue
+                    if segment.overlaps(gte, lte):
+                        self._clear_segment(partition, segment, gte, lte, matches)
+
+                if not partition.segments:
+                    os.rmdir(partition.path)
+                    del self._partitions[partition.start]
+                elif len(partition.index or ()) != sum(segment.count for segment in partition.segments):
+                    # Records were removed, their numbers and offsets changed
+                    partition.reindex()
+
+        storage._notify_clear(self.dbname, kwargs)
+
+    def expire(self, before):
+        """Drop the partitions which only hold records older than before.
+
+        before is in microseconds since epoch."""
+
+        with self._lock:
+            expired = [
+                partition for partition in self._partitions.values()
+                if self._partition_end(partition) <= before
+            ]
+            for partition in expired:
+                self._drop_partition(partition)
+
+        if expired:
+            storage._notify_clear(self.dbname, {
+                'time__gte': storage.format_micros(min(partition.start for partition in expired)*1000000),
+                'time__lte': storage.format_micros(max(self._partition_end(partition) for partition in expired) - 1),
+            })
+
+    def usage(self):
+        """(retention.Shard, bytes on disk) of the partitions."""
+
+        policy = retention.get_policy(self.dbname)
+        ttl = policy.ttl if policy is not None else None
+
+        with self._lock:
+            partitions = sorted(self._partitions.values(), key=lambda partition: partition.start)
+            sizes = [sum(segment.size for segment in partition.segments) for partition in partitions]
+
+        return [
+            (
+                retention.Shard(
+                    id=partition.start,
+                    retention_policy=None,
+                    start=partition.start*1000000,
+                    end=self._partition_end(partition),
+                    expires=self._partition_end(partition) + ttl*1000000 if ttl is not None else None
+                ),
+                size
+            )
+            for partition, size in zip(partitions, sizes)
+        ]
+
+    def _drop_partition(self, partition):
+        for segment in partition.segments:
+            writer = self._writers.pop(segment.path, None)
+            if writer is not None:
+                writer.close()
+            # Readers keep reading the unlinked files
+            segment.detach()
+        shutil.rmtree(partition.path)
+        del self._partitions[partition.start]
+
+    def _partition_end(self, partition):
+        # Excluded, in microseconds
+        return (partition.start + self.partition_seconds)*1000000
+
+    def _clear_segment(self, partition, segment, gte, lte, matches):
+        kept = Segment(segment.path, segment.seq)
+        lines = []
+        for _, line in segment.lines(segment.size):
+            record = json.loads(line.decode('utf-8'))
+            if gte <= record['t'] <= lte and matches(record):
+                continue
+            lines.append(line)
+            kept.add(record['t'], len(line))
+
+        if kept.count == segment.count:
+            return
+
+        writer = self._writers.pop(segment.path, None)
+        if writer is not None:
+            writer.close()
+
+        # Segments are append-only, write a new one in place of the old one.
+        # Readers still holding the old one keep reading the old file.
+        segment.detach()
+        index = partition.segments.index(segment)
+        if not lines:
+            os.remove(segment.path)
+            del partition.segments[index]
+            return
+
+        tmp_path = segment.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, segment.path)
+        partition.segments[index] = kept
+
+    def _time_range(self, **kwargs):
+        # Time range in microseconds, from the cursor if there is one
+        compiled = query.compile(**kwargs)
+
+        return storage.to_micros(compiled.start), storage.to_micros(compiled.time__lte)
+
+    def _partition_start(self, time):
+        return time // (self.partition_seconds*1000000) * self.partition_seconds
+
+    def _active_segment(self, time):
+        start = self._partition_start(time)
+        partition = self._partitions.get(start)
+        if partition is None:
+            partition = Partition(
+                os.path.join(self.path, str(start)),
+                start,
+                self._index_factory()
+            )
+            os.makedirs(partition.path, exist_ok=True)
+            self._partitions[start] = partition
+
+        if not partition.segments or partition.segments[-1].size >= self.segment_max_bytes:
+            return partition, partition.new_segment()
+
+        return partition, partition.segments[-1]
+
+    def _writer(self, segment):
+        f = self._writers.pop(segment.path, None)
+        if f is None:
+            f = open(segment.path, 'ab')
+        self._writers[segment.path] = f
+
+        while len(self._writers) > MAX_OPEN_SEGMENTS:
+            _, oldest = self._writers.popitem(last=False)
+            oldest.close()
+
+        return f
+
+    def _overlapping_partitions(self, gte, lte):
+        span = self.partition_seconds*1000000
+
+        return sorted(
+            (
+                partition for partition in self._partitions.values()
+                if partition.start*1000000 <= lte and (partition.start*1000000 + span) > gte
+            ),
+            key=lambda partition: partition.start
+        )
+
+    def _snapshot(self, gte, lte):
+        # For each partition to read: the segments along with their current
+        # size, the index and the number of indexed records
+        with self._lock:
+            return [
+                (
+                    [
+                        (segment, segment.size) for segment in partition.segments
+                        if segment.overlaps(gte, lte)
+                    ],
+                    partition.index,
+                    len(partition.index or ()),
+                )
+                for partition in self._overlapping_partitions(gte, lte)
+            ]
+
+    def _records(self, segments, partition_index, count, matches):
+        # Yield (seq, offset, record) of the records of a partition, only the
+        # ones which may match when the index can tell
+        numbers = matches.candidates(partition_index)
+
+        if numbers is None:
+            for segment, size in segments:
+                for offset, record in segment.records(size):
+                    yield segment.seq, offset, record
+            return
+
+        segments = {segment.seq: (segment, size) for segment, size in segments}
+        for number in numbers:
+            if number >= count:
+                # Inserted after the snapshot
+                break
+            seq, offset = partition_index.location(number)
+            if seq in segments:
+                segment, size = segments[seq]
+                yield seq, offset, segment.record(offset, size)
+
+    def _scan(self, gte, lte, matches, ordered=False):
+        """Yield the records in [gte, lte] accepted by the Filter matches.
+
+        With ordered=True records are yielded by time, records with the same
+        time in the order of insertion."""
+
+        for segments, partition_index, count in self._snapshot(gte, lte):
+            # Partitions don't overlap so it's enough to sort each one
+            found = []
+            for seq, offset, record in self._records(segments, partition_index, count, matches):
+                if gte <= record['t'] <= lte and matches(record):
+                    if not ordered:
+                        yield record
+                        continue
+                    found.append((record['t'], seq, offset, record))
+
+            found.sort(key=lambda item: item[:3])
+            for item in found:
+                yield item[3]
+
+
+storage.ABCStorage.register(SegmentStorage)
+
+
+def _record(message, tags):
+    # Returns the record and its encoded form
+    storage._check_tags(tags)
+
+    tags = dict(tags)
+    time = tags.pop('time', None)
+    time = storage.to_micros(time) if time is not None else storage.to_micros(storage._utcnow())
+
+    record = {
+        't': time,
+        'm': str(message),
+        # Tags are strings, just like in InfluxDB
+        'g': {tag: str(value) for tag, value in tags.items() if value is not None},
+    }
+    line = json.dumps(record, separators=(',', ':'))
+
+    return record, line.encode('utf-8') + b'\n'
+
+
+def _row(record):
+    row = dict(record['g'])
+    row['time'] = storage.format_micros(record['t'])
+    row['message'] = record['m']
+
+    return row
+
+
+class Filter(storage.Filters):
+    """storage.Filters of the records of the segment files."""
+
+    def __call__(self, record):
+        return self.match(record['m'], record['g'])
+
+    def candidates(self, partition_index):
+        """Numbers of the records of the partition which may match.
+
+        None if all the records may match."""
+
+        if partition_index is None:
+            return None
+
+        return partition_index.candidates(self.tags, self.message)
@@ -0,0 +1,280 @@
+# Storage spread over several shards: InfluxDB nodes or embedded data
+# directories.
+#
+# LOGSINK_SHARDS is a JSON list of the shards, the settings of each one are
+# passed to the storage backend (see LOGSINK_STORAGE). For InfluxDB:
+#
+#     [{"host": "influxdb-1"}, {"host": "influxdb-2", "port": 8087}]
+#
+# and for the embedded storage:
+#
+#     [{"data_dir": "/mnt/disk1/logsink"}, {"data_dir": "/mnt/disk2/logsink"}]
+#
+# Every database of logsink is stored on all the shards. A log message goes
+# to one shard, chosen by the crc32 of its LOGSINK_SHARD_BY tag (client_name
+# by default), or by its time when LOGSINK_SHARD_BY is "time": the time is cut
+# in periods of LOGSINK_SHARD_SECONDS, assigned to the shards in turn.
+#
+# Queries, histograms and clears run on the shards concurrently, only on the
+# ones which can hold matching logs. Query rows are merged on time, histogram
+# counts summed per interval.
+import concurrent.futures
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import zlib
+
+from logsink_server import query
+from logsink_server import storage
+
+
+SHARDS = json.loads(os.environ.get('LOGSINK_SHARDS', '') or '[]')
+SHARD_BY = os.environ.get('LOGSINK_SHARD_BY', 'client_name')  # a tag, or "time"
+SHARD_SECONDS = int(os.environ.get('LOGSINK_SHARD_SECONDS', 24*3600))
+# Threads running the shard requests, shared by all the sharded storages
+FANOUT_THREADS = int(os.environ.get('LOGSINK_FANOUT_THREADS', 32))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _fan_out(fn, shards):
+    """[fn(shard) for shard in shards], run concurrently."""
+
+    global _executor
+
+    if len(shards) == 1:
+        return [fn(shards[0])]
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=FANOUT_THREADS,
+                    thread_name_prefix='logsink-fanout'
+                )
+
+    return list(_executor.map(fn, shards))
+
+
+def _time_key(row):
+    # RFC3339 times sort as strings once their fractions of a second are
+    # padded: '...:00Z' comes after '...:00.5Z' otherwise
+    time = row['time']
+    return time[:19], time[20:-1].ljust(9, '0')
+
+
+class ShardedStorage:
+    """Storage of a database spread over several storages (the shards)."""
+
+    def __init__(self, dbname, shards=None, shard_by=SHARD_BY, shard_seconds=SHARD_SECONDS):
+        self.dbname = dbname
+        if shards is None:
+            backend = storage._single_backend()
+            shards = [backend(dbname, **settings) for settings in SHARDS]
+        if not shards:
+            raise ValueError('A sharded storage needs at least one shard.')
+        self.shards = shards
+        self.shard_by = shard_by
+        self.shard_seconds = shard_seconds
+
+    def close(self):
+        for shard in self.shards:
+            if hasattr(shard, 'close'):
+                shard.close()
+
+    def shard_index(self, tags):
+        """Index of the shard a message with tags goes to."""
+
+        if self.shard_by == 'time':
+            micros = storage.to_micros(tags['time']) if 'time' in tags else int(time.time()*1000000)
+            return micros//(self.shard_seconds*1000000) % len(self.shards)
+
+        value = str(tags.get(self.shard_by, ''))
+        return zlib.crc32(value.encode('utf-8')) % len(self.shards)
+
+    def insert(self, message, **kwargs):
+        if self.shard_by == 'time':
+            # The shard is chosen by the time the message is stored with
+            kwargs.setdefault('time', storage.format_micros(int(time.time()*1000000)))
+        self.shards[self._route(kwargs)].insert(message, **kwargs)
+
+    def insert_many(self, records):
+        groups = {}  # shard index -> [(index, record)]
+        for index, (message, tags) in enumerate(records):
+            if self.shard_by == 'time' and 'time' not in tags:
+                tags = dict(tags, time=storage.format_micros(int(time.time()*1000000)))
+            groups.setdefault(self._route(tags), []).append((index, (message, tags)))
+
+        return self._insert_groups(
+            groups,
+            lambda shard, group: shard.insert_many([record for _, record in group])
+        )
+
+    def insert_lines(self, data):
+        from logsink_server import lineprotocol
+
+        # The lines are passed on as they are, only decoded to be routed
+        groups = {}
+        lines = [line for line in lineprotocol.iter_lines(data) if line.strip()]
+        for index, line in enumerate(lines):
+            _, tags = lineprotocol.decode(line)
+            if self.shard_by == 'time' and 'time' not in tags:
+                # Stamped by the shard, close enough
+                tags['time'] = storage.format_micros(int(time.time()*1000000))
+            groups.setdefault(self._route(tags), []).append((index, line))
+
+        return self._insert_groups(
+            groups,
+            lambda shard, group: shard.insert_lines(b'\n'.join(line for _, line in group))
+        )
+
+    def _write(self, points):
+        # InfluxDB points flushed by the write-behind buffer, see
+        # storage._write_points
+        groups = {}
+        for point in points:
+            groups.setdefault(self._route(dict(point['tags'], time=point['time'])), []).append(point)
+        _fan_out(lambda index: self.shards[index]._write(groups[index]), list(groups))
+
+    def query(self, **kwargs):
+        kwargs = self._pin_time_range(kwargs)
+        compiled = query.compile(**kwargs)
+
+        # Each shard returns all the rows up to the end of the page, the
+        # page is cut from their merge. Rows at the same time are ordered by
+        # shard, the cursor skips count them in this order.
+        #
+        # So each shard reads offset + per_page rows: page N costs N pages
+        # per shard, deep pages get more expensive as shards are added. With
+        # a cursor the offset is only the number of rows at the cursor time
+        # already returned, prefer cursors to page deep.
+        shard_kwargs = dict(kwargs)
+        shard_kwargs.pop('page', None)
+        shard_kwargs['per_page'] = compiled.offset + compiled.per_page
+        if compiled.cursor is not None:
+            shard_kwargs['cursor'] = (
+                storage.encode_cursor(compiled.cursor[0], 0)
+                if compiled.cursor[0] is not None else ''
+            )
+
+        results = _fan_out(
+            lambda shard: list(shard.query(**shard_kwargs)),
+            self._shards_for(compiled)
+        )
+
+        return itertools.islice(
+            heapq.merge(*results, key=_time_key),
+            compiled.offset,
+            compiled.offset + compiled.per_page
+        )
+
+    def aggregated(self, **kwargs):
+        # The same intervals on all the shards
+        interval = storage.histogram_interval(**kwargs)
+        kwargs.pop('num_intervals', None)
+
+        return self.histogram(interval, **kwargs)
+
+    def histogram(self, interval, **kwargs):
+        kwargs = self._pin_time_range(kwargs)
+        results = _fan_out(
+            lambda shard: list(shard.histogram(interval, **kwargs)),
+            self._shards_for(query.compile(**kwargs))
+        )
+
+        counts = {}
+        for rows in results:
+            for row in rows:
+                counts[row['time']] = counts.get(row['time'], 0) + (row['count_message'] or 0)
+
+        return sorted(
+            ({'time': time, 'count_message': count} for time, count in counts.items()),
+            key=_time_key
+        )
+
+    def tag_keys(self, **kwargs):
+        kwargs = self._pin_time_range(kwargs)
+        results = _fan_out(
+            lambda shard: shard.tag_keys(**kwargs),
+            self._shards_for(query.compile(**kwargs))
+        )
+
+        return sorted(set().union(*results))
+
+    def clear(self, **kwargs):
+        compiled = query.compile(**kwargs)
+        shards = self._shards_for(compiled) if compiled.time_given else self._tag_shards(compiled)
+        _fan_out(lambda shard: shard.clear(**kwargs), shards)
+
+    def expire(self, before):
+        for shard in self.shards:
+            if hasattr(shard, 'expire'):
+                shard.expire(before)
+
+    def usage(self):
+        return [item for shard in self.shards for item in shard.usage()]
+
+    def _route(self, tags):
+        try:
+            return self.shard_index(tags)
+        except ValueError:
+            # Invalid time, the shard reports it
+            return 0
+
+    def _insert_groups(self, groups, insert):
+        indices = list(groups)
+        results = _fan_out(
+            lambda index: insert(self.shards[index], groups[index]),
+            indices
+        ) if groups else []
+
+        errors = []
+        for index, shard_errors in zip(indices, results):
+            group = groups[index]
+            errors.extend((group[i][0], error) for i, error in shard_errors)
+
+        return sorted(errors)
+
+    def _pin_time_range(self, kwargs):
+        # The default time range ends now: the same now for all the shards
+        kwargs = dict(kwargs)
+        if 'time__lte' not in kwargs:
+            compiled = query.compile(**kwargs)
+            kwargs['time__lte'] = compiled.time__lte.isoformat()
+            kwargs.setdefault('time__gte', compiled.time__gte.isoformat())
+
+        return kwargs
+
+    def _tag_shards(self, compiled):
+        # Only one shard holds the messages with a given shard tag
+        if self.shard_by != 'time':
+            for tag, value in compiled.tags:
+                if tag == self.shard_by:
+                    return [self.shards[self.shard_index({tag: value})]]
+
+        return self.shards
+
+    def _shards_for(self, compiled):
+        """The shards which can hold logs matching the query."""
+
+        if self.shard_by != 'time':
+            return self._tag_shards(compiled)
+
+        step = self.shard_seconds*1000000
+        first = storage.to_micros(compiled.start)//step
+        last = storage.to_micros(compiled.time__lte)//step
+        if last - first + 1 >= len(self.shards):
+            return self.shards
+
+        return [
+            self.shards[period % len(self.shards)]
+            for period in range(first, last + 1)
+        ]
+
+
+storage.ABCStorage.register(ShardedStorage)
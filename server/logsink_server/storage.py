@@ -1,16 +1,63 @@
 import abc
+import atexit
+import base64
+import collections
 import datetime
-from dateutil import parser
 import influxdb
+import json
+import logging
+import os
 import pytz
+import re
+import requests
+import signal
+import sys
+import threading
+import time
+
+from logsink_server import metrics
+from logsink_server import query
+from logsink_server import retention
 
 
 DEFAULT_NUM_INTERVALS = 10  # default number of intervals when returning an aggregated query
 DEFAULT_QUERY_DAY_SPAN = 10  # default time interval length for query/aggregated query
 DEFAULT_PER_PAGE = 25
+INSERT_CHUNK_SIZE = 5000  # max number of points sent in one write
+STREAM_PAGE_SIZE = 1000  # number of rows read at a time by iter_query
+# Max number of keep-alive connections to InfluxDB kept by one storage
+POOL_SIZE = int(os.environ.get('LOGSINK_INFLUXDB_POOL_SIZE', 10))
+
+# Storage backend: 'influxdb' or 'embedded' (see segments.SegmentStorage)
+STORAGE_BACKEND = os.environ.get('LOGSINK_STORAGE', 'influxdb')
+DATA_DIR = os.environ.get('LOGSINK_DATA_DIR', '/var/lib/logsink')  # for the embedded backend
+
+# Write-behind buffering of inserts, see WriteBehindBuffer
+WRITE_BEHIND = os.environ.get('LOGSINK_WRITE_BEHIND', '') not in ('', '0')
+WRITE_BEHIND_MAX_POINTS = int(os.environ.get('LOGSINK_WRITE_BEHIND_MAX_POINTS', 100000))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get('LOGSINK_WRITE_BEHIND_FLUSH_INTERVAL', 0.5))  # seconds
+CLEAR_FLUSH_TIMEOUT = 10  # seconds a clear waits for the buffered points to be written
+
+# Rollup measurements for long-range histograms, see rollup.Downsampler
+ROLLUPS = os.environ.get('LOGSINK_ROLLUPS', '') not in ('', '0')
 
 # TODO: this could be omitted if we encoded query as JSON in the GET parameters
-QUERY_KEYWORDS = ['num_intervals', 'page', 'per_page', 'time__lte', 'time__gte']
+QUERY_KEYWORDS = ['cursor', 'num_intervals', 'page', 'per_page', 'time__lte', 'time__gte']
+
+# Timestamps returned by storages, see the query method
+RFC3339_RE = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d{1,9})?Z$')
+
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+# A written log record, as passed to insert listeners (see add_insert_listener)
+Record = collections.namedtuple('Record', ['time', 'message', 'tags'])
+
+
+class BufferFull(Exception):
+    """The write-behind buffer has no room for more points."""
 
 
 class ABCStorage(metaclass=abc.ABCMeta):
@@ -28,6 +75,28 @@ class ABCStorage(metaclass=abc.ABCMeta):
 
         raise NotImplemented()
 
+    @abc.abstractmethod
+    def insert_many(self, records):
+        """Insert many messages to the storage at once.
+
+        records is an iterable of (message, tags) pairs. Invalid records or
+        records which could not be written don't stop the others from being
+        inserted.
+
+        Returns a list of (index, error message) pairs for the records which
+        were not inserted."""
+
+        raise NotImplemented()
+
+    @abc.abstractmethod
+    def insert_lines(self, data):
+        """Insert messages in line protocol, see lineprotocol.py.
+
+        data holds lines validated by lineprotocol.split_lines. Returns a
+        list of (index, error message) pairs as insert_many does."""
+
+        raise NotImplemented()
+
     @abc.abstractmethod
     def query(self, **kwargs):
         """Perform DB query with filters defined in **kwargs.
@@ -39,6 +108,10 @@ class ABCStorage(metaclass=abc.ABCMeta):
         * time__gte: timestamp of returned logs will be greater or equal to this value
             By default this is time__lte - DEFAULT_QUERY_DAY_SPAN days
         * page, per_page: pagination data (default is page = 1, per_page = DEFAULT_PER_PAGE)
+        * cursor: keyset pagination, used instead of page when present.
+            Empty for the first page, then the value returned by
+            next_cursor(rows, **kwargs) for the previous page. The cost of
+            fetching a page doesn't depend on how deep the page is.
 
 
         Returns:
@@ -77,6 +150,21 @@ class ABCStorage(metaclass=abc.ABCMeta):
         ]
         """
 
+    @abc.abstractmethod
+    def histogram(self, interval, **kwargs):
+        """Like aggregated but with intervals of a fixed length.
+
+        interval is the length of the intervals in seconds. Intervals are
+        aligned to multiples of interval since epoch. num_intervals is
+        ignored."""
+
+    @abc.abstractmethod
+    def tag_keys(self, **kwargs):
+        """Sorted names of the tags of the log entries matching the query.
+
+        Takes the query parameters of the query method. Tags of other log
+        entries may be included too, when it's cheaper."""
+
     @abc.abstractmethod
     def clear(self, **kwargs):
         """Clear the database of log entries.
@@ -88,13 +176,43 @@ class ABCStorage(metaclass=abc.ABCMeta):
         """
 
 
+class PoolAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter with one pool of max_connections, counting its requests."""
+
+    def __init__(self, max_connections):
+        super().__init__(pool_connections=1, pool_maxsize=max_connections)
+        self.max_connections = max_connections
+        self.in_use = 0  # requests being sent, each one holds a connection
+        self._count_lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        with self._count_lock:
+            self.in_use += 1
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            with self._count_lock:
+                self.in_use -= 1
+
+
 class InfluxDBStorage:
+    # Default settings of get_client
+    DEFAULT_SETTINGS = {
+        'host': 'influxdb',
+        'port': 8086,
+        'user': 'root',
+        'password': 'root',
+        'pool_size': POOL_SIZE,
+    }
+
     @staticmethod
-    def get_client(host='influxdb',
-                   port=8086,
-                   user='root',
-                   password='root',
-                   dbname='logsink'):
+    def get_client(host=DEFAULT_SETTINGS['host'],
+                   port=DEFAULT_SETTINGS['port'],
+                   user=DEFAULT_SETTINGS['user'],
+                   password=DEFAULT_SETTINGS['password'],
+                   dbname='logsink',
+                   pool_size=DEFAULT_SETTINGS['pool_size'],
+                   adapter=None):
         client = influxdb.InfluxDBClient(
             host,
             port,
@@ -102,71 +220,634 @@ class InfluxDBStorage:
             password,
             dbname
         )
-        databases = client.get_list_database()
-        if dbname not in (db['name'] for db in databases):
-            client.create_database(dbname)
+        # One pool of keep-alive connections shared by all request threads
+        if adapter is None:
+            adapter = PoolAdapter(pool_size)
+        client._session.mount('http://', adapter)
+        client._session.mount('https://', adapter)
+
+        _ensure_database(client, dbname)
 
         return client
 
-    def __init__(self, dbname):
-        self.client = self.get_client(dbname=dbname)
+    def __init__(self, dbname, **client_kwargs):
+        """client_kwargs are passed to get_client, e.g. host and port."""
+
+        self.dbname = dbname
+        # The connection settings, also used by aiostorage.AsyncInfluxDBStorage
+        self.settings = dict(self.DEFAULT_SETTINGS, **client_kwargs)
+        self.pool = PoolAdapter(self.settings['pool_size'])
+        self.client = self.get_client(dbname=dbname, adapter=self.pool, **self.settings)
+
+        policy = retention.get_policy(dbname)
+        if policy is not None:
+            retention.apply_policy(self.client, dbname, policy)
+
+    def write_points(self, points):
+        """Write points, through the write-behind buffer when it's enabled."""
+
+        if write_behind is not None:
+            write_behind.put(self.dbname, points)
+        else:
+            self._write(points)
+
+    def _write(self, points):
+        with metrics.stage('influxdb_write'):
+            self.client.write_points(points)
+        if _insert_listeners:
+            _notify_insert(self.dbname, [_point_record(point) for point in points])
 
     def insert(self, message, **kwargs):
-        if set(QUERY_KEYWORDS).intersection(kwargs):
-            raise ValueError(
-                "%s are keywords reserved for querying, you cannot use them as tags." % ', '.join(QUERY_KEYWORDS)
-            )
+        self.write_points([_point(message, kwargs)])
 
-        time = kwargs.pop('time', _utcnow().isoformat())
+    def insert_many(self, records):
+        if write_behind is not None:
+            # Points are written later so only validation errors are known
+            errors = []
+            points = []
+            for index, (message, tags) in enumerate(records):
+                try:
+                    points.append(_point(message, tags))
+                except ValueError as e:
+                    errors.append((index, str(e)))
+            if points:
+                write_behind.put(self.dbname, points)
+            return errors
 
-        self.client.write_points([
-            {
-                'measurement': 'logs',
-                'tags': kwargs,
-                'time': time,
-                'fields': {
-                    'message': message,
-                },
-            },
-        ])
+        errors = []
+        chunk = []
+        chunk_indices = []
+
+        def write_chunk():
+            try:
+                self._write(chunk)
+            except influxdb.exceptions.InfluxDBClientError:
+                # Find out which points were rejected. Rewriting the ones
+                # which were stored is harmless, the points are the same.
+                for index, point in zip(chunk_indices, chunk):
+                    try:
+                        self._write([point])
+                    except influxdb.exceptions.InfluxDBClientError as e:
+                        errors.append((index, str(e)))
+            chunk.clear()
+            chunk_indices.clear()
+
+        for index, (message, tags) in enumerate(records):
+            try:
+                chunk.append(_point(message, tags))
+            except ValueError as e:
+                errors.append((index, str(e)))
+                continue
+            chunk_indices.append(index)
+
+            if len(chunk) >= INSERT_CHUNK_SIZE:
+                write_chunk()
+
+        if chunk:
+            write_chunk()
+
+        return sorted(errors)
+
+    def insert_lines(self, data):
+        # Written as is, bypassing the write-behind buffer: the lines come in
+        # batches already
+        try:
+            with metrics.stage('influxdb_write'):
+                self.client.request(
+                    'write',
+                    'POST',
+                    params={'db': self.dbname},
+                    data=data,
+                    expected_response_code=204
+                )
+        except influxdb.exceptions.InfluxDBClientError:
+            # Find out which lines were rejected, the points written are
+            # written again the same: they all have a timestamp, see
+            # lineprotocol.split_lines
+            from logsink_server import lineprotocol
+            return self.insert_many(lineprotocol.decode_lines(data))
+
+        if _insert_listeners:
+            _notify_insert(self.dbname, _line_records(data))
+
+        return []
 
     def query(self, **kwargs):
-        where = _where_filter(**kwargs)
-        limit = _limit(**kwargs)
+        with metrics.stage('query_build'):
+            statement = query.select_logs(query.compile(**kwargs))
 
-        return self.client.query(
-            'SELECT * FROM logs WHERE %s %s;' % (where, limit)
-        ).get_points()
+        return self._query(statement).get_points()
 
     def aggregated(self, **kwargs):
-        num_intervals = kwargs.pop('num_intervals', DEFAULT_NUM_INTERVALS) - 1
+        interval = histogram_interval(**kwargs)
+        kwargs.pop('num_intervals', None)
+
+        return self.histogram(interval, **kwargs)
+
+    def histogram(self, interval, **kwargs):
+        if downsampler is not None:
+            rows = downsampler.histogram(self, interval, **kwargs)
+            if rows is not None:
+                return rows
 
-        time__lte, time__gte = _time_range(**kwargs)
-        span = (time__gte - time__lte).total_seconds()
-        diff = int(span/num_intervals)
+        with metrics.stage('query_build'):
+            statement = query.count_logs(query.compile(**kwargs), interval)
 
-        where = _where_filter(**kwargs)
+        return self._query(statement).get_points()
 
-        return self.client.query(
-            'SELECT COUNT(*) FROM logs WHERE %s GROUP BY time(%ss);' % (where, diff)
-        ).get_points()
+    def tag_keys(self, **kwargs):
+        # All the tag keys of the measurement, InfluxDB keeps them indexed
+        query.compile(**kwargs)
+
+        return sorted(row['tagKey'] for row in self._query('SHOW TAG KEYS FROM "logs";').get_points())
 
     def clear(self, **kwargs):
-        if 'time__lte' not in kwargs and 'time__gte' not in kwargs:
-            # Clear all time intervals (don't apply the DEFAULT_QUERY_DAY_SPAN)
-            where = _where_tag_filter(**kwargs)
+        # Without time bounds all time intervals are cleared (the
+        # DEFAULT_QUERY_DAY_SPAN doesn't apply)
+        compiled = query.compile(**kwargs)
+
+        # Buffered points would be written after the clear
+        if write_behind is not None and not write_behind.flush(timeout=CLEAR_FLUSH_TIMEOUT):
+            logger.warning('Clearing %s with buffered points not written yet', self.dbname)
+
+        result = None
+        deleted = False
+        if not compiled.tags and compiled.message is None:
+            # Whole time window: drop the shards inside it, only the points
+            # of the shards at its edges are deleted
+            if compiled.time_given:
+                gte, lte = to_micros(compiled.start), to_micros(compiled.time__lte)
+            else:
+                gte, lte = float('-inf'), float('inf')
+            rollups = []
+            if downsampler is not None:
+                rollups = [rollup.measurement for rollup in downsampler.rollups]
+            deleted = retention.drop_window(self.client, self.dbname, gte, lte, rollups)
+        if not deleted:
+            result = self._query(query.delete_logs(compiled))
+        # The rollups of the window are rolled up again, see rollup.Downsampler
+        _notify_clear(self.dbname, kwargs)
+
+        return result
+
+    def usage(self):
+        """(retention.Shard, bytes on disk) of the shards of the database."""
+
+        disk_usage = retention.influxdb_disk_usage(self.client, self.dbname)
+
+        return [
+            (shard, disk_usage.get(shard.id, 0))
+            for shard in retention.influxdb_shards(self.client, self.dbname)
+        ]
+
+    def _query(self, query):
+        with metrics.timed_query('influxdb_query', query):
+            return self.client.query(query)
+
+ABCStorage.register(InfluxDBStorage)
+
+
+# Process-wide storage registry. Storages are thread-safe and expensive to
+# set up so there is only one per database.
+_storages = {}
+_storages_lock = threading.Lock()
+
+# Databases which are known to exist
+_databases = set()
+_databases_lock = threading.Lock()
+
+
+def get_storage(dbname):
+    """Return the shared storage for database dbname."""
+
+    db = _storages.get(dbname)
+    if db is None:
+        # Set up without the lock, it makes requests to InfluxDB: requests
+        # of the other databases don't wait for it. When threads race to set
+        # up the same database the first one to publish its storage wins.
+        new = _backend()(dbname)
+        with _storages_lock:
+            db = _storages.setdefault(dbname, new)
+        if db is not new and hasattr(new, 'close'):
+            new.close()
+
+    return db
+
+
+def _backend():
+    from logsink_server import sharding
+    if sharding.SHARDS:
+        return sharding.ShardedStorage
+
+    return _single_backend()
+
+
+def _single_backend():
+    if STORAGE_BACKEND == 'embedded':
+        from logsink_server.segments import SegmentStorage
+        return SegmentStorage
+    elif STORAGE_BACKEND == 'influxdb':
+        return InfluxDBStorage
+
+    raise ValueError('Unknown storage backend: %s' % STORAGE_BACKEND)
+
+
+def invalidate_storage(dbname=None):
+    """Forget the storage of dbname (or all of them if dbname is None).
+
+    The next get_storage call creates a new storage and checks again that
+    the database exists, e.g. after it was dropped outside of logsink."""
+
+    with _storages_lock, _databases_lock:
+        if dbname is None:
+            _storages.clear()
+            _databases.clear()
         else:
-            where = _where_filter(**kwargs)
+            _storages.pop(dbname, None)
+            _databases.discard(dbname)
+
+
+class FlushStats:
+    """Batch size and latency statistics of write-behind flushes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.flushes = 0
+        self.points = 0
+        self.failed_points = 0
+        self.rejected_points = 0
+        self.max_batch_size = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def flushed(self, size, latency, failed=False):
+        with self._lock:
+            self.flushes += 1
+            if failed:
+                self.failed_points += size
+            else:
+                self.points += size
+            self.max_batch_size = max(self.max_batch_size, size)
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def rejected(self, size):
+        with self._lock:
+            self.rejected_points += size
+
+    def as_dict(self):
+        with self._lock:
+            flushes = self.flushes or 1
+            return {
+                'flushes': self.flushes,
+                'points': self.points,
+                'failed_points': self.failed_points,
+                'rejected_points': self.rejected_points,
+                'avg_batch_size': (self.points + self.failed_points) / flushes,
+                'max_batch_size': self.max_batch_size,
+                'avg_flush_latency': self.latency / flushes,
+                'max_flush_latency': self.max_latency,
+            }
 
-        # where can be empty
-        if where:
-            where = ' WHERE %s' % where
 
-        return self.client.query(
-            'DELETE FROM logs %s;' % where
+class WriteBehindBuffer:
+    """Collects points inserted by all requests and writes them in batches.
+
+    Points are grouped per database. A database is flushed when it has
+    batch_size points pending or its oldest pending point is flush_interval
+    seconds old. At most max_points points are held, put() raises BufferFull
+    beyond that.
+
+    write(dbname, points) does the actual write. Points which couldn't be
+    written because InfluxDB is unreachable or failing are put back, if
+    there's room, and written again after flush_interval. Points InfluxDB
+    rejected are dropped."""
+
+    def __init__(
+            self,
+            write,
+            max_points=WRITE_BEHIND_MAX_POINTS,
+            batch_size=INSERT_CHUNK_SIZE,
+            flush_interval=WRITE_BEHIND_FLUSH_INTERVAL):
+        self.write = write
+        self.max_points = max_points
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = FlushStats()
+
+        # dbname -> (time of the oldest point, points)
+        self._pending = collections.OrderedDict()
+        self._size = 0
+        self._in_flight = 0
+        self._flush_requested = False
+        self._closed = False
+        self._retry_at = None  # no writes before, after a failure
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(
+            target=self._run,
+            name='logsink-write-behind',
+            daemon=True
         )
+        self._thread.start()
 
-ABCStorage.register(InfluxDBStorage)
+    def __len__(self):
+        return self._size
+
+    def put(self, dbname, points):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Write-behind buffer is closed.')
+            if self._size + len(points) > self.max_points:
+                self.stats.rejected(len(points))
+                raise BufferFull('Write-behind buffer is full.')
+
+            new = dbname not in self._pending
+            if new:
+                self._pending[dbname] = (time.monotonic(), [])
+            pending = self._pending[dbname][1]
+            pending.extend(points)
+            self._size += len(points)
+
+            # Let the flusher know about the new flush deadline or a full batch
+            if new or len(pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Write all pending points and wait until they are written."""
+
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(
+                lambda: not self._size and not self._in_flight,
+                timeout=timeout
+            )
+
+    def close(self, timeout=None):
+        """Write all pending points and stop the flusher thread."""
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def _due(self):
+        # Returns the pending databases which should be flushed now and the
+        # time to wait for the next one otherwise
+        now = time.monotonic()
+        if not self._closed and self._retry_at is not None and now < self._retry_at:
+            return [], self._retry_at - now
+        if self._closed or self._flush_requested:
+            return list(self._pending), None
+
+        due = []
+        wait = None
+        for dbname, (since, points) in self._pending.items():
+            remaining = since + self.flush_interval - now
+            if len(points) >= self.batch_size or remaining <= 0:
+                due.append(dbname)
+            elif wait is None or remaining < wait:
+                wait = remaining
+
+        return due, wait
+
+    def _next_batches(self):
+        with self._cond:
+            while True:
+                if not self._pending:
+                    self._flush_requested = False
+                    self._cond.notify_all()
+                    if self._closed:
+                        return None
+                    self._cond.wait()
+                    continue
+
+                due, wait = self._due()
+                if due:
+                    break
+                self._cond.wait(wait)
+
+            batches = []
+            for dbname in due:
+                _, points = self._pending.pop(dbname)
+                self._size -= len(points)
+                batches.append((dbname, points))
+            self._in_flight += 1
+
+            return batches
+
+    def _run(self):
+        while True:
+            batches = self._next_batches()
+            if batches is None:
+                return
+
+            for dbname, points in batches:
+                for i in range(0, len(points), self.batch_size):
+                    chunk = points[i:i + self.batch_size]
+                    start = time.monotonic()
+                    try:
+                        self.write(dbname, chunk)
+                    except (requests.exceptions.ConnectionError, influxdb.exceptions.InfluxDBServerError) as e:
+                        self.stats.flushed(len(chunk), time.monotonic() - start, failed=True)
+                        self._retry(dbname, chunk, e)
+                    except Exception:
+                        logger.exception(
+                            'Write-behind flush of %d points to %s failed',
+                            len(chunk),
+                            dbname
+                        )
+                        self.stats.flushed(len(chunk), time.monotonic() - start, failed=True)
+                        metrics.records_dropped.inc(len(chunk), reason='flush_failed')
+                    else:
+                        self.stats.flushed(len(chunk), time.monotonic() - start)
+
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def _retry(self, dbname, points, error):
+        # Put the points back in front of the newer ones of the database
+        with self._cond:
+            if self._closed or self._size + len(points) > self.max_points:
+                logger.error('Write-behind flush of %d points to %s failed: %s', len(points), dbname, error)
+                metrics.records_dropped.inc(len(points), reason='flush_failed')
+                return
+
+            logger.warning(
+                'Write-behind flush of %d points to %s failed, retrying: %s',
+                len(points),
+                dbname,
+                error
+            )
+            now = time.monotonic()
+            since, pending = self._pending.get(dbname, (now, []))
+            self._pending[dbname] = (since, points + pending)
+            self._size += len(points)
+            self._retry_at = now + self.flush_interval
+
+
+write_behind = None
+
+
+def enable_write_behind(**kwargs):
+    """Buffer inserts of all storages in a WriteBehindBuffer.
+
+    kwargs are passed to WriteBehindBuffer. The buffer is flushed when the
+    process exits."""
+
+    global write_behind
+
+    if write_behind is not None:
+        return write_behind
+
+    write_behind = WriteBehindBuffer(_write_points, **kwargs)
+    atexit.register(write_behind.close)
+
+    # atexit handlers don't run when the process is killed with SIGTERM, turn
+    # it into a normal exit unless someone else handles the signal already
+    try:
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    except ValueError:
+        # Not in the main thread
+        pass
+
+    return write_behind
+
+
+def _write_points(dbname, points):
+    get_storage(dbname)._write(points)
+
+
+downsampler = None
+
+
+def enable_rollups(**kwargs):
+    """Maintain rollup measurements and use them in histograms.
+
+    kwargs are passed to rollup.Downsampler."""
+
+    global downsampler
+
+    if downsampler is not None:
+        return downsampler
+
+    from logsink_server import rollup
+    from logsink_server import sharding
+
+    if sharding.SHARDS:
+        logger.warning('Sharded storages have no rollups, their histograms count the raw logs')
+
+    downsampler = rollup.Downsampler(**kwargs)
+    downsampler.start()
+    atexit.register(downsampler.close)
+
+    return downsampler
+
+
+# Write listeners, used e.g. to invalidate caches
+_insert_listeners = []
+_clear_listeners = []
+
+
+def add_insert_listener(listener):
+    """Call listener(dbname, records) after records are written.
+
+    records is a list of Record. Listeners must be quick, they are called
+    by the thread which wrote the records."""
+
+    _insert_listeners.append(listener)
+
+
+def add_clear_listener(listener):
+    """Call listener(dbname, kwargs) after storage.clear(**kwargs)."""
+
+    _clear_listeners.append(listener)
+
+
+def remove_listener(listener):
+    for listeners in (_insert_listeners, _clear_listeners):
+        if listener in listeners:
+            listeners.remove(listener)
+
+
+def _notify_insert(dbname, records):
+    for listener in _insert_listeners:
+        try:
+            listener(dbname, records)
+        except Exception:
+            logger.exception('Insert listener %r failed', listener)
+
+
+def _notify_clear(dbname, kwargs):
+    for listener in _clear_listeners:
+        try:
+            listener(dbname, kwargs)
+        except Exception:
+            logger.exception('Clear listener %r failed', listener)
+
+
+def filter_tags(kwargs):
+    """The tag filters of the query kwargs."""
+
+    return {
+        tag: value for tag, value in kwargs.items()
+        if tag not in QUERY_KEYWORDS and tag != 'message'
+    }
+
+
+class Filters:
+    """Message and tag filters of a query, tells if a Record matches.
+
+    Used by all the in-process filtering: caches, live tail and the embedded
+    storage (see segments.Filter). Raises ValueError for an invalid message
+    regex."""
+
+    def __init__(self, **kwargs):
+        self.tags = filter_tags(kwargs)
+        self._tag_values = [(tag, str(value)) for tag, value in self.tags.items()]
+        self.message = kwargs.get('message')
+        self.regex = None
+        if self.message is not None:
+            try:
+                self.regex = re.compile(self.message)
+            except re.error as e:
+                raise ValueError('Invalid message regex: %s' % e)
+
+    def kwargs(self):
+        kwargs = dict(self.tags)
+        if self.message is not None:
+            kwargs['message'] = self.message
+        return kwargs
+
+    def key(self):
+        return frozenset(self.kwargs().items())
+
+    def matches(self, record):
+        return self.match(record.message, record.tags)
+
+    def match(self, message, tags):
+        for tag, value in self._tag_values:
+            tag_value = tags.get(tag)
+            if tag_value is None or str(tag_value) != value:
+                return False
+
+        return self.regex is None or self.regex.search(message) is not None
+
+
+def _ensure_database(client, dbname):
+    if dbname in _databases:
+        return
+
+    # Not under the lock, CREATE DATABASE does nothing when it exists
+    databases = client.get_list_database()
+    if dbname not in (db['name'] for db in databases):
+        client.create_database(dbname)
+
+    with _databases_lock:
+        _databases.add(dbname)
 
 
 # Utility functions
@@ -174,64 +855,188 @@ def _utcnow():
     return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
 
 
-def _time_range(**kwargs):
-    # By default, show last 10 days of data
-    time__lte = _utcnow()
-    if 'time__lte' in kwargs:
-        time__lte = parser.parse(kwargs['time__lte'])
-    if 'time__gte' in kwargs:
-        time__gte = parser.parse(kwargs['time__gte'])
-    else:
-        time__gte = time__lte - datetime.timedelta(days=DEFAULT_QUERY_DAY_SPAN)
-    if time__lte < time__gte:
-        raise ValueError('Invalid time range.')
+def to_micros(value):
+    """Microseconds since epoch of a datetime or a timestamp string."""
 
-    return time__gte, time__lte
+    value = query.parse_time(value)
 
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
 
-# InfluxDB-specific
-def _where_filter(**kwargs):
-    time__gte, time__lte = _time_range(**kwargs)
 
-    query = [
-        "time >= '%s'" % time__gte.isoformat(timespec='seconds'),
-        "time <= '%s'" % time__lte.isoformat(timespec='seconds'),
-    ]
+def format_micros(micros):
+    """RFC3339 representation of micros, the way InfluxDB returns time."""
 
-    if 'message' in kwargs:
-        # Message regex filtering
-        message = kwargs['message']
-        query.append(
-            '"message" =~ /%s/' % message
-        )
+    value = EPOCH + datetime.timedelta(microseconds=micros)
+    text = value.strftime('%Y-%m-%dT%H:%M:%S')
+    if value.microsecond:
+        text += ('.%06d' % value.microsecond).rstrip('0')
+
+    return text + 'Z'
 
-    tag_filter = _where_tag_filter(**kwargs)
-    if tag_filter:
-        query.append(tag_filter)
 
-    return ' AND '.join(query)
+def histogram_interval(**kwargs):
+    """Length in seconds of the intervals of an aggregated query."""
 
+    compiled = query.compile(**kwargs)
+    span = (compiled.time__lte - compiled.time__gte).total_seconds()
 
-def _where_tag_filter(**kwargs):
-    # TODO: this is very simple with no SQL-injection protection whatsoever
+    interval = max(1, int(span/max(1, compiled.num_intervals - 1)))
+    if downsampler is not None:
+        interval = downsampler.align_interval(interval)
 
-    query = []
+    return interval
 
-    # Other tags are filtered by exact value
-    for tag, value in kwargs.items():
-        if tag in QUERY_KEYWORDS or tag == 'message':
-            continue
 
-        query.append(
-            '"%s" = \'%s\'' % (tag, value),
+def _check_tags(tags):
+    if set(QUERY_KEYWORDS).intersection(tags):
+        raise ValueError(
+            "%s are keywords reserved for querying, you cannot use them as tags." % ', '.join(QUERY_KEYWORDS)
         )
 
-    return ' AND '.join(query)
 
+def iter_query(db, **kwargs):
+    """Yield all the rows of db.query(**kwargs), not just one page.
+
+    Rows are read per_page (STREAM_PAGE_SIZE by default) at a time using
+    cursor pagination, starting from kwargs['cursor'] if present. page is
+    ignored."""
+
+    kwargs = dict(kwargs)
+    kwargs.pop('page', None)
+    kwargs.setdefault('per_page', STREAM_PAGE_SIZE)
+    kwargs.setdefault('cursor', '')
+
+    # Don't let the default time range move while reading the pages
+    compiled = query.compile(**kwargs)
+    kwargs.setdefault('time__gte', compiled.time__gte.isoformat())
+    kwargs.setdefault('time__lte', compiled.time__lte.isoformat())
+
+    while True:
+        rows = list(db.query(**kwargs))
+        yield from rows
+
+        cursor = next_cursor(rows, **kwargs)
+        if cursor is None:
+            return
+        kwargs['cursor'] = cursor
+
+
+def encode_cursor(time, skip):
+    """Cursor pointing after the first skip rows at time."""
+
+    return base64.urlsafe_b64encode(
+        json.dumps([time, skip]).encode('utf-8')
+    ).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Returns (time, skip) of the cursor, None for an empty cursor."""
+
+    if not cursor:
+        return None
+
+    try:
+        time, skip = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor.')
+    if not isinstance(time, str) or not RFC3339_RE.match(time) or \
+            not isinstance(skip, int) or skip < 0:
+        raise ValueError('Invalid cursor.')
+
+    return time, skip
+
+
+def next_cursor(rows, **kwargs):
+    """Cursor of the page following rows, None if rows is the last page.
+
+    kwargs are the query parameters which returned rows."""
 
-def _limit(**kwargs):
-    page = int(kwargs.get('page', 1))
     per_page = int(kwargs.get('per_page', DEFAULT_PER_PAGE))
-    offset = (page - 1)*per_page
+    if not rows or len(rows) < per_page:
+        return None
+
+    # Rows at the same time are told apart by their position. Count the
+    # rows at the last time, including the previous pages if they all share
+    # this time.
+    last_time = rows[-1]['time']
+    skip = 0
+    for row in reversed(rows):
+        if row['time'] != last_time:
+            break
+        skip += 1
+    else:
+        cursor = decode_cursor(kwargs.get('cursor'))
+        if cursor is not None and cursor[0] == last_time:
+            skip += cursor[1]
+
+    return encode_cursor(last_time, skip)
+
+
+# InfluxDB-specific
+def _point(message, tags):
+    _check_tags(tags)
+
+    tags = dict(tags)
+    time = tags.pop('time', _utcnow().isoformat())
+
+    return {
+        'measurement': 'logs',
+        'tags': tags,
+        'time': time,
+        'fields': {
+            'message': message,
+        },
+    }
+
+
+def _point_record(point):
+    return Record(query.parse_time(point['time']), point['fields']['message'], point['tags'])
+
+
+def _line_records(data):
+    from logsink_server import lineprotocol
+
+    return [
+        _point_record(_point(message, tags))
+        for message, tags in lineprotocol.decode_lines(data)
+    ]
+
+
+def _pool_usage():
+    # Connections to InfluxDB per database (of all its shards): in use and
+    # the pool size
+    usage = {}
+    for dbname, db in list(_storages.items()):
+        pools = [
+            shard.pool for shard in getattr(db, 'shards', [db])
+            if isinstance(shard, InfluxDBStorage)
+        ]
+        if pools:
+            usage[(dbname, 'in_use')] = sum(pool.in_use for pool in pools)
+            usage[(dbname, 'max')] = sum(pool.max_connections for pool in pools)
+
+    return usage
+
+
+metrics.Gauge(
+    'logsink_storage_pool_connections',
+    'Connections of the storage client pools.',
+    ['database', 'state'],
+    callback=_pool_usage
+)
+metrics.Gauge(
+    'logsink_write_behind_pending_points',
+    'Points waiting in the write-behind buffer.',
+    callback=lambda: {(): len(write_behind)} if write_behind is not None else {}
+)
+
+
+if WRITE_BEHIND:
+    enable_write_behind()
+
+if ROLLUPS:
+    enable_rollups()
 
-    return 'LIMIT %d OFFSET %d' % (per_page, offset)
+# InfluxDB expires data itself, through its retention policies
+if retention.policies and STORAGE_BACKEND == 'embedded':
+    retention.enable_expiry()
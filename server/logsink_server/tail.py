@@ -0,0 +1,160 @@
+# Live tail: new log records are pushed to the subscribers as they are written.
+#
+# Records come from the storage insert listeners, so following the logs
+# doesn't query the storage at all. Only records written through this
+# process are seen.
+import collections
+import logging
+import os
+import queue
+import threading
+
+from logsink_server import storage
+
+
+# Max number of records waiting to be sent to a subscriber. Subscribers which
+# fall further behind are dropped.
+QUEUE_SIZE = int(os.environ.get('LOGSINK_TAIL_QUEUE_SIZE', 1000))
+HEARTBEAT_INTERVAL = 15  # seconds without records before a heartbeat is sent
+
+
+logger = logging.getLogger(__name__)
+
+
+class Dropped(Exception):
+    """The subscriber didn't keep up with the new records."""
+
+
+class Subscriber:
+    """Queue of the new rows of one database matching the filters."""
+
+    def __init__(self, dbname, filters, queue_size=QUEUE_SIZE):
+        self.dbname = dbname
+        self.filters = filters
+        self.dropped = False
+        self._queue = queue.Queue(maxsize=queue_size)
+
+    def get(self, timeout=None):
+        """Next row, None when there was none for timeout seconds.
+
+        Raises Dropped when the subscriber was dropped, the rows it didn't
+        read are lost."""
+
+        try:
+            row = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if row is _DROPPED:
+            raise Dropped()
+
+        return row
+
+    def _put(self, row):
+        # Returns False when the queue is full
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            return False
+        return True
+
+    def _drop(self):
+        self.dropped = True
+        # Make room for the marker, get() raises right away
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._queue.put_nowait(_DROPPED)
+
+
+_DROPPED = object()
+
+
+class FanoutHub:
+    """Pushes the written records to the matching subscribers.
+
+    Publishing never blocks the writers: subscribers whose queue is full
+    are dropped (and should subscribe again)."""
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        self._subscribers = collections.defaultdict(set)  # dbname -> {Subscriber}
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def subscribe(self, dbname, **kwargs):
+        """Subscribe to new records of dbname matching the query filters.
+
+        kwargs are the filters of ABCStorage.query, time range and
+        pagination arguments are ignored."""
+
+        filters = storage.Filters(**kwargs)
+        subscriber = Subscriber(dbname, filters, queue_size=self.queue_size)
+        with self._lock:
+            if not self._subscribers:
+                storage.add_insert_listener(self._inserted)
+            self._subscribers[dbname].add(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._remove(subscriber)
+
+    def _remove(self, subscriber):
+        subscribers = self._subscribers.get(subscriber.dbname)
+        if subscribers is None or subscriber not in subscribers:
+            return
+
+        subscribers.remove(subscriber)
+        if not subscribers:
+            del self._subscribers[subscriber.dbname]
+            if not self._subscribers:
+                storage.remove_listener(self._inserted)
+
+    def _inserted(self, dbname, records):
+        with self._lock:
+            subscribers = list(self._subscribers.get(dbname, ()))
+        if not subscribers:
+            return
+
+        rows = [None]*len(records)
+        for subscriber in subscribers:
+            for i, record in enumerate(records):
+                if subscriber.dropped:
+                    break
+                if not subscriber.filters.matches(record):
+                    continue
+
+                if rows[i] is None:
+                    rows[i] = _row(record)
+                if not subscriber._put(rows[i]):
+                    self._drop(subscriber)
+                    break
+
+    def _drop(self, subscriber):
+        with self._lock:
+            if subscriber.dropped:
+                # By a concurrent write
+                return
+            logger.warning('Dropping slow tail subscriber of %s', subscriber.dbname)
+            self._remove(subscriber)
+            self.dropped += 1
+            subscriber._drop()
+
+
+def _row(record):
+    # Same format as the rows returned by ABCStorage.query
+    row = dict(record.tags)
+    row['time'] = storage.format_micros(storage.to_micros(record.time))
+    row['message'] = record.message
+    return row
+
+
+hub = FanoutHub()
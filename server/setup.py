@@ -14,4 +14,7 @@ setup(
         'python-dateutil==2.6.0',
         'pytz==2016.10',
     ],
+    extras_require={
+        'asgi': ['aiohttp', 'uvicorn'],
+    },
 )
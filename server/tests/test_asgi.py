@@ -0,0 +1,181 @@
+import asyncio
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from logsink_server import aiostorage
+from logsink_server import asgi
+from logsink_server import auth
+from logsink_server import limits
+from logsink_server import storage
+
+
+class TestASGI(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.backend = storage.STORAGE_BACKEND
+        self.default_data_dir = storage.DATA_DIR
+        storage.STORAGE_BACKEND = 'embedded'
+        storage.DATA_DIR = self.data_dir
+
+    async def asyncTearDown(self):
+        await aiostorage.close_storages()
+        for db in list(storage._storages.values()):
+            db.close()
+        storage.invalidate_storage()
+        storage.STORAGE_BACKEND = self.backend
+        storage.DATA_DIR = self.default_data_dir
+        shutil.rmtree(self.data_dir)
+
+    async def request(self, method, path, body=b'', query_string=b'', token=auth.TEST_TOKEN, headers=()):
+        """Call the app, returns (status, headers, body)."""
+
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query_string,
+            'headers': [(b'x-auth-token', token.encode())] + list(headers),
+        }
+        messages = [{'type': 'http.request', 'body': body}]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            # The client stays connected
+            await asyncio.Event().wait()
+
+        async def send(message):
+            sent.append(message)
+
+        await asgi.app(scope, receive, send)
+        self.sent = sent
+
+        return (
+            sent[0]['status'],
+            dict(sent[0]['headers']),
+            b''.join(message.get('body', b'') for message in sent[1:]),
+        )
+
+    async def test_logs(self):
+        status, _, body = await self.request(
+            'POST', '/logs',
+            json.dumps({'message': 'test message', 'tags': {'tag1': 'value1'}}).encode()
+        )
+        self.assertEqual(status, 201)
+        self.assertEqual(json.loads(body)['message'], 'test message')
+
+        status, _, body = await self.request('POST', '/logs', json.dumps({'tags': {}}).encode())
+        self.assertEqual(status, 400)
+
+        batch = [{'message': 'batch message %d' % i, 'tags': {'tag1': 'value2'}} for i in range(3)]
+        status, _, body = await self.request(
+            'POST', '/logs/batch',
+            gzip.compress(json.dumps(batch + [{'tags': {}}]).encode()),
+            headers=[(b'content-encoding', b'gzip')]
+        )
+        self.assertEqual(status, 207)
+        self.assertEqual(json.loads(body)['inserted'], 3)
+
+        status, _, body = await self.request('GET', '/logs', query_string=b'tag1=value2')
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)), 3)
+
+        status, headers, body = await self.request(
+            'GET', '/logs', headers=[(b'accept', b'application/x-ndjson')]
+        )
+        self.assertEqual(headers[b'content-type'], b'application/x-ndjson')
+        self.assertEqual(len(body.splitlines()), 4)
+
+        status, _, body = await self.request('GET', '/logs/aggregated')
+        self.assertEqual(sum(row['count_message'] for row in json.loads(body)), 4)
+
+        status, _, _ = await self.request('DELETE', '/logs')
+        self.assertEqual(status, 200)
+        status, _, body = await self.request('GET', '/logs')
+        self.assertEqual(json.loads(body), [])
+
+    async def test_stream_error(self):
+        # The response started already, it ends where the error happened
+        # instead of starting an error response
+        async def iter_query(db, **kwargs):
+            yield {'time': '2017-01-01T00:00:00Z', 'message': 'test message'}
+            raise RuntimeError('storage failed')
+
+        with mock.patch.object(aiostorage, 'iter_query', iter_query), self.assertLogs(asgi.logger):
+            status, _, body = await self.request(
+                'GET', '/logs', headers=[(b'accept', b'application/x-ndjson')]
+            )
+
+        # No second start, the body is ended
+        self.assertEqual(status, 200)
+        self.assertEqual([message['type'] for message in self.sent], ['http.response.start', 'http.response.body'])
+        self.assertEqual(self.sent[-1], {'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def test_invalid_requests(self):
+        for path in ('/logs', '/logs/aggregated'):
+            status, _, body = await self.request('GET', path, query_string=b'time__gte=yesterday-ish')
+            self.assertEqual(status, 400)
+            self.assertIn('error', json.loads(body))
+
+        status, _, _ = await self.request('GET', '/logs/aggregated', query_string=b'num_intervals=ten')
+        self.assertEqual(status, 400)
+        status, _, _ = await self.request('DELETE', '/logs', query_string=b'time__lte=yesterday-ish')
+        self.assertEqual(status, 400)
+
+        status, _, body = await self.request('POST', '/logs', json.dumps({'message': 'test message'}).encode())
+        self.assertEqual(status, 400)
+        self.assertEqual(list(json.loads(body)['message']), ['tags'])
+
+    async def test_influxdb_settings(self):
+        # The async storage connects to the InfluxDB of the blocking one
+        db = storage.InfluxDBStorage.__new__(storage.InfluxDBStorage)
+        db.dbname = 'logsink-test'
+        db.settings = dict(storage.InfluxDBStorage.DEFAULT_SETTINGS, host='influxdb-2', port=8087, pool_size=3)
+        async_db = aiostorage.AsyncInfluxDBStorage(db)
+        self.assertEqual(async_db.url, 'http://influxdb-2:8087')
+        self.assertEqual(async_db.pool_size, 3)
+
+    async def test_auth(self):
+        status, _, body = await self.request('GET', '/logs', token='wrong token')
+        self.assertEqual(status, 403)
+        self.assertEqual(json.loads(body), {'error': 'Token incorrect'})
+
+    async def test_limits(self):
+        settings = limits.settings
+        limits.settings = {'logsink-test': {'records_per_second': 2, 'max_queries': 0}, '*': {}}
+        limits.reset()
+        try:
+            limits.admit('logsink', 1, 10)
+            batch = [{'message': 'batch message %d' % i, 'tags': {}} for i in range(2)]
+            status, _, _ = await self.request('POST', '/logs/batch', json.dumps(batch).encode())
+            self.assertEqual(status, 201)
+
+            status, headers, body = await self.request('POST', '/logs/batch', json.dumps(batch).encode())
+            self.assertEqual(status, 429)
+            self.assertEqual(headers[b'retry-after'], b'1')
+            self.assertIn('error', json.loads(body))
+
+            status, _, _ = await self.request('GET', '/logs/aggregated')
+            self.assertEqual(status, 429)
+
+            # Only the usage of the database of the token
+            status, _, body = await self.request('GET', '/stats')
+            self.assertEqual(status, 200)
+            self.assertEqual(list(json.loads(body)['limits']), ['logsink-test'])
+        finally:
+            limits.settings = settings
+            limits.reset()
+
+    async def test_wsgi_fallback(self):
+        # The other endpoints are served by the Flask app
+        status, _, body = await self.request('GET', '/api/swagger.json')
+        self.assertEqual(status, 200)
+        self.assertIn('/logs/aggregated', json.loads(body)['paths'])
+
+        status, _, body = await self.request('GET', '/stats', token='wrong token')
+        self.assertEqual(status, 403)
@@ -0,0 +1,185 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from logsink_server import cache
+from logsink_server import segments
+
+
+class TestAggregationCache(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.db = segments.SegmentStorage('logsink-test', data_dir=self.data_dir)
+        self.cache = cache.AggregationCache(max_size=100000)
+
+        for i in range(9):
+            self.db.insert(
+                'test message %d' % i,
+                tag='value%d' % (i % 2),
+                time='2017-01-0%dT01:00:00Z' % (i + 1)
+            )
+
+    def tearDown(self):
+        self.cache.close()
+        self.db.close()
+        shutil.rmtree(self.data_dir)
+
+    def aggregated(self, **kwargs):
+        kwargs.setdefault('time__gte', '2017-01-01T00:00:00Z')
+        kwargs.setdefault('time__lte', '2017-01-10T00:00:00Z')
+        return self.cache.aggregated(self.db, **kwargs)
+
+    def test_aggregated(self):
+        for kwargs in [{}, {'tag': 'value1'}, {'message': 'message [1-3]'}]:
+            self.assertEqual(self.aggregated(**kwargs), list(self.db.aggregated(
+                time__gte='2017-01-01T00:00:00Z',
+                time__lte='2017-01-10T00:00:00Z',
+                **kwargs
+            )))
+
+        # The second query is served from the cache except for the partial
+        # interval at the end of the window
+        misses = self.cache.misses
+        result = self.aggregated()
+        self.assertEqual(self.cache.misses, misses + 1)
+        self.assertEqual(sum(row['count_message'] for row in result), 9)
+
+    def test_concurrent_stats(self):
+        # Each interval is counted once, as a hit or a miss
+        def run():
+            for _ in range(20):
+                self.aggregated()
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.cache.as_dict()
+        self.assertEqual(stats['hits'] + stats['misses'], 4*20*10)
+
+    def test_invalidation(self):
+        self.aggregated()
+        self.aggregated(tag='value0')
+
+        self.db.insert('late message', tag='value1', time='2017-01-02T02:00:00Z')
+        self.assertEqual(self.aggregated()[1]['count_message'], 2)
+        self.assertEqual(self.aggregated(tag='value0')[1]['count_message'], 0)
+
+        self.db.clear(time__gte='2017-01-02T00:00:00Z', time__lte='2017-01-03T23:00:00Z')
+        result = self.aggregated()
+        self.assertEqual([row['count_message'] for row in result[:4]], [1, 0, 0, 1])
+
+        self.db.clear()
+        self.assertEqual(sum(row['count_message'] for row in self.aggregated()), 0)
+
+    def test_ttl(self):
+        self.cache.ttl = 0.1
+        self.aggregated()
+
+        # Written by another process, the cache doesn't see it
+        self.cache.close()
+        self.db.insert('late message', tag='value1', time='2017-01-02T02:00:00Z')
+        self.assertEqual(self.aggregated()[1]['count_message'], 1)
+
+        time.sleep(0.2)
+        self.assertEqual(self.aggregated()[1]['count_message'], 2)
+
+    def test_eviction(self):
+        self.cache.max_size = cache.ENTRY_BYTES + 20*cache.BUCKET_BYTES
+        self.aggregated(tag='value0')
+        self.aggregated(tag='value1')
+        self.assertEqual(len(self.cache), 1)
+
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.db = segments.SegmentStorage('logsink-test', data_dir=self.data_dir)
+        self.cache = cache.QueryCache(max_size=100000, ttl=60, past_ttl=3600)
+
+        for i in range(9):
+            self.db.insert(
+                'test message %d' % i,
+                tag='value%d' % (i % 2),
+                time='2017-01-0%dT01:00:00Z' % (i + 1)
+            )
+
+    def tearDown(self):
+        self.cache.close()
+        self.db.close()
+        shutil.rmtree(self.data_dir)
+
+    def query(self, **kwargs):
+        kwargs.setdefault('time__gte', '2017-01-01T00:00:00Z')
+        kwargs.setdefault('time__lte', '2017-01-10T00:00:00Z')
+        return self.cache.query(self.db, **kwargs)
+
+    def test_query(self):
+        for kwargs in [{}, {'tag': 'value1'}, {'page': '2', 'per_page': '3'}]:
+            self.assertEqual(self.query(**kwargs), list(self.db.query(
+                time__gte='2017-01-01T00:00:00Z',
+                time__lte='2017-01-10T00:00:00Z',
+                **kwargs
+            )))
+        self.assertEqual(self.cache.misses, 3)
+
+        # Same normalized parameters
+        self.query(time__gte='2017-01-01T00:00:00+00:00', per_page=25)
+        self.assertEqual(self.cache.hits, 1)
+
+        # Windows ending now are cached by their parameters
+        self.cache.query(self.db, tag='value1')
+        self.cache.query(self.db, tag='value1')
+        self.assertEqual(self.cache.hits, 2)
+
+    def test_ttl(self):
+        self.query()
+        self.cache.query(self.db)
+        entries = {entry.key[1].time__lte is None: entry for entry in self.cache._entries.values()}
+        # The window in the past is kept longer
+        self.assertGreater(entries[False].expires - entries[True].expires, 3000)
+
+        entries[False].expires = 0
+        self.query()
+        self.assertEqual(self.cache.misses, 3)
+
+    def test_invalidation(self):
+        self.query()
+        self.query(tag='value0')
+        self.query(time__lte='2017-01-01T23:00:00Z')
+
+        self.db.insert('late message', tag='value1', time='2017-01-02T02:00:00Z')
+        self.assertEqual(self.cache.invalidations, 1)
+        self.assertEqual(len(self.query()), 10)
+        self.assertEqual(len(self.query(tag='value0')), 5)
+
+        self.db.clear(tag='value1', time__gte='2017-01-02T00:00:00Z', time__lte='2017-01-03T00:00:00Z')
+        # The value0 result can't hold value1 rows
+        self.assertEqual(self.cache.invalidations, 2)
+        self.assertEqual(len(self.query()), 8)
+
+        hits = self.cache.hits
+        self.query(tag='value0')
+        self.query(time__lte='2017-01-01T23:00:00Z')
+        self.assertEqual(self.cache.hits, hits + 2)
+
+    def test_insert_nothing(self):
+        self.query()
+        self.cache._inserted('logsink-test', [])
+        self.assertEqual(len(self.cache), 1)
+
+    def test_insert_while_reading(self):
+        rows, entry = self.cache.lookup('logsink-test', time__gte='2017-01-01T00:00:00Z', time__lte='2017-01-10T00:00:00Z')
+        self.assertIsNone(rows)
+        self.db.insert('late message', time='2017-01-02T02:00:00Z')
+        self.cache.store(entry, [])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_eviction(self):
+        self.cache.max_size = cache.ENTRY_BYTES + 9*(cache.ROW_BYTES + 20)
+        self.query()
+        self.query(tag='value1')
+        self.assertEqual(len(self.cache), 1)
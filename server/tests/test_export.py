@@ -0,0 +1,124 @@
+import csv
+import gzip
+import io
+import json
+import shutil
+import tempfile
+import unittest
+
+from logsink_server import export
+from logsink_server import query
+from logsink_server import segments
+from logsink_server import storage
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.db = segments.SegmentStorage('logsink-test', data_dir=self.data_dir)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.data_dir)
+
+    def test_time_slices(self):
+        gte = storage.to_micros('2017-01-01T00:00:00Z')
+        lte = storage.to_micros('2017-01-01T02:30:00Z')
+
+        self.assertEqual(
+            list(export.time_slices(gte, lte, 3600)),
+            [
+                ('2017-01-01T00:00:00Z', '2017-01-01T00:59:59.999999Z'),
+                ('2017-01-01T01:00:00Z', '2017-01-01T01:59:59.999999Z'),
+                ('2017-01-01T02:00:00Z', '2017-01-01T02:30:00Z'),
+            ]
+        )
+
+    def test_slice_boundaries(self):
+        # Records in the last fraction of a second of a slice
+        self.db.insert('test message 1', time='2017-01-01T00:59:59.999Z')
+        self.db.insert('test message 2', time='2017-01-01T01:00:00.25Z')
+        self.db.insert('test message 3', time='2017-01-01T01:59:59.5Z')
+        kwargs = {'time__gte': '2017-01-01T00:00:00Z', 'time__lte': '2017-01-01T02:59:59Z'}
+
+        rows = list(export.iter_rows(self.db, slice_seconds=3600, **kwargs))
+        self.assertEqual(
+            [row['message'] for row in rows],
+            ['test message 1', 'test message 2', 'test message 3']
+        )
+
+        # The InfluxQL of adjacent slices leaves no gap between them
+        gte = storage.to_micros(kwargs['time__gte'])
+        lte = storage.to_micros(kwargs['time__lte'])
+        statements = [
+            query.select_logs(query.compile(time__gte=start, time__lte=end))
+            for start, end in export.time_slices(gte, lte, 3600)
+        ]
+        self.assertIn(
+            "time >= '2017-01-01T00:00:00+00:00' AND time <= '2017-01-01T00:59:59.999999+00:00'",
+            statements[0]
+        )
+        self.assertIn(
+            "time >= '2017-01-01T01:00:00+00:00' AND time <= '2017-01-01T01:59:59.999999+00:00'",
+            statements[1]
+        )
+
+    def test_iter_rows(self):
+        # More slices than threads, several rows at the same time
+        start = storage.to_micros('2017-01-01T00:00:00Z')
+        for minute in range(0, 600, 7):
+            self.db.insert_many([
+                ('test message %d %d' % (minute, i), {
+                    'tag': 'value%d' % (i % 2),
+                    'time': storage.format_micros(start + minute*60000000),
+                })
+                for i in range(3)
+            ])
+
+        kwargs = {'time__gte': '2017-01-01T00:00:00Z', 'time__lte': '2017-01-01T09:59:59Z'}
+        expected = list(storage.iter_query(self.db, **kwargs))
+        self.assertEqual(len(expected), 86*3)
+
+        rows = list(export.iter_rows(self.db, slice_seconds=1800, concurrency=3, **kwargs))
+        self.assertEqual(rows, expected)
+
+        rows = list(export.iter_rows(self.db, slice_seconds=600, concurrency=2, tag='value1', **kwargs))
+        self.assertEqual(rows, [row for row in expected if row['tag'] == 'value1'])
+
+        with self.assertRaises(ValueError):
+            export.iter_rows(self.db, time__gte='2017-01-02T00:00:00Z', time__lte='2017-01-01T00:00:00Z')
+
+    def test_close(self):
+        for i in range(50):
+            self.db.insert('test message %d' % i, time='2017-01-01T00:00:%02dZ' % i)
+
+        rows = export.iter_rows(
+            self.db,
+            slice_seconds=10,
+            time__gte='2017-01-01T00:00:00Z',
+            time__lte='2017-01-01T00:00:59Z'
+        )
+        self.assertEqual(next(rows)['message'], 'test message 0')
+        rows.close()
+
+    def test_formats(self):
+        self.db.insert('test message 1', tag1='value1', time='2017-01-01T00:00:00Z')
+        self.db.insert('test, "message" 2', tag2='value2', time='2017-01-01T00:00:01Z')
+        kwargs = {'time__gte': '2017-01-01T00:00:00Z', 'time__lte': '2017-01-01T00:59:59Z'}
+        rows = list(export.iter_rows(self.db, **kwargs))
+
+        self.assertEqual(self.db.tag_keys(**kwargs), ['tag1', 'tag2'])
+        self.assertEqual(self.db.tag_keys(tag2='value2', **kwargs), ['tag2'])
+
+        data = gzip.decompress(b''.join(export.gzip_chunks(export.csv_lines(rows, ['tag1', 'tag2']))))
+        self.assertEqual(
+            list(csv.reader(io.StringIO(data.decode('utf-8')))),
+            [
+                ['time', 'message', 'tag1', 'tag2'],
+                ['2017-01-01T00:00:00Z', 'test message 1', 'value1', ''],
+                ['2017-01-01T00:00:01Z', 'test, "message" 2', '', 'value2'],
+            ]
+        )
+
+        data = gzip.decompress(b''.join(export.gzip_chunks(export.ndjson_lines(rows))))
+        self.assertEqual([json.loads(line) for line in data.splitlines()], rows)
@@ -0,0 +1,113 @@
+import unittest
+from unittest import mock
+
+from logsink_server import limits
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_wait(self):
+        bucket = limits.TokenBucket(10, 20)
+        self.assertEqual(bucket.wait(20), 0)
+        bucket.take(15)
+        self.assertEqual(bucket.wait(5), 0)
+        self.assertAlmostEqual(bucket.wait(10), 0.5)
+
+        # Refilled at rate, up to capacity
+        bucket.refill(bucket._updated + 0.5)
+        self.assertAlmostEqual(bucket.tokens, 10)
+        bucket.refill(bucket._updated + 10)
+        self.assertEqual(bucket.tokens, 20)
+
+        # Requests larger than the bucket get through when it's full
+        self.assertEqual(bucket.wait(100), 0)
+        bucket.take(100)
+        self.assertAlmostEqual(bucket.wait(1), 8.1)
+
+
+class TestLimiter(unittest.TestCase):
+    def test_admit(self):
+        limiter = limits.Limiter('logsink-test', records_per_second=100, bytes_per_second=1000)
+        now = 1000.0
+        with mock.patch('time.monotonic', return_value=now):
+            for bucket in limiter.buckets.values():
+                bucket._updated = now
+
+            limiter.admit(50, 500)
+            limiter.admit(50, 100)
+            with self.assertRaises(limits.RateLimited) as raised:
+                limiter.admit(1, 100)
+            self.assertEqual(raised.exception.retry_after_header(), '1')
+            # Refused requests take nothing
+            with self.assertRaises(limits.RateLimited):
+                limiter.admit(0, 500)
+
+        with mock.patch('time.monotonic', return_value=now + 0.5):
+            limiter.admit(50, 100)
+
+        usage = limiter.as_dict()
+        self.assertEqual(usage['admitted'], {'records': 150, 'bytes': 700, 'queries': 0})
+        self.assertEqual(usage['limited'], {'records': 1, 'bytes': 1, 'queries': 0})
+
+    def test_queries(self):
+        limiter = limits.Limiter('logsink-test', max_queries=2)
+        limiter.acquire_query()
+        limiter.acquire_query()
+        with self.assertRaises(limits.RateLimited):
+            limiter.acquire_query()
+        limiter.release_query()
+        limiter.acquire_query()
+        self.assertEqual(limiter.as_dict()['running_queries'], 2)
+        # Ingest isn't limited
+        limiter.admit(1000000, 1000000)
+
+
+class TestSettings(unittest.TestCase):
+    def setUp(self):
+        self.settings = limits.settings
+        limits.reset()
+
+    def tearDown(self):
+        limits.settings = self.settings
+        limits.reset()
+
+    def test_parse_limits(self):
+        self.assertEqual(limits.parse_limits(''), {})
+        self.assertEqual(
+            limits.parse_limits('{"*": {"records_per_second": 10, "bytes_per_second": null}}'),
+            {'*': {'records_per_second': 10}}
+        )
+        with self.assertRaises(ValueError):
+            limits.parse_limits('{"*": {"records": 10}}')
+        with self.assertRaises(ValueError):
+            limits.parse_limits('[]')
+
+    def test_query_slot(self):
+        limits.settings = {'logsink': {'max_queries': 1}, '*': {'records_per_second': 1}}
+
+        with limits.query_slot('logsink'):
+            with self.assertRaises(limits.RateLimited):
+                with limits.query_slot('logsink'):
+                    pass
+        with limits.query_slot('logsink'):
+            pass
+        self.assertEqual(limits.get_limiter('logsink').queries, 0)
+
+        # No query limit
+        with limits.query_slot('logsink-test'), limits.query_slot('logsink-test'):
+            pass
+        self.assertIsNotNone(limits.get_limiter('logsink-test'))
+
+        limits.settings = {}
+        limits.reset()
+        self.assertIsNone(limits.get_limiter('logsink'))
+        limits.admit('logsink', 1000000, 1000000)
+
+    def test_usage(self):
+        limits.settings = {'*': {'records_per_second': 10}}
+        limits.admit('logsink', 1, 10)
+        limits.admit('logsink-test', 2, 20)
+
+        self.assertEqual(sorted(limits.usage()), ['logsink', 'logsink-test'])
+        usage = limits.usage('logsink-test')
+        self.assertEqual(list(usage), ['logsink-test'])
+        self.assertEqual(usage['logsink-test']['admitted']['records'], 2)
@@ -0,0 +1,151 @@
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import influxdb
+import logsink.lineprotocol
+
+from logsink_server import lineprotocol
+from logsink_server import segments
+from logsink_server import storage
+
+
+class TestLineProtocol(unittest.TestCase):
+    def test_split_lines(self):
+        body = (
+            b'logs,client_name=test,tag1=value\\ 1 message="test \\"message\\"" 1483232400000000000\n'
+            b'\n'
+            b'logs message="no tags"\r\n'
+            b'cpu,host=a value=1\n'
+            b'logs,page=2 message="reserved tag"\n'
+            b'logs,tag=a\\,page\\=2 message="escaped comma"\n'
+            b'logs,tag=value message=1'
+        )
+        lines, errors = lineprotocol.split_lines(body)
+
+        self.assertEqual([index for index, _ in errors], [2, 3, 5])
+        self.assertIn('reserved', errors[1][1])
+        self.assertIsInstance(lines[0], memoryview)
+        self.assertEqual(lines[0].obj, body)
+        self.assertEqual(
+            [line is not None for line in lines],
+            [True, True, False, False, True, False]
+        )
+        # Lines without a timestamp get the same one, the time they were
+        # received
+        stamp = bytes(lines[1]).rsplit(b' ', 1)[1]
+        self.assertEqual(bytes(lines[4]).rsplit(b' ', 1)[1], stamp)
+        self.assertAlmostEqual(int(stamp)/1e9, time.time(), delta=60)
+        self.assertEqual(
+            lineprotocol.join(lines, body),
+            b'logs,client_name=test,tag1=value\\ 1 message="test \\"message\\"" 1483232400000000000\n'
+            b'logs message="no tags" ' + stamp + b'\n'
+            b'logs,tag=a\\,page\\=2 message="escaped comma" ' + stamp
+        )
+
+        body = b'logs message="a" 1483232400000000000\nlogs message="b" 1483232400000000000\n'
+        lines, errors = lineprotocol.split_lines(body)
+        self.assertEqual(errors, [])
+        # Nothing to copy when all the lines are valid and have a timestamp
+        self.assertIs(lineprotocol.join(lines, body), body)
+
+        lines, errors = lineprotocol.split_lines(b'logs message="a" 1483232400000000000\nlogs message="b"\n')
+        self.assertEqual(errors, [])
+        self.assertIsInstance(lines[1], bytes)
+
+    def test_decode(self):
+        self.assertEqual(
+            lineprotocol.decode(
+                b'logs,client_name=test,tag1=value\\ 1 message="a \\"b\\"\nc\\\\d\\n" 1483232400500000000'
+            ),
+            # \n is not a newline, as for InfluxDB
+            ('a "b"\nc\\d\\n', {
+                'client_name': 'test',
+                'tag1': 'value 1',
+                'time': '2017-01-01T01:00:00.5Z',
+            })
+        )
+
+    def test_client_encoding(self):
+        records = [
+            {'message': 'line 1\nline "2" \\', 'tags': {'client_name': 'test', 'b': 'x,y=z w', 'empty': ''}},
+            {'message': 'test', 'tags': {'time': '2017-01-01T01:00:00.5Z'}},
+        ]
+        body = logsink.lineprotocol.encode(records)
+        # The newline is sent as is, inside the quotes
+        self.assertIn(b'message="line 1\nline \\"2\\" \\\\"', body)
+        lines, errors = lineprotocol.split_lines(body)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lineprotocol.decode_lines(body), [
+            ('line 1\nline "2" \\', {'client_name': 'test', 'b': 'x,y=z w'}),
+            ('test', {'time': '2017-01-01T01:00:00.5Z'}),
+        ])
+
+    def test_embedded_storage(self):
+        data_dir = tempfile.mkdtemp()
+        db = segments.SegmentStorage('logsink-test', data_dir=data_dir)
+        try:
+            errors = db.insert_lines(
+                b'logs,tag=value message="test message" 1483232400000000000\n'
+            )
+            self.assertEqual(errors, [])
+            self.assertEqual(
+                list(db.query(time__gte='2017-01-01T00:00:00Z', time__lte='2017-01-02T00:00:00Z')),
+                [{'time': '2017-01-01T01:00:00Z', 'message': 'test message', 'tag': 'value'}]
+            )
+        finally:
+            db.close()
+            shutil.rmtree(data_dir)
+
+    def test_multiline(self):
+        # The same message on every storage
+        body = logsink.lineprotocol.encode([
+            {'message': 'line 1\n  line "2" \\n', 'tags': {'tag': 'value', 'time': '2017-01-01T01:00:00Z'}},
+        ])
+
+        data_dir = tempfile.mkdtemp()
+        db = segments.SegmentStorage('logsink-test', data_dir=data_dir)
+        try:
+            self.assertEqual(db.insert_lines(body), [])
+            self.assertEqual(
+                [record['message'] for record in db.query(time__gte='2017-01-01T00:00:00Z', time__lte='2017-01-02T00:00:00Z')],
+                ['line 1\n  line "2" \\n']
+            )
+        finally:
+            db.close()
+            shutil.rmtree(data_dir)
+
+        # InfluxDB gets the body as is, only \" and \\ are unescaped in the
+        # message it stores
+        db = storage.InfluxDBStorage.__new__(storage.InfluxDBStorage)
+        db.dbname = 'logsink-test'
+        db.client = mock.Mock()
+        self.assertEqual(db.insert_lines(body), [])
+        self.assertIs(db.client.request.call_args[1]['data'], body)
+        self.assertEqual(body, b'logs,tag=value message="line 1\n  line \\"2\\" \\\\n" 1483232400000000000\n')
+
+    def test_partial_write(self):
+        # InfluxDB rejected some of the lines and stored the others, they're
+        # written again with the same timestamps
+        body = b'logs,tag=a message="test 1"\nlogs,tag=b message="test 2" 1483232400000000000\n'
+        lines, errors = lineprotocol.split_lines(body)
+        data = lineprotocol.join(lines, body)
+
+        db = storage.InfluxDBStorage.__new__(storage.InfluxDBStorage)
+        db.dbname = 'logsink-test'
+        db.client = mock.Mock()
+        db.client.request.side_effect = influxdb.exceptions.InfluxDBClientError('partial write', 400)
+        points = []
+        db.client.write_points.side_effect = points.extend
+        with mock.patch.object(storage, 'write_behind', None):
+            self.assertEqual(db.insert_lines(data), [])
+
+        self.assertEqual(db.client.request.call_args[1]['data'], data)
+        stamp = int(bytes(lines[0]).rsplit(b' ', 1)[1])
+        self.assertEqual(
+            [point['time'] for point in points],
+            [storage.format_micros(stamp//1000), '2017-01-01T01:00:00Z']
+        )
@@ -0,0 +1,60 @@
+import unittest
+
+from logsink_server import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registered = list(metrics._metrics)
+
+    def tearDown(self):
+        metrics._metrics[:] = self.registered
+
+    def test_counter(self):
+        counter = metrics.Counter('test_total', 'Test counter.', ['reason'])
+        counter.inc(reason='a')
+        counter.inc(2, reason='a')
+        counter.inc(reason='b "quoted"')
+
+        self.assertEqual(counter.value(reason='a'), 3)
+        text = metrics.render()
+        self.assertIn('# TYPE test_total counter\n', text)
+        self.assertIn('test_total{reason="a"} 3\n', text)
+        self.assertIn('test_total{reason="b \\"quoted\\""} 1\n', text)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Test histogram.', ['stage'], buckets=[0.1, 1])
+        for value in [0.05, 0.1, 0.5, 5]:
+            histogram.observe(value, stage='parse')
+
+        self.assertEqual(histogram.count(stage='parse'), 4)
+        lines = [line for line in metrics.render().splitlines() if line.startswith('test_seconds')]
+        self.assertEqual(lines, [
+            'test_seconds_bucket{stage="parse",le="0.1"} 2',
+            'test_seconds_bucket{stage="parse",le="1"} 3',
+            'test_seconds_bucket{stage="parse",le="+Inf"} 4',
+            'test_seconds_count{stage="parse"} 4',
+            'test_seconds_sum{stage="parse"} 5.65',
+        ])
+
+    def test_gauge(self):
+        metrics.Gauge('test_connections', 'Test gauge.', ['state'], callback=lambda: {('idle',): 2})
+        metrics.Gauge('test_broken', 'Failing gauge.', callback=lambda: 1/0)
+
+        text = metrics.render()
+        self.assertIn('test_connections{state="idle"} 2\n', text)
+        self.assertIn('# TYPE test_broken gauge\n', text)
+
+    def test_slow_query(self):
+        with self.assertLogs('logsink_server.metrics', 'WARNING') as logs:
+            with metrics.timed_query('influxdb_query', 'SELECT * FROM logs'):
+                pass
+            metrics.SLOW_QUERY_SECONDS, slow = 0, metrics.SLOW_QUERY_SECONDS
+            try:
+                with metrics.timed_query('influxdb_query', 'SELECT * FROM logs WHERE slow'):
+                    pass
+            finally:
+                metrics.SLOW_QUERY_SECONDS = slow
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('SELECT * FROM logs WHERE slow', logs.output[0])
@@ -0,0 +1,148 @@
+import datetime
+import unittest
+
+import pytz
+
+from logsink_server import query
+from logsink_server import storage
+
+
+class TestQuery(unittest.TestCase):
+    def test_compile(self):
+        compiled = query.compile(
+            time__gte='2017-01-01T00:00:00Z',
+            time__lte='2017-01-02 12:00',
+            tag2='value2',
+            tag1='value1',
+            per_page='10',
+            page='3'
+        )
+        self.assertEqual(compiled.time__gte, datetime.datetime(2017, 1, 1, tzinfo=pytz.utc))
+        self.assertEqual(compiled.time__lte, datetime.datetime(2017, 1, 2, 12, tzinfo=pytz.utc))
+        self.assertEqual(compiled.tags, (('tag1', 'value1'), ('tag2', 'value2')))
+        self.assertEqual(compiled.offset, 20)
+        self.assertIsNone(compiled.message)
+
+        # Compiled once, in any parameter order
+        self.assertIs(compiled, query.compile(
+            tag1='value1',
+            tag2='value2',
+            time__gte='2017-01-01T00:00:00Z',
+            time__lte='2017-01-02 12:00',
+            page='3',
+            per_page='10'
+        ))
+        hash(compiled)
+
+        with self.assertRaises(ValueError):
+            query.compile(time__gte='2017-01-02T00:00:00Z', time__lte='2017-01-01T00:00:00Z')
+        with self.assertRaises(ValueError):
+            query.compile(time__gte='not a time')
+
+    def test_parse_time(self):
+        for value in [
+                '2017-01-01T01:00:00Z',
+                '2017-01-01T01:00:00+00:00',
+                '2017-01-01T02:00:00+01:00',
+                '2017-01-01 01:00:00',
+                'Jan 1 2017 01:00 UTC']:
+            self.assertEqual(
+                query.parse_time(value),
+                datetime.datetime(2017, 1, 1, 1, tzinfo=pytz.utc),
+                value
+            )
+        self.assertEqual(
+            query.parse_time('2017-01-01T01:00:00.123456789Z').microsecond,
+            123456
+        )
+
+    def test_default_range(self):
+        compiled = query.compile()
+        self.assertEqual(
+            compiled.time__lte - compiled.time__gte,
+            datetime.timedelta(days=storage.DEFAULT_QUERY_DAY_SPAN)
+        )
+        self.assertFalse(compiled.time_given)
+
+    def test_influxql(self):
+        compiled = query.compile(
+            time__gte='2017-01-01T00:00:00Z',
+            time__lte='2017-01-02T00:00:00Z',
+            message='test [0-9]+',
+            tag='value'
+        )
+        self.assertEqual(
+            query.select_logs(compiled),
+            "SELECT * FROM logs WHERE time >= '2017-01-01T00:00:00+00:00' AND "
+            "time <= '2017-01-02T00:00:00+00:00' AND \"message\" =~ /test [0-9]+/ AND "
+            "\"tag\" = 'value' LIMIT 25 OFFSET 0;"
+        )
+        self.assertEqual(
+            query.count_logs(compiled, 3600),
+            "SELECT COUNT(*) FROM logs WHERE time >= '2017-01-01T00:00:00+00:00' AND "
+            "time <= '2017-01-02T00:00:00+00:00' AND \"message\" =~ /test [0-9]+/ AND "
+            "\"tag\" = 'value' GROUP BY time(3600s);"
+        )
+        self.assertEqual(query.tag_filter(compiled), "\"tag\" = 'value'")
+        self.assertEqual(
+            query.select_logs(query.compile(time__lte='2017-01-02T00:00:00Z', page=2)),
+            "SELECT * FROM logs WHERE time >= '2016-12-23T00:00:00+00:00' AND "
+            "time <= '2017-01-02T00:00:00+00:00' LIMIT 25 OFFSET 25;"
+        )
+
+        # Without time bounds all times are cleared
+        self.assertEqual(
+            query.delete_logs(query.compile(tag='value', message='test')),
+            "DELETE FROM logs WHERE \"tag\" = 'value';"
+        )
+        self.assertEqual(query.delete_logs(query.compile()), 'DELETE FROM logs;')
+
+    def test_cursor(self):
+        cursor = storage.encode_cursor('2017-01-01T01:00:00Z', 2)
+        compiled = query.compile(
+            time__gte='2017-01-01T00:00:00Z',
+            time__lte='2017-01-02T00:00:00Z',
+            cursor=cursor
+        )
+        self.assertEqual(compiled.offset, 2)
+        self.assertEqual(compiled.start, datetime.datetime(2017, 1, 1, 1, tzinfo=pytz.utc))
+        self.assertIn("time >= '2017-01-01T01:00:00Z'", query.select_logs(compiled))
+        self.assertEqual(query.compile(cursor='').offset, 0)
+
+        with self.assertRaises(ValueError):
+            query.compile(cursor='not a cursor')
+
+    def test_escaping(self):
+        compiled = query.compile(
+            time__gte='2017-01-01T00:00:00Z',
+            time__lte='2017-01-02T00:00:00Z',
+            message="a/b\\/c",
+            **{'tag" = \'x\' OR "1': "value' OR 'a' = 'a", '100%': 'back\\slash'}
+        )
+        self.assertEqual(
+            query.select_logs(compiled),
+            "SELECT * FROM logs WHERE time >= '2017-01-01T00:00:00+00:00' AND "
+            "time <= '2017-01-02T00:00:00+00:00' AND \"message\" =~ /a\\/b\\/c/ AND "
+            "\"100%\" = 'back\\\\slash' AND "
+            "\"tag\\\" = 'x' OR \\\"1\" = 'value\\' OR \\'a\\' = \\'a' "
+            "LIMIT 25 OFFSET 0;"
+        )
+
+    def test_regex_trailing_backslash(self):
+        # The backslash mustn't escape the closing / and let the next value
+        # out of its quotes
+        compiled = query.compile(
+            time__gte='2017-01-01T00:00:00Z',
+            time__lte='2017-01-02T00:00:00Z',
+            message='abc\\',
+            t='/ ; DROP DATABASE x ; x'
+        )
+        self.assertEqual(
+            query.select_logs(compiled),
+            "SELECT * FROM logs WHERE time >= '2017-01-01T00:00:00+00:00' AND "
+            "time <= '2017-01-02T00:00:00+00:00' AND \"message\" =~ /abc\\\\/ AND "
+            "\"t\" = '/ ; DROP DATABASE x ; x' LIMIT 25 OFFSET 0;"
+        )
+        self.assertEqual(query.quote_regex('a\\\\'), '/a\\\\/')
+        self.assertEqual(query.quote_regex('a\\\\\\'), '/a\\\\\\\\/')
+        self.assertEqual(query.quote_regex('a\\/'), '/a\\//')
@@ -0,0 +1,137 @@
+import unittest
+from unittest import mock
+
+from logsink_server import retention
+from logsink_server import rollup
+from logsink_server import storage
+
+
+class TestRetention(unittest.TestCase):
+    def test_parse_duration(self):
+        self.assertEqual(retention.parse_duration('90'), 90)
+        self.assertEqual(retention.parse_duration(90), 90)
+        self.assertEqual(retention.parse_duration('30m'), 1800)
+        self.assertEqual(retention.parse_duration('7d'), 7*86400)
+        self.assertEqual(retention.parse_duration('2w'), 14*86400)
+        self.assertIsNone(retention.parse_duration(None))
+        for value in ['0d', '7 days', '-1', '1.5h']:
+            with self.assertRaises(ValueError):
+                retention.parse_duration(value)
+
+        self.assertEqual(retention.parse_influxdb_duration('168h0m0s'), 7*86400)
+        self.assertIsNone(retention.parse_influxdb_duration('0s'))
+
+    def test_parse_policies(self):
+        policies = retention.parse_policies(
+            '{"logsink": {"ttl": "7d", "rollups": {"logs_rollup_1h": null}}, "*": {"ttl": "1d"}}'
+        )
+        self.assertEqual(policies['logsink'], retention.Policy(7*86400, {'logs_rollup_1h': None}))
+        self.assertEqual(policies['*'], retention.Policy(86400, {}))
+        self.assertEqual(retention.parse_policies(''), {})
+        with self.assertRaises(ValueError):
+            retention.parse_policies('[]')
+
+    def test_measurement(self):
+        policies, retention.policies = retention.policies, {
+            'logsink': retention.Policy(86400, {'logs_rollup_1h': None}),
+        }
+        try:
+            self.assertEqual(
+                retention.measurement('logsink', 'logs_rollup_1h'),
+                '"logs_rollup_1h"."logs_rollup_1h"'
+            )
+            self.assertEqual(retention.measurement('logsink', 'logs'), '"logs"')
+            self.assertEqual(retention.measurement('other', 'logs_rollup_1h'), '"logs_rollup_1h"')
+        finally:
+            retention.policies = policies
+
+    def test_covered(self):
+        day = 86400*1000000
+        shards = [
+            retention.Shard(i, 'autogen', i*day, (i + 1)*day, None) for i in range(5)
+        ]
+
+        inside, partial = retention.covered(shards, day, 3*day)
+        self.assertEqual([shard.id for shard in inside], [1, 2])
+        self.assertEqual([shard.id for shard in partial], [3])
+
+        inside, partial = retention.covered(shards, day + 1, 3*day - 1)
+        self.assertEqual([shard.id for shard in inside], [2])
+        self.assertEqual([shard.id for shard in partial], [1])
+
+        inside, partial = retention.covered(shards, float('-inf'), float('inf'))
+        self.assertEqual(len(inside), 5)
+        self.assertEqual(partial, [])
+
+
+DAY = 86400*1000000  # microseconds
+
+
+class FakeClient:
+    """InfluxDB client with day long shards in the default retention policy."""
+
+    def __init__(self, days):
+        self.days = days
+        self.queries = []
+
+    def get_list_retention_policies(self, dbname):
+        return [
+            {'name': 'autogen', 'default': True, 'duration': '0s'},
+            {'name': 'logs_rollup_1h', 'default': False, 'duration': '0s'},
+        ]
+
+    def query(self, statement):
+        self.queries.append(statement)
+        result = mock.Mock()
+        if statement == 'SHOW SHARDS;':
+            result.get_points.return_value = [
+                {
+                    'id': day,
+                    'retention_policy': 'autogen',
+                    'start_time': storage.format_micros(day*DAY),
+                    'end_time': storage.format_micros((day + 1)*DAY),
+                    'expiry_time': storage.format_micros((day + 1)*DAY),
+                }
+                for day in range(self.days)
+            ]
+        return result
+
+
+class TestDropWindow(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(retention, 'policies', {
+            'logsink': retention.Policy(86400, {'logs_rollup_1h': None}),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_drop(self):
+        client = FakeClient(5)
+        self.assertTrue(retention.drop_window(client, 'logsink', DAY, 3*DAY - 1, ['logs_rollup_1h']))
+        self.assertEqual(client.queries[1:], ['DROP SHARD 1;', 'DROP SHARD 2;'])
+
+    def test_shared_rollups(self):
+        # The rollups without a retention policy of their own are in the
+        # shards of the logs, nothing is dropped
+        for dbname, measurements in [('logsink', ['logs_rollup_1m', 'logs_rollup_1h']), ('other', ['logs_rollup_1h'])]:
+            client = FakeClient(5)
+            self.assertFalse(retention.drop_window(client, dbname, DAY, 3*DAY - 1, measurements))
+            self.assertEqual(client.queries, [])
+
+    def test_clear(self):
+        # Points deleted instead, the rollups of the window are rolled up
+        # again
+        downsampler = rollup.Downsampler()
+        self.addCleanup(downsampler.close)
+        state = downsampler._states['other'] = {'logs_rollup_1h': rollup.RollupState(watermark=5*86400)}
+        db = storage.InfluxDBStorage.__new__(storage.InfluxDBStorage)
+        db.dbname = 'other'
+        db.client = FakeClient(5)
+        db._query = db.client.query
+
+        with mock.patch.object(storage, 'downsampler', downsampler):
+            db.clear(time__gte=storage.format_micros(DAY), time__lte=storage.format_micros(3*DAY - 1))
+
+        self.assertEqual(len(db.client.queries), 1)
+        self.assertTrue(db.client.queries[0].startswith('DELETE FROM logs WHERE'))
+        self.assertEqual(state['logs_rollup_1h'].dirty, [(86400, 3*86400)])
@@ -0,0 +1,208 @@
+import collections
+import re
+import unittest
+
+from logsink_server import rollup
+from logsink_server import storage
+
+
+BASE = 1483228800  # 2017-01-01T00:00:00Z
+
+
+class FakeResult:
+    def __init__(self, points):
+        self.points = points
+
+    def get_points(self):
+        return iter(self.points)
+
+
+class FakeInfluxDB:
+    """The histogram queries of Downsampler over raw points and rollups.
+
+    The rollups hold what downsample would write: the counts of the raw
+    points per period and client_name."""
+
+    QUERY_RE = re.compile(
+        r'SELECT (?:COUNT\(message\)|SUM\("count"\)) AS "count" FROM "(\w+)" '
+        r"WHERE time >= '([^']+)' AND time (<|<=) '([^']+)'"
+        r'''(?: AND "client_name" = '([^']*)')? GROUP BY time\((\d+)s\);'''
+    )
+
+    def __init__(self, points, rollups):
+        self.dbname = 'logsink-test'
+        self.points = points  # (seconds since epoch, client_name)
+        self.rollups = {}  # measurement -> [(period start, client_name, count)]
+        for measurement, period in rollups:
+            counts = collections.Counter((t//period*period, client) for t, client in points)
+            self.rollups[measurement] = [(t, client, count) for (t, client), count in counts.items()]
+        self.queries = []
+
+    def _query(self, statement):
+        self.queries.append(statement)
+        match = self.QUERY_RE.match(statement)
+        measurement, gte, op, lte, client_name, interval = match.groups()
+        gte = storage.to_micros(gte)
+        lte = storage.to_micros(lte)
+        interval = int(interval)*1000000
+
+        if measurement == 'logs':
+            rows = [(t, client, 1) for t, client in self.points]
+        else:
+            rows = self.rollups[measurement]
+        counts = collections.Counter()
+        for t, client, count in rows:
+            t *= 1000000
+            if gte <= t and (t < lte if op == '<' else t <= lte) and client_name in (None, client):
+                counts[t//interval*interval] += count
+
+        return FakeResult([
+            {'time': storage.format_micros(t), 'count': counts[t] or None}
+            for t in range(gte//interval*interval, lte + 1, interval)
+        ])
+
+
+class TestRollupPlan(unittest.TestCase):
+    def setUp(self):
+        self.downsampler = rollup.Downsampler()
+        self.states = self.downsampler._states['logsink-test'] = {
+            'logs_rollup_1m': rollup.RollupState(watermark=7*86400),
+            'logs_rollup_1h': rollup.RollupState(watermark=7*86400 - 3600),
+        }
+
+    def tearDown(self):
+        self.downsampler.close()
+
+    def plan(self, interval, gte, lte, **kwargs):
+        result = self.downsampler.plan('logsink-test', interval, gte, lte, **kwargs)
+        if result is None:
+            return None
+        return result[0].measurement, result[1], result[2]
+
+    def test_plan(self):
+        # The coarsest rollup which divides the interval, raw edges
+        self.assertEqual(
+            self.plan(86400, 30, 10*86400),
+            ('logs_rollup_1h', 3600, 7*86400 - 3600)
+        )
+        self.assertEqual(
+            self.plan(600, 30, 3000, client_name='test'),
+            ('logs_rollup_1m', 60, 3000)
+        )
+        # Not divisible, filtered by a message or a tag which isn't rolled up
+        self.assertIsNone(self.plan(601, 30, 3000))
+        self.assertIsNone(self.plan(600, 30, 3000, message='test'))
+        self.assertIsNone(self.plan(600, 30, 3000, host='test'))
+        # Less than a period
+        self.assertIsNone(self.plan(60, 30, 80))
+
+    def test_invalidation(self):
+        self.states['logs_rollup_1h'].invalidate(7200, 10800)
+        self.assertEqual(
+            self.plan(86400, 0, 10*86400),
+            ('logs_rollup_1m', 0, 7*86400)
+        )
+
+        self.states['logs_rollup_1m'].reset = True
+        self.assertIsNone(self.plan(86400, 0, 10*86400))
+
+    def test_align_interval(self):
+        self.assertEqual(self.downsampler.align_interval(90000 + 17), 90000)
+        self.assertEqual(self.downsampler.align_interval(617), 600)
+        self.assertEqual(self.downsampler.align_interval(599), 599)
+
+    def test_add_range(self):
+        ranges = []
+        for start, end in [(10, 20), (30, 40), (20, 25), (0, 5), (35, 50)]:
+            rollup._add_range(ranges, start, end)
+        self.assertEqual(ranges, [(0, 5), (10, 25), (30, 50)])
+
+
+class TestRollupHistogram(unittest.TestCase):
+    def setUp(self):
+        self.downsampler = rollup.Downsampler()
+
+        # A point every 7 seconds for 8 hours, on the period boundaries too
+        points = [(BASE + t, 'client-%d' % (t % 3)) for t in range(0, 8*3600, 7)]
+        points += [(BASE + t, 'client-0') for t in (60, 3600, 4*3600, 5*3600 - 1)]
+        self.db = FakeInfluxDB(points, [(r.measurement, r.period) for r in rollup.ROLLUPS])
+
+    def tearDown(self):
+        self.downsampler.close()
+
+    def set_watermarks(self, minutes, hours):
+        self.downsampler._states['logsink-test'] = {
+            'logs_rollup_1m': rollup.RollupState(watermark=BASE + minutes),
+            'logs_rollup_1h': rollup.RollupState(watermark=BASE + hours),
+        }
+
+    def raw_histogram(self, interval, gte, lte, client_name=None):
+        counts = collections.Counter(
+            t//interval*interval for t, client in self.db.points
+            if gte <= t <= lte and client_name in (None, client)
+        )
+        return [
+            {'time': storage.format_micros(t*1000000), 'count_message': counts[t]}
+            for t in range(int(gte)//interval*interval, int(lte) + 1, interval)
+        ]
+
+    def histogram(self, interval, gte, lte, **kwargs):
+        return self.downsampler.histogram(
+            self.db,
+            interval,
+            time__gte=storage.format_micros(round((BASE + gte)*1000000)),
+            time__lte=storage.format_micros(round((BASE + lte)*1000000)),
+            **kwargs
+        )
+
+    def rollups_read(self):
+        return [
+            statement.split(' FROM ')[1].split()[0]
+            for statement in self.db.queries
+        ]
+
+    def test_minutes(self):
+        # Partial first and last intervals, the edges are counted from the
+        # raw points
+        self.set_watermarks(minutes=4200, hours=3600)
+        rows = self.histogram(600, 210, 4665)
+        self.assertEqual(rows, self.raw_histogram(600, BASE + 210, BASE + 4665))
+        self.assertEqual(self.rollups_read(), ['"logs"', '"logs_rollup_1m"', '"logs"'])
+
+    def test_hours(self):
+        self.set_watermarks(minutes=6*3600, hours=5*3600)
+        rows = self.histogram(7200, 1800, 6*3600 - 1)
+        self.assertEqual(rows, self.raw_histogram(7200, BASE + 1800, BASE + 6*3600 - 1))
+        self.assertEqual(self.rollups_read(), ['"logs"', '"logs_rollup_1h"', '"logs"'])
+
+    def test_aligned(self):
+        # No raw edge before the rollup, the point at lte is counted
+        self.set_watermarks(minutes=6*3600, hours=5*3600)
+        rows = self.histogram(3600, 0, 4*3600)
+        self.assertEqual(rows, self.raw_histogram(3600, BASE, BASE + 4*3600))
+        # The last interval is only the point at 04:00:00
+        self.assertEqual(rows[-1], {'time': '2017-01-01T04:00:00Z', 'count_message': 1})
+        self.assertEqual(self.rollups_read(), ['"logs_rollup_1h"', '"logs"'])
+
+    def test_sub_second(self):
+        # The point at 210s is before the window, as for the raw histogram
+        self.set_watermarks(minutes=4200, hours=3600)
+        rows = self.histogram(600, 210.5, 4661.25)
+        self.assertEqual(rows, self.raw_histogram(600, BASE + 210.5, BASE + 4661.25))
+        self.assertEqual(rows[0]['count_message'], self.raw_histogram(600, BASE + 210, BASE + 600)[0]['count_message'] - 1)
+        self.assertEqual(self.rollups_read(), ['"logs"', '"logs_rollup_1m"', '"logs"'])
+        self.assertIn("time >= '2017-01-01T00:03:30.5Z'", self.db.queries[0])
+        self.assertIn("time <= '2017-01-01T01:17:41.25Z'", self.db.queries[2])
+
+    def test_tags(self):
+        self.set_watermarks(minutes=4200, hours=3600)
+        rows = self.histogram(600, 210, 4665, client_name='client-0')
+        self.assertEqual(rows, self.raw_histogram(600, BASE + 210, BASE + 4665, 'client-0'))
+
+    def test_dirty(self):
+        # A late write in a rolled up hour: the minutes are used instead
+        self.set_watermarks(minutes=6*3600, hours=5*3600)
+        self.downsampler._states['logsink-test']['logs_rollup_1h'].invalidate(BASE + 3600, BASE + 7200)
+        rows = self.histogram(7200, 1800, 6*3600 - 1)
+        self.assertEqual(rows, self.raw_histogram(7200, BASE + 1800, BASE + 6*3600 - 1))
+        self.assertIn('"logs_rollup_1m"', self.rollups_read())
@@ -0,0 +1,276 @@
+import itertools
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from logsink_server import index
+from logsink_server import segments
+from logsink_server import storage
+
+
+class TestSegmentStorage(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.db = self.open()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.data_dir)
+
+    def open(self, **kwargs):
+        return segments.SegmentStorage('logsink-test', data_dir=self.data_dir, **kwargs)
+
+    def query(self, db=None, **kwargs):
+        kwargs.setdefault('time__gte', '2017-01-01T00:00:00Z')
+        kwargs.setdefault('time__lte', '2017-01-10T00:00:00Z')
+        return list((db or self.db).query(**kwargs))
+
+    def test_insert_query(self):
+        self.db.insert('test message 2', tag='value1', time='2017-01-02T01:00:00Z')
+        self.db.insert('test message 1', tag='value2', time='2017-01-01T01:00:00.5Z')
+        # Outside of the queried time range
+        self.db.insert('test message 3', tag='value1', time='2017-02-01T01:00:00Z')
+
+        self.assertEqual(
+            self.query(),
+            [
+                {'time': '2017-01-01T01:00:00.5Z', 'message': 'test message 1', 'tag': 'value2'},
+                {'time': '2017-01-02T01:00:00Z', 'message': 'test message 2', 'tag': 'value1'},
+            ]
+        )
+        self.assertEqual(len(self.query(tag='value1')), 1)
+        self.assertEqual(len(self.query(message='message [12]$')), 2)
+        self.assertEqual(len(self.query(message='message 1', tag='value1')), 0)
+
+        with self.assertRaises(ValueError):
+            self.db.insert('test message', page='1')
+
+    def test_pagination(self):
+        # Several rows at the same time are told apart by insertion order
+        for i in range(5):
+            self.db.insert('test message %d' % i, time='2017-01-01T01:00:0%dZ' % (i // 2))
+
+        page = self.query(page=2, per_page=2)
+        self.assertEqual([row['message'] for row in page], ['test message 2', 'test message 3'])
+
+        messages = []
+        kwargs = {'cursor': '', 'per_page': 2}
+        while True:
+            rows = self.query(**kwargs)
+            messages.extend(row['message'] for row in rows)
+            kwargs['cursor'] = segments.storage.next_cursor(rows, **kwargs)
+            if kwargs['cursor'] is None:
+                break
+        self.assertEqual(messages, ['test message %d' % i for i in range(5)])
+
+    def test_aggregated(self):
+        self.db.insert('test message', time='2017-01-01T01:00:00Z')
+        self.db.insert('test message', time='2017-01-02T01:00:00Z')
+        self.db.insert('test message', time='2017-01-02T02:00:00Z')
+
+        result = list(self.db.aggregated(
+            time__gte='2017-01-01T00:00:00Z',
+            time__lte='2017-01-10T00:00:00Z'
+        ))
+        self.assertEqual(len(result), 10)
+        self.assertEqual(result[0], {'time': '2017-01-01T00:00:00Z', 'count_message': 1})
+        self.assertEqual(result[1], {'time': '2017-01-02T00:00:00Z', 'count_message': 2})
+        self.assertEqual(sum(row['count_message'] for row in result), 3)
+
+    def test_histogram_sparse(self):
+        # A year of one-second intervals, only the records are counted
+        self.db.insert('test message', time='2017-01-01T00:00:01.5Z')
+
+        rows = self.db.histogram(1, time__gte='2017-01-01T00:00:00.2Z', time__lte='2018-01-01T00:00:00Z')
+        self.assertEqual(list(itertools.islice(rows, 3)), [
+            {'time': '2017-01-01T00:00:00Z', 'count_message': 0},
+            {'time': '2017-01-01T00:00:01Z', 'count_message': 1},
+            {'time': '2017-01-01T00:00:02Z', 'count_message': 0},
+        ])
+
+    def test_insert_many_partitions(self):
+        # More segments than MAX_OPEN_SEGMENTS written by one insert
+        errors = self.db.insert_many([
+            ('test message %d' % i, {'time': '2017-01-%02dT01:00:00Z' % (i + 1)})
+            for i in range(segments.MAX_OPEN_SEGMENTS + 4)
+        ])
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.query(time__lte='2017-02-01T00:00:00Z', per_page=100)),
+                         segments.MAX_OPEN_SEGMENTS + 4)
+
+    def test_clear(self):
+        self.db.insert('test message 1', tag='value1', time='2017-01-01T01:00:00Z')
+        self.db.insert('test message 2', tag='value1', time='2017-01-02T01:00:00Z')
+        self.db.insert('test message 3', tag='value2', time='2017-01-02T01:00:00Z')
+
+        self.db.clear(tag='value1', time__gte='2017-01-02T00:00:00Z')
+        self.assertEqual(
+            [row['message'] for row in self.query()],
+            ['test message 1', 'test message 3']
+        )
+
+        self.db.clear(tag='value2')
+        self.assertEqual([row['message'] for row in self.query()], ['test message 1'])
+
+        self.db.clear()
+        self.assertEqual(self.query(), [])
+        self.assertEqual(os.listdir(self.db.path), [])
+
+    def test_clear_window(self):
+        for time in ['00:30', '01:10', '02:20', '03:00', '03:10']:
+            self.db.insert('test message %s' % time, time='2017-01-01T%s:00Z' % time)
+
+        # Partitions inside the window are dropped, the edges are rewritten
+        self.db.clear(time__gte='2017-01-01T01:00:00Z', time__lte='2017-01-01T03:00:00Z')
+        self.assertEqual(
+            [row['message'] for row in self.query()],
+            ['test message 00:30', 'test message 03:10']
+        )
+        self.assertEqual(sorted(os.listdir(self.db.path)), ['1483228800', '1483239600'])
+
+    def test_clear_while_reading(self):
+        # Readers which took their snapshot before a clear keep reading the
+        # records they saw, the segment files were replaced or removed
+        for time in ['01:10', '01:20', '02:10']:
+            self.db.insert('test message %s' % time, time='2017-01-01T%s:00Z' % time)
+        gte, lte = storage.to_micros('2017-01-01T00:00:00Z'), storage.to_micros('2017-01-01T03:00:00Z')
+        snapshot = self.db._snapshot(gte, lte)
+
+        self.db.clear(time__gte='2017-01-01T01:15:00Z', time__lte='2017-01-01T03:00:00Z')
+        self.assertEqual([row['message'] for row in self.query()], ['test message 01:10'])
+
+        matches = segments.Filter()
+        self.assertEqual(
+            [record['m'] for partition in snapshot for _, _, record in self.db._records(*partition, matches)],
+            ['test message 01:10', 'test message 01:20', 'test message 02:10']
+        )
+
+    def test_expire(self):
+        self.db.insert('test message 1', time='2017-01-01T01:00:00Z')
+        self.db.insert('test message 2', time='2017-01-01T02:30:00Z')
+
+        self.db.expire(storage.to_micros('2017-01-01T02:30:00Z'))
+        self.assertEqual([row['message'] for row in self.query()], ['test message 2'])
+        self.assertEqual(os.listdir(self.db.path), ['1483236000'])
+
+        (shard, size), = self.db.usage()
+        self.assertEqual(shard.start, storage.to_micros('2017-01-01T02:00:00Z'))
+        self.assertEqual(shard.end, storage.to_micros('2017-01-01T03:00:00Z'))
+        self.assertIsNone(shard.expires)
+        self.assertGreater(size, 0)
+
+    def test_reopen(self):
+        db = self.open(segment_max_bytes=100)
+        for i in range(5):
+            db.insert('test message %d' % i, time='2017-01-01T01:00:00Z')
+        db.close()
+
+        # Simulate a crash in the middle of a write
+        partition = os.path.join(self.db.path, os.listdir(self.db.path)[0])
+        last_segment = os.path.join(partition, sorted(os.listdir(partition))[-1])
+        with open(last_segment, 'ab') as f:
+            f.write(b'{"t": 1483232400')
+
+        db = self.open(segment_max_bytes=100)
+        self.assertGreater(len(os.listdir(partition)), 1)
+        db.insert('test message 5', time='2017-01-01T01:00:00Z')
+        self.assertEqual(
+            [row['message'] for row in self.query(db)],
+            ['test message %d' % i for i in range(6)]
+        )
+        db.close()
+
+
+class TestMessageIndex(TestSegmentStorage):
+    def open(self, **kwargs):
+        return super().open(message_index=True, **kwargs)
+
+    def test_message_search(self):
+        messages = [
+            'Request failed with E1234',
+            'request failed with E4321',
+            'Request OK',
+            'E12 is not E1234',
+        ]
+        for i, message in enumerate(messages):
+            self.db.insert(message, time='2017-01-01T01:00:0%dZ' % i)
+
+        def search(db, pattern):
+            return [row['message'] for row in self.query(db, message=pattern)]
+
+        for pattern in ['E1234', 'failed', 'Request', r'E\d+', 'E12(34)?', '^Request OK$', 'xyz']:
+            expected = [message for message in messages if re.search(pattern, message)]
+            self.assertEqual(search(self.db, pattern), expected, pattern)
+
+        self.db.clear(message='E4321')
+        self.assertEqual(search(self.db, 'failed'), [messages[0]])
+
+        # The index is rebuilt when the storage is opened again
+        db = self.open()
+        self.assertEqual(search(db, 'E1234'), [messages[0], messages[3]])
+        db.close()
+
+    def test_required_literals(self):
+        for pattern, literals in [
+                ('E1234', ['E1234']),
+                ('error: E1234$', ['error: E1234']),
+                (r'file\.py:\d+', ['file.py:']),
+                ('abc?d', ['ab', 'd']),
+                ('ab+c[xyz]*def', ['ab', 'c', 'def']),
+                ('a(bcd)?efg', ['a', 'efg']),
+                ('foo|bar', []),
+                ('(?i)foo', [])]:
+            self.assertEqual(index.required_literals(pattern), literals, pattern)
+
+    def test_posting_list(self):
+        posting_list = index.PostingList()
+        numbers = [0, 1, 127, 128, 300, 100000]
+        for number in numbers:
+            posting_list.append(number)
+        self.assertEqual(list(posting_list), numbers)
+        self.assertEqual(len(posting_list), len(numbers))
+
+        other = index.PostingList()
+        for number in [1, 2, 300, 100001]:
+            other.append(number)
+        self.assertEqual(index.intersect([posting_list, other]), [1, 300])
+
+
+class TestTagIndex(TestSegmentStorage):
+    def open(self, **kwargs):
+        return super().open(tag_index=True, **kwargs)
+
+    def test_multi_tag_filter(self):
+        for i in range(20):
+            self.db.insert(
+                'test message %d' % i,
+                host='host%d' % (i % 2),
+                level='error' if i % 5 == 0 else 'info',
+                shard=i % 4,
+                time='2017-01-01T01:00:%02dZ' % i
+            )
+
+        rows = self.query(host='host0', level='error')
+        self.assertEqual([row['message'] for row in rows], ['test message 0', 'test message 10'])
+        self.assertEqual(self.query(host='host0', level='debug'), [])
+        # Tag values are strings, whatever the type of the filter value
+        self.assertEqual(len(self.query(shard=1)), 5)
+        self.assertEqual(len(self.query(shard='1', host='host1')), 5)
+
+        partition_index = list(self.db._partitions.values())[0].index
+        self.assertEqual(len(partition_index.candidates({'host': 'host0'})), 10)
+        self.assertEqual(partition_index.candidates({'level': 'error', 'host': 'host0'}), [0, 10])
+        self.assertEqual(partition_index.candidates({'level': 'error', 'shard': 0}), [0])
+        self.assertEqual(partition_index.candidates({'level': 'debug'}), [])
+
+        self.db.clear(level='error')
+        self.assertEqual(len(self.query(per_page=100)), 16)
+        self.assertEqual(self.query(level='error'), [])
+        self.assertEqual(len(self.query(host='host1', per_page=100)), 8)
+
+
+class TestAllIndexes(TestMessageIndex):
+    def open(self, **kwargs):
+        return super().open(tag_index=True, **kwargs)
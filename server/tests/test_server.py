@@ -1,8 +1,15 @@
+import csv
+import gzip
+import json
 import os
+import shutil
+import tempfile
+import threading
 import unittest
 import time
 
 import logsink
+import requests
 
 
 TEST_TOKEN = os.environ['TEST_TOKEN']
@@ -114,3 +121,232 @@ class TestServer(unittest.TestCase):
 
         query_r = self.client.query()
         self.assertEqual(len(query_r), 1)
+
+    def test_batch_insert(self):
+        client = logsink.Client(
+            self.client_name,
+            token=TEST_TOKEN,
+            buffered=True,
+            flush_interval=60
+        )
+        with client:
+            client.log('test message 1', tag='value1')
+            client.log('test message 2', tag='value2')
+            self.assertTrue(client.flush(timeout=5))
+
+        time.sleep(1)
+
+        query_r = self.client.query()
+        self.assertEqual(len(query_r), 2)
+
+    def test_export(self):
+        self.client.log('test message 1', tag1='value1', time='2017-01-01T01:00:00Z')
+        self.client.log('test message 2', tag2='value2', time='2017-01-01T05:00:00Z')
+        self.client.log('test message 3', tag1='value1', time='2017-01-02T01:00:00Z')
+
+        time.sleep(1)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'logs.ndjson.gz')
+            self.client.export(path, time__gte='2017-01-01T00:00:00Z', time__lte='2017-01-01T23:59:59Z')
+            with gzip.open(path, 'rt') as f:
+                logs = [json.loads(line) for line in f]
+            self.assertEqual([log['message'] for log in logs], ['test message 1', 'test message 2'])
+
+            self.client.export(path, format='csv', time__gte='2017-01-01T00:00:00Z', time__lte='2017-01-03T00:00:00Z', tag1='value1')
+            with gzip.open(path, 'rt') as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual([row['message'] for row in rows], ['test message 1', 'test message 3'])
+            self.assertEqual(rows[0]['tag1'], 'value1')
+            self.assertEqual(rows[0]['client_name'], self.client_name)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        r = self.client.session.get(
+            '%s/logs/export' % self.client.url,
+            params={'time__gte': 'invalid'}
+        )
+        self.assertEqual(r.status_code, 400)
+
+    def test_batch_insert_errors(self):
+        batch_r = requests.post(
+            '%s/logs/batch' % self.client.url,
+            json=[
+                {'message': 'test message 1', 'tags': {}},
+                {'message': 'test message 2'},
+                {'message': 'test message 3', 'tags': {'page': '1'}},
+            ],
+            headers=self.client.headers
+        )
+        self.assertEqual(batch_r.status_code, 207)
+        self.assertEqual(batch_r.json()['inserted'], 1)
+        self.assertEqual(
+            [error['index'] for error in batch_r.json()['errors']],
+            [1, 2]
+        )
+
+    def test_line_protocol_insert(self):
+        client = logsink.Client(
+            self.client_name,
+            token=TEST_TOKEN,
+            buffered=True,
+            flush_interval=60,
+            line_protocol=True
+        )
+        with client:
+            client.log('test message 1', tag='line protocol')
+            client.log('test message "2"\nline 2', tag='line protocol')
+            self.assertTrue(client.flush(timeout=5))
+
+        batch_r = requests.post(
+            '%s/logs/batch' % self.client.url,
+            data=b'logs,client_name=test-client message="test message 3"\nlogs,page=1 message="x"\n',
+            headers=dict(self.client.headers, **{'Content-Type': 'application/x-influxdb-line-protocol'})
+        )
+        self.assertEqual(batch_r.status_code, 207)
+        self.assertEqual(batch_r.json()['inserted'], 1)
+        self.assertEqual([error['index'] for error in batch_r.json()['errors']], [1])
+
+        time.sleep(1)
+
+        logs = self.client.query(tag='line protocol')
+        self.assertEqual(len(logs), 2)
+        self.assertEqual(len(self.client.query()), 3)
+
+    def test_compressed_insert(self):
+        client = logsink.Client(self.client_name, token=TEST_TOKEN, compress_threshold=0)
+        log_r = client.log('test message', tag1='compressed')
+        self.assertEqual(log_r.status_code, 201)
+
+        r = requests.post(
+            '%s/logs' % client.url,
+            data=b'not gzip',
+            headers=dict(client.headers, **{'Content-Encoding': 'gzip'})
+        )
+        self.assertEqual(r.status_code, 400)
+
+        time.sleep(1)
+
+        logs = client.query(tag1='compressed')
+        self.assertEqual([log['message'] for log in logs], ['test message'])
+        client.close()
+
+    def test_metrics(self):
+        batch_r = requests.post(
+            '%s/logs/batch' % self.client.url,
+            json=[{'message': 'test message', 'tags': {}}, {'message': 'test message'}],
+            headers=self.client.headers
+        )
+        self.assertEqual(batch_r.status_code, 207)
+
+        r = requests.get('%s/metrics' % self.client.url, headers=self.client.headers)
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+        self.assertIn('logsink_records_ingested_total ', r.text)
+        self.assertIn('logsink_records_rejected_total ', r.text)
+        self.assertIn('logsink_stage_duration_seconds_count{stage="parse"}', r.text)
+        self.assertIn('logsink_request_duration_seconds_count{handler="/logs/batch"', r.text)
+
+    def test_invalid_requests(self):
+        for path in ('logs', 'logs/aggregated'):
+            r = requests.get(
+                '%s/%s' % (self.client.url, path),
+                params={'time__gte': 'yesterday-ish'},
+                headers=self.client.headers
+            )
+            self.assertEqual(r.status_code, 400)
+            self.assertIn('error', r.json())
+
+        r = requests.get(
+            '%s/logs/aggregated' % self.client.url,
+            params={'num_intervals': 'ten'},
+            headers=self.client.headers
+        )
+        self.assertEqual(r.status_code, 400)
+
+        r = requests.delete(
+            '%s/logs' % self.client.url,
+            params={'time__lte': 'yesterday-ish'},
+            headers=self.client.headers
+        )
+        self.assertEqual(r.status_code, 400)
+
+        r = requests.post('%s/logs' % self.client.url, json={'message': 'test message'}, headers=self.client.headers)
+        self.assertEqual(r.status_code, 400)
+        self.assertIn('tags', r.json()['message'])
+
+    def test_storage_admin(self):
+        log_r = self.client.log('test message', time='2017-01-01T01:00:00Z')
+        self.assertEqual(log_r.status_code, 201)
+
+        time.sleep(1)
+
+        r = requests.get('%s/admin/storage' % self.client.url, headers=self.client.headers)
+        self.assertEqual(r.status_code, 200)
+        status = r.json()
+        self.assertGreater(status['disk_bytes'], 0)
+        self.assertTrue(any(
+            shard['start'] <= '2017-01-01T01:00:00Z' < shard['end']
+            for shard in status['shards']
+        ))
+        self.assertIn('pending_expirations', status)
+
+    def test_cursor_pagination(self):
+        for i in range(5):
+            log_r = self.client.log('test message %d' % i, time='2017-01-01T01:00:0%dZ' % i)
+            self.assertEqual(log_r.status_code, 201)
+
+        time.sleep(1)
+
+        pages = list(self.client.query_pages(
+            time__gte='2017-01-01T00:00:00Z',
+            time__lte='2017-01-02T00:00:00Z',
+            per_page=2
+        ))
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(
+            [log['message'] for page in pages for log in page],
+            ['test message %d' % i for i in range(5)]
+        )
+
+    def test_iter_query(self):
+        for i in range(5):
+            log_r = self.client.log('test message %d' % i, time='2017-01-01T01:00:0%dZ' % i)
+            self.assertEqual(log_r.status_code, 201)
+
+        time.sleep(1)
+
+        logs = list(self.client.iter_query(
+            time__gte='2017-01-01T00:00:00Z',
+            time__lte='2017-01-02T00:00:00Z',
+            per_page=2
+        ))
+        self.assertEqual(
+            [log['message'] for log in logs],
+            ['test message %d' % i for i in range(5)]
+        )
+
+    def test_tail(self):
+        received = []
+        logs = self.client.tail(tag='tail')
+
+        def read():
+            received.append(next(logs))
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+
+        # The reader may not be subscribed yet, keep logging until it gets a
+        # message
+        for i in range(50):
+            self.client.log('test message %d' % i, tag='other')
+            self.client.log('tail message %d' % i, tag='tail')
+            reader.join(0.1)
+            if received:
+                break
+
+        self.assertEqual(len(received), 1)
+        self.assertTrue(received[0]['message'].startswith('tail message'))
+        self.assertEqual(received[0]['client_name'], self.client_name)
+        logs.close()
@@ -0,0 +1,240 @@
+import shutil
+import concurrent.futures
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from logsink_server import query
+from logsink_server import segments
+from logsink_server import sharding
+from logsink_server import storage
+
+
+class TestShardedStorage(unittest.TestCase):
+    def setUp(self):
+        self.data_dirs = [tempfile.mkdtemp() for _ in range(3)]
+        self.db = self.open()
+
+    def tearDown(self):
+        self.db.close()
+        for data_dir in self.data_dirs:
+            shutil.rmtree(data_dir)
+
+    def open(self, **kwargs):
+        return sharding.ShardedStorage(
+            'logsink-test',
+            shards=[
+                segments.SegmentStorage('logsink-test', data_dir=data_dir)
+                for data_dir in self.data_dirs
+            ],
+            **kwargs
+        )
+
+    def query(self, db=None, **kwargs):
+        kwargs.setdefault('time__gte', '2017-01-01T00:00:00Z')
+        kwargs.setdefault('time__lte', '2017-01-10T00:00:00Z')
+        return list((db or self.db).query(**kwargs))
+
+    def insert_clients(self):
+        # Several rows at the same time on different shards
+        for i in range(12):
+            self.db.insert(
+                'test message %d' % i,
+                client_name='client-%d' % (i % 4),
+                time='2017-01-01T01:00:0%dZ' % (i // 3)
+            )
+
+    def test_routing(self):
+        self.insert_clients()
+
+        for i in range(4):
+            rows = self.query(client_name='client-%d' % i)
+            self.assertEqual(len(rows), 3)
+            # All on the one shard of the client
+            shard = self.db.shards[self.db.shard_index({'client_name': 'client-%d' % i})]
+            self.assertEqual(rows, self.query(shard, client_name='client-%d' % i))
+
+        counts = [len(self.query(shard, per_page=100)) for shard in self.db.shards]
+        self.assertEqual(sum(counts), 12)
+        self.assertGreater(sum(1 for count in counts if count), 1)
+
+    def test_merge(self):
+        self.db.insert('test message 2', client_name='a', time='2017-01-01T01:00:00Z')
+        self.db.insert('test message 1', client_name='b', time='2017-01-01T00:59:59.5Z')
+        self.db.insert('test message 3', client_name='c', time='2017-01-01T01:00:00.25Z')
+
+        self.assertEqual(
+            [row['message'] for row in self.query()],
+            ['test message 1', 'test message 2', 'test message 3']
+        )
+
+    def test_pagination(self):
+        self.insert_clients()
+        rows = self.query(per_page=100)
+        self.assertEqual(len(rows), 12)
+        self.assertEqual(rows, sorted(rows, key=lambda row: row['time']))
+
+        self.assertEqual(self.query(page=2, per_page=5), rows[5:10])
+        self.assertEqual(self.query(page=3, per_page=5), rows[10:])
+
+        # The cursor pages follow each other, rows at the same time too
+        paged = []
+        kwargs = {'cursor': '', 'per_page': 2}
+        while True:
+            page = self.query(**kwargs)
+            paged.extend(page)
+            cursor = storage.next_cursor(page, **kwargs)
+            if cursor is None:
+                break
+            kwargs['cursor'] = cursor
+        self.assertEqual(paged, rows)
+
+    def test_cursor_same_time(self):
+        # Rows at the same times on all the shards, more of them than a page
+        clients = {}
+        for i in range(100):
+            clients.setdefault(self.db.shard_index({'client_name': 'client-%d' % i}), 'client-%d' % i)
+        self.assertEqual(len(clients), 3)
+        for second in range(2):
+            for shard, client_name in sorted(clients.items()):
+                for i in range(3):
+                    self.db.insert(
+                        'test message %d-%d-%d' % (second, shard, i),
+                        client_name=client_name,
+                        time='2017-01-01T01:00:0%dZ' % second
+                    )
+        rows = self.query(per_page=100)
+        self.assertEqual(len(rows), 18)
+
+        requested = []
+        for shard in self.db.shards:
+            query_shard = shard.query
+
+            def record(query_shard=query_shard, **kwargs):
+                requested.append(int(kwargs['per_page']))
+                return query_shard(**kwargs)
+            shard.query = record
+
+        for per_page in (2, 4, 5):
+            paged = []
+            kwargs = {'cursor': '', 'per_page': per_page}
+            while True:
+                del requested[:]
+                page = self.query(**kwargs)
+                paged.extend(page)
+                # The rows at the cursor time on top of the page
+                skip = storage.decode_cursor(kwargs['cursor'])
+                self.assertEqual(requested, [per_page + (skip[1] if skip else 0)]*3)
+                cursor = storage.next_cursor(page, **kwargs)
+                if cursor is None:
+                    break
+                kwargs['cursor'] = cursor
+            self.assertEqual(paged, rows)
+
+        # Page N reads N pages from every shard
+        del requested[:]
+        self.assertEqual(self.query(page=3, per_page=4), rows[8:12])
+        self.assertEqual(requested, [12]*3)
+
+    def test_histogram(self):
+        self.insert_clients()
+        self.db.insert('test message', client_name='client-1', time='2017-01-01T02:30:00Z')
+
+        self.assertEqual(
+            self.db.histogram(3600, time__gte='2017-01-01T00:00:00Z', time__lte='2017-01-01T02:59:59Z'),
+            [
+                {'time': '2017-01-01T00:00:00Z', 'count_message': 0},
+                {'time': '2017-01-01T01:00:00Z', 'count_message': 12},
+                {'time': '2017-01-01T02:00:00Z', 'count_message': 1},
+            ]
+        )
+        rows = self.db.aggregated(
+            time__gte='2017-01-01T00:00:00Z',
+            time__lte='2017-01-01T03:00:00Z',
+            num_intervals=4,
+            client_name='client-1'
+        )
+        self.assertEqual(sum(row['count_message'] for row in rows), 4)
+
+    def test_clear(self):
+        self.insert_clients()
+
+        self.db.clear(client_name='client-2')
+        self.assertEqual(len(self.query(per_page=100)), 9)
+        self.assertEqual(self.query(client_name='client-2'), [])
+
+        self.db.clear()
+        self.assertEqual(self.query(), [])
+
+    def test_insert_many(self):
+        errors = self.db.insert_many([
+            ('test message 1', {'client_name': 'a', 'time': '2017-01-01T01:00:00Z'}),
+            ('test message 2', {'client_name': 'b', 'page': '1'}),
+            ('test message 3', {'client_name': 'c', 'time': '2017-01-01T01:00:01Z'}),
+            ('test message 4', {'client_name': 'a', 'per_page': '1'}),
+        ])
+
+        self.assertEqual([index for index, _ in errors], [1, 3])
+        self.assertEqual(len(self.query()), 2)
+
+    def test_insert_lines(self):
+        errors = self.db.insert_lines(
+            b'logs,client_name=a message="test message 1" 1483232400000000000\n'
+            b'logs,client_name=b message="test message 2" 1483232401000000000\n'
+            b'logs,client_name=c message="test message 3\nline 2" 1483232402000000000\n'
+        )
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            [row['message'] for row in self.query()],
+            ['test message 1', 'test message 2', 'test message 3\nline 2']
+        )
+
+    def test_time_sharding(self):
+        db = self.open(shard_by='time', shard_seconds=3600)
+        for hour in range(6):
+            db.insert('test message %d' % hour, time='2017-01-01T%02d:30:00Z' % hour)
+
+        # One hour per shard, in turn
+        for i, shard in enumerate(db.shards):
+            self.assertEqual(
+                [row['message'] for row in self.query(shard)],
+                ['test message %d' % i, 'test message %d' % (i + 3)]
+            )
+        self.assertEqual(len(self.query(db)), 6)
+
+        # Only the shards of the queried hours are queried
+        compiled = query.compile(time__gte='2017-01-01T01:00:00Z', time__lte='2017-01-01T01:59:59Z')
+        self.assertEqual(db._shards_for(compiled), [db.shards[1]])
+        compiled = query.compile(time__gte='2017-01-01T00:00:00Z', time__lte='2017-01-01T03:00:00Z')
+        self.assertEqual(db._shards_for(compiled), db.shards)
+
+
+class TestFanOut(unittest.TestCase):
+    def test_one_executor(self):
+        # Concurrent first fan-outs share one executor
+        created = []
+        new_executor = concurrent.futures.ThreadPoolExecutor
+
+        def executor(**kwargs):
+            time.sleep(0.05)
+            created.append(new_executor(**kwargs))
+            return created[-1]
+
+        results = []
+        with mock.patch.object(sharding, '_executor', None), \
+                mock.patch.object(concurrent.futures, 'ThreadPoolExecutor', side_effect=executor):
+            threads = [
+                threading.Thread(target=lambda: results.append(sharding._fan_out(lambda shard: shard*2, [1, 2])))
+                for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, [[2, 4]]*4)
+        self.assertEqual(len(created), 1)
+        created[0].shutdown()
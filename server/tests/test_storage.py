@@ -0,0 +1,154 @@
+import datetime
+import threading
+import unittest
+from unittest import mock
+
+from logsink_server import segments
+from logsink_server import storage
+
+
+class FakeStorage:
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestStorageRegistry(unittest.TestCase):
+    def setUp(self):
+        self.created = []
+        patcher = mock.patch.object(storage, '_backend', lambda: self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        storage.invalidate_storage()
+        self.addCleanup(storage.invalidate_storage)
+
+    def backend(self, dbname):
+        # Set up without holding the registry lock
+        self.assertFalse(storage._storages_lock.locked())
+        db = FakeStorage(dbname)
+        self.created.append(db)
+        return db
+
+    def test_cached(self):
+        db = storage.get_storage('logsink-a')
+        self.assertIs(storage.get_storage('logsink-a'), db)
+        self.assertIsNot(storage.get_storage('logsink-b'), db)
+        self.assertEqual([db.dbname for db in self.created], ['logsink-a', 'logsink-b'])
+
+    def test_invalidate(self):
+        a = storage.get_storage('logsink-a')
+        b = storage.get_storage('logsink-b')
+
+        storage.invalidate_storage('logsink-a')
+        self.assertIsNot(storage.get_storage('logsink-a'), a)
+        self.assertIs(storage.get_storage('logsink-b'), b)
+
+        storage.invalidate_storage()
+        self.assertIsNot(storage.get_storage('logsink-b'), b)
+        self.assertEqual(len(self.created), 4)
+
+    def test_race(self):
+        # Both threads set up a storage, one of them is published and the
+        # other one closed
+        barrier = threading.Barrier(2, timeout=2)
+
+        def backend(dbname):
+            db = FakeStorage(dbname)
+            self.created.append(db)
+            barrier.wait()
+            return db
+
+        results = []
+        with mock.patch.object(storage, '_backend', lambda: backend):
+            threads = [
+                threading.Thread(target=lambda: results.append(storage.get_storage('logsink-a')))
+                for _ in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(self.created), 2)
+        self.assertIs(results[0], results[1])
+        self.assertEqual(sorted(db.closed for db in self.created), [False, True])
+        self.assertFalse(results[0].closed)
+
+
+class TestEnsureDatabase(unittest.TestCase):
+    def setUp(self):
+        storage.invalidate_storage()
+        self.addCleanup(storage.invalidate_storage)
+
+    def test_ensure_database(self):
+        client = mock.Mock()
+        client.get_list_database.return_value = [{'name': 'logsink-other'}]
+
+        storage._ensure_database(client, 'logsink-a')
+        storage._ensure_database(client, 'logsink-a')
+        client.get_list_database.assert_called_once_with()
+        client.create_database.assert_called_once_with('logsink-a')
+
+        # Checked again once invalidated, e.g. dropped outside of logsink
+        client.get_list_database.return_value = [{'name': 'logsink-a'}]
+        storage.invalidate_storage('logsink-a')
+        storage._ensure_database(client, 'logsink-a')
+        self.assertEqual(client.get_list_database.call_count, 2)
+        client.create_database.assert_called_once_with('logsink-a')
+
+
+class TestFilters(unittest.TestCase):
+    def record(self, message, **tags):
+        return storage.Record(datetime.datetime(2017, 1, 1), message, tags)
+
+    def test_matches(self):
+        filters = storage.Filters(message='^test [0-9]+$', client_name='a', level='1', per_page='5')
+        self.assertEqual(filters.tags, {'client_name': 'a', 'level': '1'})
+        self.assertTrue(filters.matches(self.record('test 12', client_name='a', level=1)))
+        self.assertFalse(filters.matches(self.record('test x', client_name='a', level=1)))
+        self.assertFalse(filters.matches(self.record('test 12', client_name='b', level=1)))
+        self.assertFalse(filters.matches(self.record('test 12', client_name='a')))
+
+    def test_invalid_regex(self):
+        # Same error for the embedded storage, the caches and the live tail
+        for filters in (storage.Filters, segments.Filter):
+            with self.assertRaisesRegex(ValueError, 'Invalid message regex'):
+                filters(message='test [')
+
+    def test_segments(self):
+        # Segment records hold the tags as strings
+        filters = segments.Filter(message='test', level='1')
+        self.assertTrue(filters({'m': 'a test', 'g': {'level': '1'}}))
+        self.assertFalse(filters({'m': 'a test', 'g': {}}))
+        self.assertFalse(filters({'m': 'a message', 'g': {'level': '1'}}))
+
+
+class TestPoolAdapter(unittest.TestCase):
+    def test_in_use(self):
+        adapter = storage.PoolAdapter(4)
+        sending = threading.Event()
+        done = threading.Event()
+
+        def send(self, request, **kwargs):
+            sending.set()
+            done.wait(2)
+            return 'response'
+
+        with mock.patch('requests.adapters.HTTPAdapter.send', send):
+            thread = threading.Thread(target=adapter.send, args=('request',))
+            thread.start()
+            self.assertTrue(sending.wait(2))
+            self.assertEqual(adapter.in_use, 1)
+            done.set()
+            thread.join()
+        self.assertEqual(adapter.in_use, 0)
+
+    def test_pool_usage(self):
+        db = storage.InfluxDBStorage.__new__(storage.InfluxDBStorage)
+        db.pool = storage.PoolAdapter(4)
+        db.pool.in_use = 3
+        with mock.patch.dict(storage._storages, {'logsink-a': db, 'logsink-b': FakeStorage('logsink-b')}, clear=True):
+            self.assertEqual(storage._pool_usage(), {('logsink-a', 'in_use'): 3, ('logsink-a', 'max'): 4})
@@ -0,0 +1,55 @@
+import shutil
+import tempfile
+import unittest
+
+from logsink_server import segments
+from logsink_server import tail
+
+
+class TestFanoutHub(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.db = segments.SegmentStorage('logsink-test', data_dir=self.data_dir)
+        self.hub = tail.FanoutHub(queue_size=3)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.data_dir)
+
+    def test_subscribe(self):
+        subscriber = self.hub.subscribe('logsink-test', tag='value1', message='^test')
+        other = self.hub.subscribe('other-db')
+        self.assertEqual(len(self.hub), 2)
+
+        self.db.insert('test message 1', tag='value1', time='2017-01-01T01:00:00Z')
+        self.db.insert('test message 2', tag='value2', time='2017-01-01T01:00:00Z')
+        self.db.insert('other message', tag='value1', time='2017-01-01T01:00:00Z')
+
+        self.assertEqual(
+            subscriber.get(timeout=0),
+            {'time': '2017-01-01T01:00:00Z', 'message': 'test message 1', 'tag': 'value1'}
+        )
+        self.assertIsNone(subscriber.get(timeout=0))
+        self.assertIsNone(other.get(timeout=0))
+
+        self.hub.unsubscribe(subscriber)
+        self.hub.unsubscribe(other)
+        self.assertEqual(len(self.hub), 0)
+
+        with self.assertRaises(ValueError):
+            self.hub.subscribe('logsink-test', message='(')
+
+    def test_slow_subscriber(self):
+        slow = self.hub.subscribe('logsink-test')
+        fast = self.hub.subscribe('logsink-test')
+
+        for i in range(5):
+            self.db.insert('test message %d' % i, time='2017-01-01T01:00:00Z')
+            self.assertEqual(fast.get(timeout=0)['message'], 'test message %d' % i)
+
+        self.assertTrue(slow.dropped)
+        with self.assertRaises(tail.Dropped):
+            slow.get(timeout=0)
+        self.assertEqual(self.hub.dropped, 1)
+        self.assertEqual(len(self.hub), 1)
+        self.hub.unsubscribe(fast)
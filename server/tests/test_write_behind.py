@@ -0,0 +1,181 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import influxdb
+import requests
+
+from logsink_server import storage
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class FakeWrite:
+    """write(dbname, points) of a WriteBehindBuffer, raising errors in turn."""
+
+    def __init__(self, errors=(), gate=None):
+        self.errors = list(errors)
+        self.batches = []
+        self.lock = threading.Lock()
+        self.gate = gate  # an Event writes wait for
+
+    def __call__(self, dbname, points):
+        if self.gate is not None:
+            self.gate.wait()
+        with self.lock:
+            if self.errors:
+                raise self.errors.pop(0)
+            self.batches.append((dbname, list(points)))
+
+    def points(self, dbname=None):
+        with self.lock:
+            return [point for name, points in self.batches if dbname in (None, name) for point in points]
+
+
+class TestWriteBehindBuffer(unittest.TestCase):
+    def open(self, write, **kwargs):
+        kwargs.setdefault('max_points', 100)
+        kwargs.setdefault('batch_size', 10)
+        kwargs.setdefault('flush_interval', 60)
+        buffer = storage.WriteBehindBuffer(write, **kwargs)
+        self.addCleanup(buffer.close, 2)
+        return buffer
+
+    def test_batch_size(self):
+        write = FakeWrite()
+        buffer = self.open(write, batch_size=3)
+
+        buffer.put('db', [1, 2])
+        time.sleep(0.1)
+        self.assertEqual(write.batches, [])
+
+        # A full batch is written without waiting for the flush interval
+        buffer.put('db', [3, 4])
+        self.assertTrue(wait_for(lambda: write.points() == [1, 2, 3, 4]))
+        self.assertEqual([points for _, points in write.batches], [[1, 2, 3], [4]])
+
+    def test_flush_interval(self):
+        write = FakeWrite()
+        buffer = self.open(write, flush_interval=0.2)
+
+        buffer.put('db-1', [1])
+        buffer.put('db-2', [2, 3])
+        self.assertEqual(write.batches, [])
+        self.assertTrue(wait_for(lambda: len(write.batches) == 2))
+        self.assertEqual(sorted(write.batches), [('db-1', [1]), ('db-2', [2, 3])])
+        self.assertEqual(len(buffer), 0)
+
+    def test_flush(self):
+        write = FakeWrite()
+        buffer = self.open(write)
+
+        buffer.put('db', [1, 2])
+        self.assertTrue(buffer.flush(timeout=2))
+        self.assertEqual(write.batches, [('db', [1, 2])])
+        self.assertEqual(buffer.stats.as_dict()['points'], 2)
+
+    def test_buffer_full(self):
+        buffer = self.open(FakeWrite(), max_points=3)
+
+        buffer.put('db', [1, 2])
+        with self.assertRaises(storage.BufferFull):
+            buffer.put('db', [3, 4])
+        self.assertEqual(len(buffer), 2)
+        self.assertEqual(buffer.stats.as_dict()['rejected_points'], 2)
+
+    def test_retry(self):
+        # Unreachable or failing InfluxDB: the points are written again,
+        # before the newer ones
+        write = FakeWrite([
+            requests.exceptions.ConnectionError('refused'),
+            influxdb.exceptions.InfluxDBServerError('timeout'),
+        ])
+        buffer = self.open(write, flush_interval=0.1)
+
+        buffer.put('db', [1, 2])
+        self.assertTrue(wait_for(lambda: len(write.errors) == 1))
+        buffer.put('db', [3])
+        self.assertTrue(buffer.flush(timeout=2))
+        self.assertEqual(write.points(), [1, 2, 3])
+        stats = buffer.stats.as_dict()
+        # The second try wrote the new point with the failed ones
+        self.assertEqual(stats['failed_points'], 5)
+        self.assertEqual(stats['points'], 3)
+
+    def test_retry_full(self):
+        # No room left for the failed points, they're dropped
+        gate = threading.Event()
+        write = FakeWrite([requests.exceptions.ConnectionError('refused')], gate)
+        buffer = self.open(write, max_points=3, flush_interval=0.1)
+
+        buffer.put('db', [1, 2])
+        self.assertTrue(wait_for(lambda: len(buffer) == 0))
+        # Put while the failing write is in flight
+        buffer.put('db', [3, 4])
+        gate.set()
+        self.assertTrue(buffer.flush(timeout=2))
+        self.assertEqual(write.points(), [3, 4])
+
+    def test_rejected(self):
+        # Points InfluxDB refuses won't be written by trying again
+        write = FakeWrite([influxdb.exceptions.InfluxDBClientError('bad point', 400)])
+        buffer = self.open(write)
+
+        buffer.put('db', [1])
+        self.assertTrue(buffer.flush(timeout=2))
+        buffer.put('db', [2])
+        self.assertTrue(buffer.flush(timeout=2))
+        self.assertEqual(write.points(), [2])
+        self.assertEqual(buffer.stats.as_dict()['failed_points'], 1)
+
+    def test_close(self):
+        write = FakeWrite()
+        buffer = storage.WriteBehindBuffer(write, max_points=100, batch_size=10, flush_interval=60)
+
+        buffer.put('db', [1, 2, 3])
+        buffer.close(timeout=2)
+        self.assertFalse(buffer._thread.is_alive())
+        self.assertEqual(write.points(), [1, 2, 3])
+        with self.assertRaises(RuntimeError):
+            buffer.put('db', [4])
+
+    def test_close_failing(self):
+        # No retries once closed, close doesn't hang on an unreachable InfluxDB
+        write = FakeWrite([requests.exceptions.ConnectionError('refused')])
+        buffer = storage.WriteBehindBuffer(write, max_points=100, batch_size=10, flush_interval=60)
+
+        buffer.put('db', [1])
+        buffer.close(timeout=2)
+        self.assertFalse(buffer._thread.is_alive())
+        self.assertEqual(write.points(), [])
+
+
+class TestClear(unittest.TestCase):
+    def test_flush_before_clear(self):
+        # Buffered points are written before the DELETE, not after it
+        calls = []
+        buffer = storage.WriteBehindBuffer(
+            lambda dbname, points: calls.append(('write', points)),
+            flush_interval=60
+        )
+        self.addCleanup(buffer.close, 2)
+
+        db = storage.InfluxDBStorage.__new__(storage.InfluxDBStorage)
+        db.dbname = 'logsink-test'
+        db.client = mock.Mock()
+        db.client.query.side_effect = lambda query: calls.append(('query', query))
+
+        with mock.patch.object(storage, 'write_behind', buffer):
+            buffer.put('logsink-test', ['point'])
+            db.clear(client_name='test')
+
+        self.assertEqual([call[0] for call in calls], ['write', 'query'])
+        self.assertIn('DELETE', calls[1][1])